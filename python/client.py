@@ -21,20 +21,26 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import collections
+import collections.abc
 import dbus
 import dbus.service
 import dbus.mainloop.glib
+import json
 import logging
+import os
 import os.path
 import sys
 import inspect
 
 from xml.etree import ElementTree
+from gi.repository import GLib
 
 dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
 from zeitgeist.datamodel import (Event, Subject, TimeRange, StorageState,
-	ResultType)
+	ResultType, NULL_EVENT, EventRecord, TemplateMatcher)
 
 SIG_EVENT = "asaasay"
 
@@ -53,6 +59,81 @@ def _set_bus(bus):
 	global session_bus
 	session_bus = bus
 
+class _IntrospectionCache(object):
+	"""
+	Cache of the method and signal names of the D-Bus interfaces used by
+	:class:`_DBusInterface`, so that they don't need to be introspected
+	every time a program starts. It is kept in memory and in a small JSON
+	file in the user's cache directory, shared by all processes.
+	
+	Entries are keyed by bus name, object path and interface name. They
+	aren't keyed by engine version, since finding that out would cost as
+	much as introspecting; instead :class:`_DBusInterface` introspects
+	again whenever a name it's asked for isn't in the cached data.
+	"""
+	
+	FORMAT_VERSION = 1
+	
+	def __init__(self):
+		self._members = None
+	
+	@staticmethod
+	def get_path():
+		cache_dir = os.environ.get("XDG_CACHE_HOME") or \
+			os.path.join(os.path.expanduser("~"), ".cache")
+		return os.path.join(cache_dir, "zeitgeist", "introspection.json")
+	
+	@staticmethod
+	def _make_key(bus_name, object_path, interface_name):
+		return " ".join((bus_name, object_path, interface_name))
+	
+	def _load(self):
+		self._members = {}
+		try:
+			with open(self.get_path()) as f:
+				data = json.load(f)
+			if data.get("version") == self.FORMAT_VERSION:
+				self._members = data["interfaces"]
+		except (IOError, ValueError, KeyError, AttributeError) as e:
+			log.debug("Couldn't read introspection cache: %s" % e)
+	
+	def _save(self):
+		path = self.get_path()
+		temp_path = "%s.%d" % (path, os.getpid())
+		try:
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(temp_path, "w") as f:
+				json.dump({"version": self.FORMAT_VERSION,
+					"interfaces": self._members}, f)
+			os.rename(temp_path, path)
+		except (IOError, OSError) as e:
+			log.debug("Couldn't write introspection cache: %s" % e)
+	
+	def get(self, bus_name, object_path, interface_name):
+		"""
+		Return a (methods, signals) tuple or None if the interface
+		isn't cached.
+		"""
+		if self._members is None:
+			self._load()
+		members = self._members.get(
+			self._make_key(bus_name, object_path, interface_name))
+		if members is None:
+			return None
+		return list(members["methods"]), list(members["signals"])
+	
+	def set(self, bus_name, object_path, interface_name, methods, signals):
+		if self._members is None:
+			self._load()
+		key = self._make_key(bus_name, object_path, interface_name)
+		members = {"methods": sorted(methods), "signals": sorted(signals)}
+		if self._members.get(key) != members:
+			self._members[key] = members
+			self._save()
+
+_introspection_cache = _IntrospectionCache()
+
 class _DBusInterface(object):
 	"""Wrapper around dbus.Interface adding convenience methods."""
 
@@ -61,6 +142,17 @@ class _DBusInterface(object):
 	_disconnect_callbacks = None
 	_reconnect_callbacks = None
 
+	# Errors meaning that Zeitgeist couldn't be reached at all
+	_CONNECTION_ERRORS = frozenset((
+		"org.freedesktop.DBus.Error.ServiceUnknown",
+		"org.freedesktop.DBus.Error.NameHasNoOwner",
+		"org.freedesktop.DBus.Error.NoReply",
+		"org.freedesktop.DBus.Error.NoServer",
+		"org.freedesktop.DBus.Error.Disconnected",
+		"org.freedesktop.DBus.Error.Timeout",
+		"org.freedesktop.DBus.Error.TimedOut",
+	))
+
 	@staticmethod
 	def get_members(introspection_xml):
 		"""Parses the XML context returned by Introspect() and returns
@@ -85,7 +177,8 @@ class _DBusInterface(object):
 			self.__iface.requested_bus_name, self.__object_path,
 			follow_name_owner_changes=True)
 		self.__iface = dbus.Interface(self.__proxy, self.__interface_name)
-		self._load_introspection_data()
+		self.__disconnected = False
+		self.__introspected = False
 
 	def _disconnection_safe(self, method_getter, *args, **kwargs):
 		"""
@@ -122,7 +215,7 @@ class _DBusInterface(object):
 			return reconnecting_error_handler(e)
 
 	def __getattr__(self, name):
-		if self.__methods is not None and name not in self.__methods:
+		if not self._has_member(name):
 			raise TypeError("Unknown method name: %s" % name)
 		def _ProxyMethod(*args, **kwargs):
 			"""
@@ -140,9 +233,9 @@ class _DBusInterface(object):
 
 	def connect(self, signal, callback, **kwargs):
 		"""Connect a callback to a signal of the current proxy instance."""
-		if self.__signals is None:
+		if self.__disconnected:
 			self.reconnect()
-		if signal not in self.__signals:
+		if not self._has_member(signal, signal=True):
 			raise TypeError("Unknown signal name: %s" % signal)
 		return self.__proxy.connect_to_signal(
 			signal,
@@ -170,6 +263,41 @@ class _DBusInterface(object):
 		self.__methods, self.__signals = self.get_members(
 			self.__proxy.Introspect(
 				dbus_interface='org.freedesktop.DBus.Introspectable'))
+		self.__introspected = True
+		_introspection_cache.set(self.__iface.requested_bus_name,
+			self.__object_path, self.__interface_name,
+			self.__methods, self.__signals)
+
+	def _has_member(self, name, signal=False):
+		"""
+		Check whether the remote interface has a method (or signal) called
+		`name`. The list of members is loaded lazily, from the cache if
+		possible, and introspected again if `name` isn't found in cached
+		data.
+		"""
+		try:
+			if self.__methods is None:
+				members = _introspection_cache.get(
+					self.__iface.requested_bus_name, self.__object_path,
+					self.__interface_name)
+				if members is not None:
+					self.__methods, self.__signals = members
+				else:
+					self._load_introspection_data()
+			if name in (self.__signals if signal else self.__methods):
+				return True
+			if self.__introspected:
+				return False
+			# The cached data may be outdated, eg. if Zeitgeist was upgraded
+			self._load_introspection_data()
+			return name in (self.__signals if signal else self.__methods)
+		except dbus.exceptions.DBusException as e:
+			if e.get_dbus_name() not in self._CONNECTION_ERRORS:
+				raise
+			# Zeitgeist isn't reachable right now; don't stand in the way,
+			# the call itself will try to reconnect.
+			log.debug("Introspection failed: %s" % e)
+			return True
 
 	def __init__(self, proxy, interface_name, object_path, reconnect=True):
 		self.__proxy = proxy
@@ -177,7 +305,10 @@ class _DBusInterface(object):
 		self.__object_path = object_path
 		self.__iface = dbus.Interface(proxy, interface_name)
 		self._reconnect_when_needed = reconnect
-		self._load_introspection_data()
+		# Method and signal names are loaded lazily, see _has_member()
+		self.__methods = self.__signals = None
+		self.__disconnected = False
+		self.__introspected = False
 		
 		self._first_connection = True
 		self._disconnect_callbacks = set()
@@ -187,6 +318,8 @@ class _DBusInterface(object):
 		def name_owner_changed(connection_name):
 			if connection_name == "":
 				self.__methods = self.__signals = None
+				self.__disconnected = True
+				self.__introspected = False
 				for callback in self._disconnect_callbacks:
 					callback()
 			elif self._first_connection:
@@ -269,6 +402,178 @@ class ZeitgeistDBusInterface(object):
 			self.__shared_state["dbus_interface"] = _DBusInterface(proxy,
 				self.INTERFACE_NAME, self.OBJECT_PATH, reconnect)
 
+class _StringInterner(object):
+	"""
+	Bounded table through which the events decoded from D-Bus replies
+	share a single copy of each interpretation, manifestation, actor,
+	mime-type and storage string, instead of keeping a separate
+	dbus.String for every occurrence. This saves memory with large result
+	sets and turns most symbol comparisons into identity checks.
+	
+	When the table is full it is emptied and starts over, which keeps its
+	size bounded without any bookkeeping on lookups.
+	"""
+	
+	EVENT_FIELDS = (Event.Interpretation, Event.Manifestation, Event.Actor)
+	SUBJECT_FIELDS = (Subject.Interpretation, Subject.Manifestation,
+		Subject.Mimetype, Subject.Storage)
+	
+	def __init__(self, max_size=4096):
+		self._max_size = max_size
+		self._strings = {}
+	
+	def intern(self, value):
+		string = self._strings.get(value)
+		if string is None:
+			if len(self._strings) >= self._max_size:
+				self._strings.clear()
+			string = self._strings[value] = str(value)
+		return string
+	
+	def intern_event_struct(self, struct):
+		"""
+		Replace the repetitive fields of the raw event `struct`, and of
+		its subjects, with their interned copies. Returns `struct`.
+		"""
+		intern = self.intern
+		data = struct[0]
+		if len(data) > Event.Actor:
+			for field in self.EVENT_FIELDS:
+				data[field] = intern(data[field])
+		if len(struct) > 1:
+			for subject in struct[1]:
+				if len(subject) > Subject.Storage:
+					for field in self.SUBJECT_FIELDS:
+						subject[field] = intern(subject[field])
+		return struct
+
+_string_interner = _StringInterner()
+
+class LazyEventList(collections.abc.MutableSequence):
+	"""
+	Sequence of events built from a raw D-Bus reply, signature
+	a(asaasay), which creates each :class:`Event <zeitgeist.datamodel.Event>`
+	only when it's first accessed.
+	
+	It behaves like a list of events (or None for events which weren't
+	found), but isn't a :class:`list` subclass, so the raw structs it
+	holds are never visible from the outside. Indexing and iterating
+	only build the events they return; use `list(events)` to get a plain
+	list, eg. for :mod:`json` or other code which requires one.
+	"""
+	
+	__slots__ = ("_factory", "_items")
+	
+	__hash__ = None
+	
+	def __init__(self, factory, structs=()):
+		"""
+		:param factory: Callable turning a raw event struct into an
+		    event, eg. :meth:`Event.new_for_struct`
+		:param structs: The raw event structs
+		"""
+		self._factory = factory
+		self._items = list(structs)
+	
+	@staticmethod
+	def _is_raw(item):
+		# D-Bus structs are tuples; events are lists
+		return isinstance(item, tuple)
+	
+	def _get(self, index):
+		item = self._items[index]
+		if self._is_raw(item):
+			item = self._factory(item)
+			self._items[index] = item
+		return item
+	
+	def materialize(self):
+		"""
+		Build all events which haven't been accessed yet.
+		"""
+		for i in range(len(self._items)):
+			self._get(i)
+	
+	def __len__(self):
+		return len(self._items)
+	
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return LazyEventList(self._factory, self._items[index])
+		return self._get(index)
+	
+	def __setitem__(self, index, value):
+		if isinstance(index, slice):
+			value = list(value)
+		self._items[index] = value
+	
+	def __delitem__(self, index):
+		del self._items[index]
+	
+	def insert(self, index, value):
+		self._items.insert(index, value)
+	
+	def __iter__(self):
+		i = 0
+		while i < len(self._items):
+			yield self._get(i)
+			i += 1
+	
+	def extend(self, items):
+		if isinstance(items, LazyEventList) and \
+			items._factory == self._factory:
+			# Don't build events just to move them between lists
+			self._items.extend(items._items)
+		else:
+			self._items.extend(items)
+	
+	def __iadd__(self, items):
+		self.extend(items)
+		return self
+	
+	def __add__(self, other):
+		if isinstance(other, (list, LazyEventList)):
+			return list(self) + list(other)
+		return NotImplemented
+	
+	def __radd__(self, other):
+		if isinstance(other, list):
+			return other + list(self)
+		return NotImplemented
+	
+	def __mul__(self, count):
+		return list(self) * count
+	
+	__rmul__ = __mul__
+	
+	def __eq__(self, other):
+		if isinstance(other, (list, LazyEventList)):
+			return list(self) == list(other)
+		return NotImplemented
+	
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		return result if result is NotImplemented else not result
+	
+	def __repr__(self):
+		return repr(list(self))
+	
+	def clear(self):
+		self._items.clear()
+	
+	def copy(self):
+		return list(self)
+	
+	def sort(self, *args, **kwargs):
+		self.materialize()
+		self._items.sort(*args, **kwargs)
+	
+	def reverse(self):
+		self._items.reverse()
+	
+	def __reduce_ex__(self, protocol):
+		return (list, (list(self),))
+
 class Monitor(dbus.service.Object):
 	"""
 	DBus interface for monitoring the Zeitgeist log for certain types
@@ -280,6 +585,14 @@ class Monitor(dbus.service.Object):
 	It is important to understand that the Monitor instance lives on the
 	client side, and expose a DBus service there, and the Zeitgeist engine
 	calls back to the monitor when matching events are registered.
+	
+	If *coalesce_latency* is given, notifications are not delivered as
+	they arrive. Instead all insertions (or deletions) received within
+	*coalesce_latency* milliseconds of the first one are merged and
+	delivered with a single callback: events are concatenated, event ids
+	are joined and the time ranges are widened to cover all of them.
+	While a merged callback runs, :attr:`coalesced_notifications` holds
+	the number of raw notifications that were merged into it.
 	"""
 	
 	# Used in Monitor._next_path() to generate unique path names
@@ -288,7 +601,8 @@ class Monitor(dbus.service.Object):
 	_event_type = Event
 
 	def __init__ (self, time_range, event_templates, insert_callback,
-		delete_callback, monitor_path=None, event_type=None):
+		delete_callback, monitor_path=None, event_type=None,
+		coalesce_latency=None):
 		if not monitor_path:
 			monitor_path = Monitor._next_path()
 		elif isinstance(monitor_path, str):
@@ -304,8 +618,15 @@ class Monitor(dbus.service.Object):
 		self._path = monitor_path
 		self._insert_callback = insert_callback
 		self._delete_callback = delete_callback
+		self._coalesce_latency = coalesce_latency
+		self._coalesced_notifications = 1
+		self._pending = None
+		self._pending_source = None
 		dbus.service.Object.__init__(self, get_bus(), monitor_path)
 	
+	def _new_event(self, struct):
+		return self._event_type(_string_interner.intern_event_struct(struct))
+	
 	def get_path (self): return self._path
 	path = property(get_path,
 		doc="Read only property with the DBus path of the monitor object")
@@ -318,6 +639,12 @@ class Monitor(dbus.service.Object):
 	templates = property(get_templates,
 		doc="Read only property with installed templates")
 	
+	def get_coalesced_notifications (self):
+		return self._coalesced_notifications
+	coalesced_notifications = property(get_coalesced_notifications,
+		doc="Read only property with the number of raw notifications "
+		"merged into the callback currently being delivered")
+	
 	@dbus.service.method("org.gnome.zeitgeist.Monitor",
 	                     in_signature="(xx)a("+SIG_EVENT+")")
 	def NotifyInsert(self, time_range, events):
@@ -335,8 +662,12 @@ class Monitor(dbus.service.Object):
 		    with the events matching the monitor.
 		    See :meth:`ZeitgeistClient.install_monitor`
 		"""
-		self._insert_callback(TimeRange(time_range[0], time_range[1]),
-			list(map(self._event_type, events)))
+		events = LazyEventList(self._new_event, events)
+		if self._coalesce_latency:
+			self._coalesce(self._insert_callback, time_range, events)
+		else:
+			self._insert_callback(TimeRange(time_range[0], time_range[1]),
+				events)
 	
 	@dbus.service.method("org.gnome.zeitgeist.Monitor",
 	                     in_signature="(xx)au")
@@ -357,7 +688,67 @@ class Monitor(dbus.service.Object):
 		:param event_ids: A list of event ids. An event id is simply
 		    and unsigned 32 bit integer. DBus signature au.
 		"""
-		self._delete_callback(TimeRange(time_range[0], time_range[1]), event_ids)
+		if self._coalesce_latency:
+			self._coalesce(self._delete_callback, time_range, list(event_ids))
+		else:
+			self._delete_callback(TimeRange(time_range[0], time_range[1]),
+				event_ids)
+	
+	def _coalesce(self, callback, time_range, items):
+		pending = self._pending
+		if pending is not None and pending[0] is not callback:
+			# Don't let deletions overtake insertions (or the other way
+			# around); deliver what we have before switching kinds.
+			self.flush()
+			pending = None
+		if pending is None:
+			# Deleted ids are merged as a set union, keeping their order;
+			# the first notification's list is never modified in place
+			if callback is self._delete_callback:
+				items = dict.fromkeys(items)
+			else:
+				items = list(items)
+			self._pending = [callback, time_range[0], time_range[1], items, 1]
+			self._pending_source = GLib.timeout_add(self._coalesce_latency,
+				self._on_coalesce_timeout)
+		else:
+			pending[1] = min(pending[1], time_range[0])
+			pending[2] = max(pending[2], time_range[1])
+			if callback is self._delete_callback:
+				pending[3].update(dict.fromkeys(items))
+			else:
+				pending[3].extend(items)
+			pending[4] += 1
+	
+	def flush(self):
+		"""
+		Immediately deliver any notifications held back because of
+		*coalesce_latency*.
+		"""
+		self._cancel_pending()
+		pending, self._pending = self._pending, None
+		if pending is None:
+			return False
+		callback, start, end, items, count = pending
+		self._coalesced_notifications = count
+		try:
+			callback(TimeRange(start, end), list(items))
+		finally:
+			self._coalesced_notifications = 1
+		return False
+	
+	def _on_coalesce_timeout(self):
+		self._pending_source = None
+		return self.flush()
+	
+	def _cancel_pending(self):
+		if self._pending_source is not None:
+			GLib.source_remove(self._pending_source)
+			self._pending_source = None
+	
+	def _discard_pending(self):
+		self._cancel_pending()
+		self._pending = None
 	
 	def __hash__ (self):
 		return hash(self._path)
@@ -371,6 +762,503 @@ class Monitor(dbus.service.Object):
 		return dbus.ObjectPath("/org/gnome/zeitgeist/monitor/%s" % \
 			cls._last_path_id)
 
+class _LocalMonitor(object):
+	"""
+	Monitor returned by :meth:`ZeitgeistClient.install_monitor` when
+	monitor multiplexing is enabled. It doesn't have a D-Bus object of its
+	own; its callbacks are invoked by the :class:`_MonitorMultiplexer`.
+	"""
+	
+	def __init__(self, multiplexer, time_range, event_templates,
+		insert_callback, delete_callback):
+		self._multiplexer = multiplexer
+		self._time_range = TimeRange(time_range[0], time_range[1])
+		self._templates = event_templates
+		self._matcher = TemplateMatcher.compile(event_templates)
+		self._insert_callback = insert_callback
+		self._delete_callback = delete_callback
+	
+	def get_time_range(self): return self._time_range
+	time_range = property(get_time_range,
+		doc="Read only property with the :class:`TimeRange` matched by this monitor")
+	
+	def get_templates (self): return self._templates
+	templates = property(get_templates,
+		doc="Read only property with installed templates")
+	
+	def _filter_events(self, events):
+		return self._matcher.filter(event for event in events
+			if event.in_time_range(self._time_range))
+
+class _MonitorMultiplexer(object):
+	"""
+	Installs a single :class:`Monitor` in the engine covering the union of
+	the templates and time ranges of all the monitors installed through
+	:meth:`ZeitgeistClient.install_monitor`, and dispatches the received
+	notifications to each of them after matching the events locally.
+	
+	Whenever the set of monitors changes, a new combined monitor is
+	installed with a new path and the old one is removed once the engine
+	has confirmed the installation; notifications are only dispatched
+	from the active monitor, so no event is lost or reported twice.
+	"""
+	
+	def __init__(self, client):
+		self._client = client
+		self._subscribers = []
+		self._monitor = None # the installed monitor we dispatch from
+		self._pending = None # a monitor waiting for InstallMonitor's reply
+		self._update_id = None
+		client._iface.connect_join(self._reinstall)
+	
+	def add(self, time_range, event_templates, insert_callback,
+		delete_callback):
+		subscriber = _LocalMonitor(self, time_range, event_templates,
+			insert_callback, delete_callback)
+		self._subscribers.append(subscriber)
+		self._schedule_update()
+		return subscriber
+	
+	def remove(self, subscriber):
+		self._subscribers.remove(subscriber)
+		self._schedule_update()
+	
+	def _schedule_update(self):
+		# Several monitors are often installed at once, so we only
+		# reinstall the combined one when we get back to the mainloop.
+		if self._update_id is None:
+			self._update_id = GLib.idle_add(self._update)
+	
+	def _get_union(self):
+		begin = min(sub.time_range[0] for sub in self._subscribers)
+		end = max(sub.time_range[1] for sub in self._subscribers)
+		templates = []
+		seen = set()
+		for subscriber in self._subscribers:
+			if not subscriber.templates:
+				# This one wants all events
+				return TimeRange(begin, end), []
+			for template in subscriber.templates:
+				key = _get_template_key(template)
+				if key not in seen:
+					seen.add(key)
+					templates.append(template)
+		return TimeRange(begin, end), templates
+	
+	def _update(self):
+		self._update_id = None
+		if not self._subscribers:
+			self._pending = None
+			if self._monitor is not None:
+				self._remove(self._monitor)
+				self._monitor = None
+			return False
+		
+		time_range, templates = self._get_union()
+		monitor = Monitor(time_range, templates,
+			lambda time_range, events:
+				self._notify_insert(monitor, time_range, events),
+			lambda time_range, event_ids:
+				self._notify_delete(monitor, time_range, event_ids),
+			event_type=self._client._event_type)
+		self._pending = monitor
+		
+		def installed_cb():
+			if self._pending is not monitor:
+				# Superseded by a newer update before being installed
+				self._remove(monitor)
+				return
+			self._pending = None
+			if self._monitor is not None:
+				self._remove(self._monitor)
+			self._monitor = monitor
+		
+		self._client._iface.InstallMonitor(monitor.path, monitor.time_range,
+			monitor.templates,
+			reply_handler=installed_cb,
+			error_handler=lambda err: log.warn(
+				"Error installing monitor: %s" % err))
+		return False
+	
+	def _remove(self, monitor):
+		self._client._iface.RemoveMonitor(monitor.path,
+			reply_handler=lambda: monitor.remove_from_connection(),
+			error_handler=lambda err: log.warn(
+				"Error removing monitor %s: %s" % (monitor.path, err)))
+	
+	def _reinstall(self):
+		if self._monitor is not None:
+			self._client._iface.InstallMonitor(self._monitor.path,
+				self._monitor.time_range,
+				self._monitor.templates,
+				reply_handler=self._client._void_reply_handler,
+				error_handler=lambda err: log.warn(
+					"Error reinstalling monitor: %s" % err))
+	
+	def _notify_insert(self, monitor, time_range, events):
+		if monitor is not self._monitor:
+			return
+		for subscriber in list(self._subscribers):
+			matching = subscriber._filter_events(events)
+			if matching:
+				timestamps = [int(event.timestamp) for event in matching]
+				subscriber._insert_callback(
+					TimeRange(min(timestamps), max(timestamps)), matching)
+	
+	def _notify_delete(self, monitor, time_range, event_ids):
+		if monitor is not self._monitor:
+			return
+		for subscriber in list(self._subscribers):
+			# Report the same range a dedicated monitor would have
+			subscriber_range = subscriber.time_range.intersect(time_range)
+			if subscriber_range is not None:
+				subscriber._delete_callback(subscriber_range, event_ids)
+
+class _InsertBatcher(object):
+	"""
+	Queue used by :class:`ZeitgeistClient` in batching mode. It collects
+	the events given to :meth:`ZeitgeistClient.insert_events` and sends
+	them to the engine in a single InsertEvents call once `max_events`
+	events are waiting or `max_delay` milliseconds have passed since the
+	first of them was queued.
+	"""
+
+	# Errors for calls which the engine rejected without inserting anything
+	_INVALID_ERRORS = frozenset((
+		"org.gnome.zeitgeist.EngineError.InvalidArgument",
+		"org.gnome.zeitgeist.EngineError.InvalidEvent",
+		"org.freedesktop.DBus.Error.InvalidArgs",
+	))
+	
+	def __init__(self, iface, max_events, max_delay):
+		self._iface = iface
+		self._max_events = max_events
+		self._max_delay = max_delay
+		self._queue = [] # (events, reply_handler, error_handler) tuples
+		self._num_events = 0
+		self._timeout_id = None
+
+	def add(self, events, reply_handler, error_handler):
+		self._queue.append((events, reply_handler, error_handler))
+		self._num_events += len(events)
+		if self._num_events >= self._max_events:
+			self.flush()
+		elif self._timeout_id is None:
+			self._timeout_id = GLib.timeout_add(self._max_delay,
+				self._timeout_cb)
+
+	def _timeout_cb(self):
+		self._timeout_id = None
+		self.flush()
+		return False
+
+	def flush(self):
+		"""
+		Send all queued events right away.
+		"""
+		if self._timeout_id is not None:
+			GLib.source_remove(self._timeout_id)
+			self._timeout_id = None
+		if not self._queue:
+			return
+		queue, self._queue = self._queue, []
+		self._num_events = 0
+		self._send(queue)
+
+	def _send(self, queue):
+		events = []
+		for batch, reply_handler, error_handler in queue:
+			events.extend(batch)
+
+		def dispatch_reply(ids):
+			# The ids come back in insertion order, so each caller gets
+			# the slice corresponding to the events it queued.
+			offset = 0
+			for batch, reply_handler, error_handler in queue:
+				try:
+					reply_handler(ids[offset:offset + len(batch)])
+				except Exception:
+					log.exception("Error in insert_events reply handler")
+				offset += len(batch)
+
+		def dispatch_error(error):
+			if len(queue) > 1 and \
+				error.get_dbus_name() in self._INVALID_ERRORS:
+				# The engine rejects the whole call if a single event is
+				# invalid (and doesn't insert any of them), so send each
+				# batch on its own to find out whose events were at fault.
+				# Other errors (eg. timeouts) may come after the events
+				# were inserted, so those aren't retried.
+				for entry in queue:
+					self._send([entry])
+				return
+			for batch, reply_handler, error_handler in queue:
+				try:
+					error_handler(error)
+				except Exception:
+					log.exception("Error in insert_events error handler")
+
+		self._iface.InsertEvents(events,
+			reply_handler=dispatch_reply,
+			error_handler=dispatch_error)
+
+def _freeze(value):
+	if isinstance(value, (list, tuple)):
+		return tuple(_freeze(item) for item in value)
+	return str(value)
+
+def _get_template_key(template):
+	"""
+	Return a hashable representation of an event template, leaving out
+	its timestamp, which isn't used for matching.
+	"""
+	data = list(template[0])
+	data[Event.Timestamp] = ""
+	return _freeze((data, template[1], template[2]))
+
+def _copy_event_struct(struct):
+	"""
+	Event instances use the metadata array of the struct they are created
+	from, so cached structs must be copied before being handed out.
+	"""
+	return (list(struct[0]), struct[1], struct[2])
+
+class QueryCache(object):
+	"""
+	Client-side cache for the results of
+	:meth:`ZeitgeistClient.find_events_for_templates` and
+	:meth:`ZeitgeistClient.find_event_ids_for_templates`, as returned by
+	:meth:`ZeitgeistClient.enable_query_cache`.
+	
+	Results are keyed by the query arguments (ignoring the timestamps of
+	the templates, which aren't used for matching). Each entry installs
+	its own :class:`Monitor` with the templates and time range of the
+	query, and is dropped as soon as the engine notifies the insertion
+	of a matching event or the deletion of an event in that time range.
+	Queries without an explicit time range are monitored over
+	:meth:`TimeRange.always() <zeitgeist.datamodel.TimeRange.always>`.
+	
+	Queries restricted to a *storage_state* other than
+	:attr:`StorageState.Any <zeitgeist.datamodel.StorageState.Any>`
+	aren't cached, since their results also change when storage media
+	become available or unavailable, which monitors don't report.
+	
+	Identical queries issued while the first one is still waiting for
+	its reply share that reply. At most *max_entries* results are kept,
+	evicting the least recently used ones first.
+	
+	The *hits*, *misses* and *invalidations* attributes count how many
+	queries were answered from the cache, how many had to be sent to the
+	engine and how many entries were dropped because the log changed.
+	"""
+	
+	class _Entry(object):
+		
+		def __init__(self, key):
+			self.key = key
+			self.reply = None
+			self.waiters = [] # set to None once the reply is available
+			self.monitor = None
+			self.valid = True
+	
+	def __init__(self, client, max_entries):
+		self._client = client
+		self._max_entries = max_entries
+		self._entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+	
+	def __len__(self):
+		return len(self._entries)
+	
+	@classmethod
+	def make_key(cls, method_name, timerange, event_templates,
+		storage_state, num_events, result_type):
+		"""
+		Return a hashable normalized form of the given query arguments.
+		A `timerange` of None stands for "until now".
+		"""
+		templates = tuple(map(_get_template_key, event_templates))
+		if timerange is not None:
+			timerange = (int(timerange[0]), int(timerange[1]))
+		return (method_name, timerange, templates,
+			int(storage_state), int(num_events), int(result_type))
+	
+	def query(self, key, method, args, monitor_time_range, event_templates,
+		copy_reply, reply_handler, error_handler):
+		"""
+		Pass to `reply_handler` the cached reply for `key`, or call
+		`method` with `args` and cache its reply. `copy_reply` is used to
+		give each caller its own copy of the cached reply.
+		"""
+		entry = self._entries.get(key)
+		if entry is not None:
+			self.hits += 1
+			self._entries.move_to_end(key)
+			if entry.waiters is None:
+				# Keep the reply asynchronous, as callers expect
+				reply = copy_reply(entry.reply)
+				GLib.idle_add(lambda: reply_handler(reply) and False)
+			else:
+				entry.waiters.append((copy_reply, reply_handler, error_handler))
+			return
+		
+		self.misses += 1
+		entry = self._Entry(key)
+		entry.waiters.append((copy_reply, reply_handler, error_handler))
+		self._entries[key] = entry
+		# The monitor is installed before the query is sent, so that no
+		# change happening after the query was executed can be missed.
+		invalidate = lambda time_range, events: self._invalidate(entry)
+		entry.monitor = self._client.install_monitor(monitor_time_range,
+			event_templates, invalidate, invalidate)
+		
+		def dispatch_reply(reply):
+			waiters, entry.waiters = entry.waiters, None
+			if entry.valid:
+				entry.reply = reply
+			for copy_reply, reply_handler, error_handler in waiters:
+				reply_handler(copy_reply(reply))
+		
+		def dispatch_error(error):
+			waiters, entry.waiters = entry.waiters, None
+			self._drop(entry)
+			for copy_reply, reply_handler, error_handler in waiters:
+				error_handler(error)
+		
+		method(*args, reply_handler=dispatch_reply,
+			error_handler=dispatch_error)
+		
+		while len(self._entries) > self._max_entries:
+			self._drop(next(iter(self._entries.values())))
+	
+	def _invalidate(self, entry):
+		if entry.valid:
+			self.invalidations += 1
+			self._drop(entry)
+	
+	def _drop(self, entry):
+		if not entry.valid:
+			return
+		entry.valid = False
+		entry.reply = None
+		if self._entries.get(entry.key) is entry:
+			del self._entries[entry.key]
+		monitor = entry.monitor
+		if isinstance(monitor, Monitor):
+			# Unexport it as well, or each dropped entry would leave an
+			# object behind on the bus connection
+			self._client.remove_monitor(monitor,
+				lambda removed: monitor.remove_from_connection())
+		else:
+			self._client.remove_monitor(monitor)
+	
+	def clear(self):
+		"""
+		Drop all cached results.
+		"""
+		for entry in list(self._entries.values()):
+			self._drop(entry)
+
+class EventCache(object):
+	"""
+	Bounded least-recently-used cache of events by id, used by
+	:meth:`ZeitgeistClient.get_events` once it has been enabled with
+	:meth:`ZeitgeistClient.enable_event_cache`.
+	
+	Only the ids which aren't cached are requested from the engine, and
+	the result is merged back in the requested order. A :class:`Monitor`
+	matching no events is installed to learn about deletions, which
+	remove the deleted events from the cache.
+	
+	Note that the cached events don't reflect later changes to the
+	*current_uri* and *current_origin* fields of their subjects, which
+	the engine makes when files are moved.
+	
+	The *hits* and *misses* attributes count how many of the requested
+	ids were found in the cache and how many had to be fetched.
+	"""
+	
+	# Monitors are notified about deletions no matter their templates,
+	# and we don't want to be sent all inserted events, so we use a
+	# template which can't match anything.
+	_NO_EVENTS_TEMPLATE = Event.new_for_values(
+		interpretation="zeitgeist-client:event-cache")
+	
+	def __init__(self, client, max_events):
+		self._client = client
+		self._max_events = max_events
+		self._structs = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self._monitor = client.install_monitor(TimeRange.always(),
+			[self._NO_EVENTS_TEMPLATE], self._void_handler,
+			self._delete_handler)
+	
+	def __len__(self):
+		return len(self._structs)
+	
+	def __contains__(self, event_id):
+		return int(event_id) in self._structs
+	
+	def _void_handler(self, *args):
+		pass
+	
+	def _delete_handler(self, time_range, event_ids):
+		for event_id in event_ids:
+			self._structs.pop(int(event_id), None)
+	
+	def get_events(self, event_ids, method, reply_handler, error_handler):
+		"""
+		Pass to `reply_handler` the event structs for `event_ids`, calling
+		`method` (ie. GetEvents) for those which aren't cached.
+		"""
+		found = {}
+		missing = []
+		for event_id in event_ids:
+			event_id = int(event_id)
+			if event_id in found:
+				continue
+			struct = self._structs.get(event_id)
+			if struct is not None:
+				self.hits += 1
+				self._structs.move_to_end(event_id)
+				found[event_id] = struct
+			elif event_id not in missing:
+				self.misses += 1
+				missing.append(event_id)
+		
+		def dispatch_reply(raw=()):
+			for event_id, struct in zip(missing, raw):
+				if struct[0]: # not a NULL_EVENT
+					found[event_id] = struct
+					self._structs[event_id] = struct
+			while len(self._structs) > self._max_events:
+				self._structs.popitem(last=False)
+			reply_handler([_copy_event_struct(found.get(int(event_id),
+				NULL_EVENT)) for event_id in event_ids])
+		
+		if missing:
+			method(missing, reply_handler=dispatch_reply,
+				error_handler=error_handler)
+		else:
+			# Keep the reply asynchronous, as callers expect
+			GLib.idle_add(lambda: dispatch_reply() and False)
+	
+	def clear(self):
+		"""
+		Drop all cached events.
+		"""
+		self._structs.clear()
+	
+	def close(self):
+		"""
+		Drop all cached events and remove the deletion monitor.
+		"""
+		self.clear()
+		self._client.remove_monitor(self._monitor)
+
 class ZeitgeistClient(object):
 	"""
 	Convenience APIs to have a Pythonic way to call and monitor the running
@@ -384,6 +1272,10 @@ class ZeitgeistClient(object):
 	
 	_installed_monitors = []
 	_event_type = Event
+	_insert_batcher = None
+	_query_cache = None
+	_event_cache = None
+	_monitor_multiplexer = None
 	
 	@staticmethod
 	def get_event_and_extra_arguments(arguments):
@@ -548,11 +1440,127 @@ class ZeitgeistClient(object):
 		"""
 		
 		self._check_list_or_tuple(events)
+		events = self._as_events(events)
 		self._check_members(events, Event)
+		reply_handler = self._safe_reply_handler(ids_reply_handler)
+		error_handler = self._safe_error_handler(error_handler,
+			reply_handler, [])
+		if self._insert_batcher is not None:
+			self._insert_batcher.add(events, reply_handler, error_handler)
+			return
 		self._iface.InsertEvents(events,
-					reply_handler=self._safe_reply_handler(ids_reply_handler),
-					error_handler=self._safe_error_handler(error_handler,
-						self._safe_reply_handler(ids_reply_handler), []))
+					reply_handler=reply_handler,
+					error_handler=error_handler)
+	
+	def enable_insert_batching(self, max_events=100, max_delay=50):
+		"""
+		Switch this client to batching mode. From now on, events passed
+		to :meth:`insert_events`, :meth:`insert_event` and
+		:meth:`insert_event_for_values` are queued and sent to the
+		engine together, in a single InsertEvents call, as soon as
+		*max_events* events are waiting or *max_delay* milliseconds
+		after the first of them was queued, whatever happens first.
+		
+		Each *ids_reply_handler* still receives only the ids of the
+		events it was given. If the engine rejects the combined insertion
+		as invalid, every queued call is retried on its own, so that only
+		the *error_handler* of the calls which actually fail is invoked;
+		any other error is passed to all of them.
+		
+		Use :meth:`flush` to send the queued events immediately and
+		:meth:`close` to leave batching mode.
+		
+		In order to use this method there needs to be a GLib mainloop
+		running.
+		"""
+		if max_events < 1:
+			raise ValueError("max_events must be a positive number")
+		self.flush()
+		self._insert_batcher = _InsertBatcher(self._iface, max_events,
+			max_delay)
+	
+	def flush(self):
+		"""
+		Send any events queued by batching mode to the engine right away.
+		Does nothing if batching mode isn't enabled.
+		"""
+		if self._insert_batcher is not None:
+			self._insert_batcher.flush()
+	
+	def close(self):
+		"""
+		Send any events queued by batching mode and leave batching mode.
+		"""
+		self.flush()
+		self._insert_batcher = None
+	
+	def enable_query_cache(self, max_entries=50):
+		"""
+		Start caching the results of :meth:`find_events_for_templates`
+		and :meth:`find_event_ids_for_templates`, so that repeating a
+		query doesn't reach the engine until the events it matches
+		actually change. See :class:`QueryCache` for the details.
+		
+		Note that each cached result keeps a monitor installed in the
+		engine, so *max_entries* shouldn't be too big.
+		
+		:returns: the :class:`QueryCache`, which can be used to look at
+		    its hit and miss counters.
+		"""
+		if self._query_cache is None:
+			self._query_cache = QueryCache(self, max_entries)
+			# A restarted engine may have a different log
+			self._iface.connect_join(self._query_cache.clear)
+		return self._query_cache
+	
+	def disable_query_cache(self):
+		"""
+		Stop caching query results and drop the cached ones.
+		"""
+		if self._query_cache is not None:
+			self._query_cache.clear()
+			self._query_cache = None
+	
+	def enable_monitor_multiplexing(self):
+		"""
+		Make :meth:`install_monitor` share a single monitor in the engine
+		between all the monitors installed from now on. The engine is
+		asked for the union of their templates and time ranges, and the
+		received events are matched against each monitor's own templates
+		locally, using a :class:`TemplateMatcher
+		<zeitgeist.datamodel.TemplateMatcher>`, before invoking
+		its callbacks. This is much cheaper for the engine when many
+		monitors are installed.
+		
+		Monitors installed with an explicit *monitor_path* are never
+		shared. The monitors returned while multiplexing is enabled
+		don't have a D-Bus path of their own.
+		"""
+		if self._monitor_multiplexer is None:
+			self._monitor_multiplexer = _MonitorMultiplexer(self)
+	
+	def enable_event_cache(self, max_events=1000):
+		"""
+		Start keeping up to *max_events* of the events returned by
+		:meth:`get_events` in memory, so that asking again for them
+		doesn't reach the engine. See :class:`EventCache` for the details.
+		
+		:returns: the :class:`EventCache`, which can be used to look at
+		    its hit and miss counters.
+		"""
+		if self._event_cache is None:
+			self._event_cache = EventCache(self, max_events)
+			# A restarted engine may have a different log
+			self._iface.connect_join(self._event_cache.clear)
+		return self._event_cache
+	
+	def disable_event_cache(self):
+		"""
+		Stop caching events and drop the cached ones.
+		"""
+		if self._event_cache is not None:
+			self._event_cache.close()
+			self._event_cache = None
 	
 	def find_event_ids_for_templates (self,
 					event_templates,
@@ -616,12 +1624,24 @@ class ZeitgeistClient(object):
 		        Read about the default behaviour above
 		"""
 		self._check_list_or_tuple(event_templates)
+		event_templates = self._as_events(event_templates)
 		self._check_members(event_templates, Event)
 		
 		if not callable(ids_reply_handler):
 			raise TypeError(
 				"Reply handler not callable, found %s" % ids_reply_handler)
 		
+		reply_handler = self._safe_reply_handler(ids_reply_handler)
+		error_handler = self._safe_error_handler(error_handler,
+			ids_reply_handler, [])
+		
+		if self._query_cache is not None and \
+			storage_state == StorageState.Any:
+			self._cached_query("FindEventIds", timerange, event_templates,
+				storage_state, num_events, result_type, list,
+				reply_handler, error_handler)
+			return
+		
 		if timerange is None:
 			timerange = TimeRange.until_now()
 		
@@ -630,9 +1650,8 @@ class ZeitgeistClient(object):
 					storage_state,
 					num_events,
 					result_type,
-					reply_handler=self._safe_reply_handler(ids_reply_handler),
-					error_handler=self._safe_error_handler(error_handler,
-						ids_reply_handler, []))
+					reply_handler=reply_handler,
+					error_handler=error_handler)
 	
 	def find_event_ids_for_template (self, event_template, ids_reply_handler,
 		**kwargs):
@@ -712,12 +1731,26 @@ class ZeitgeistClient(object):
 		        Read about the default behaviour above
 		"""
 		self._check_list_or_tuple(event_templates)
+		event_templates = self._as_events(event_templates)
 		self._check_members(event_templates, Event)
 		
 		if not callable(events_reply_handler):
 			raise TypeError(
 				"Reply handler not callable, found %s" % events_reply_handler)
 		
+		reply_handler = lambda raw: events_reply_handler(
+			LazyEventList(self._event_for_struct, raw))
+		error_handler = self._safe_error_handler(error_handler,
+			events_reply_handler, [])
+		
+		if self._query_cache is not None and \
+			storage_state == StorageState.Any:
+			copy_reply = lambda raw: list(map(_copy_event_struct, raw))
+			self._cached_query("FindEvents", timerange, event_templates,
+				storage_state, num_events, result_type, copy_reply,
+				reply_handler, error_handler)
+			return
+		
 		if timerange is None:
 			timerange = TimeRange.until_now()
 		
@@ -726,10 +1759,23 @@ class ZeitgeistClient(object):
 					storage_state,
 					num_events,
 					result_type,
-					reply_handler=lambda raw: events_reply_handler(
-						list(map(self._event_type.new_for_struct, raw))),
-					error_handler=self._safe_error_handler(error_handler,
-						events_reply_handler, []))
+					reply_handler=reply_handler,
+					error_handler=error_handler)
+	
+	def _cached_query(self, method_name, timerange, event_templates,
+		storage_state, num_events, result_type, copy_reply, reply_handler,
+		error_handler):
+		key = self._query_cache.make_key(method_name, timerange,
+			event_templates, storage_state, num_events, result_type)
+		if timerange is None:
+			monitor_time_range = TimeRange.always()
+			timerange = TimeRange.until_now()
+		else:
+			monitor_time_range = timerange
+		self._query_cache.query(key, getattr(self._iface, method_name),
+			(timerange, event_templates, storage_state, num_events,
+			result_type), monitor_time_range, event_templates, copy_reply,
+			reply_handler, error_handler)
 	
 	def find_events_for_template (self, event_template, events_reply_handler,
 		**kwargs):
@@ -786,11 +1832,202 @@ class ZeitgeistClient(object):
 		
 		# Generate a wrapper callback that does automagic conversion of
 		# the raw DBus reply into a list of Event instances
+		reply_handler = lambda raw: events_reply_handler(
+			LazyEventList(self._event_for_struct, raw))
+		error_handler = self._safe_error_handler(error_handler,
+			events_reply_handler, [])
+		
+		if self._event_cache is not None:
+			self._event_cache.get_events(event_ids, self._iface.GetEvents,
+				reply_handler, error_handler)
+			return
+		
 		self._iface.GetEvents(event_ids,
-				reply_handler=lambda raw: events_reply_handler(
-					list(map(self._event_type.new_for_struct, raw))),
-				error_handler=self._safe_error_handler(error_handler,
-						events_reply_handler, []))
+				reply_handler=reply_handler,
+				error_handler=error_handler)
+
+	def iter_events(self,
+					event_templates,
+					timerange = None,
+					storage_state = StorageState.Any,
+					num_events = 0,
+					result_type = ResultType.MostRecentEvents,
+					page_size = 100):
+		"""
+		Return an iterator over all :class:`Events <zeitgeist.datamodel.Event>`
+		matching *event_templates*, for walking through large result sets.
+
+		The query is executed once with FindEventIds and the events are
+		then fetched with GetEvents in pages of *page_size* events. The
+		next page is always requested while the current one is being
+		consumed, and no more than two pages are held in memory at the
+		same time. Events deleted after the query was run are skipped.
+
+		Unlike the rest of this class, iterating blocks until the needed
+		data is available; meanwhile the default GLib main context is
+		iterated, so D-Bus replies and other sources keep being dispatched.
+
+		The arguments have the same meaning as in
+		:meth:`find_event_ids_for_templates`, except that *num_events*
+		defaults to 0, which returns all matching events. D-Bus errors
+		are raised from the iterator.
+		"""
+		self._check_list_or_tuple(event_templates)
+		event_templates = self._as_events(event_templates)
+		self._check_members(event_templates, Event)
+		if page_size < 1:
+			raise ValueError("page_size must be a positive number")
+
+		if timerange is None:
+			timerange = TimeRange.until_now()
+
+		request = self._request_reply(self._iface.FindEventIds, timerange,
+			event_templates, storage_state, num_events, result_type)
+		return self._iter_events_for_ids(self._wait_for_reply(request),
+			page_size)
+
+	def _iter_events_for_ids(self, event_ids, page_size):
+		pending = None
+		if event_ids:
+			pending = self._request_reply(self._iface.GetEvents,
+				event_ids[:page_size])
+		for offset in range(0, len(event_ids), page_size):
+			request = pending
+			next_offset = offset + page_size
+			if next_offset < len(event_ids):
+				# Prefetch the next page while this one is consumed
+				pending = self._request_reply(self._iface.GetEvents,
+					event_ids[next_offset:next_offset + page_size])
+			for struct in self._wait_for_reply(request):
+				event = self._event_for_struct(struct)
+				if event is not None:
+					yield event
+
+	@staticmethod
+	def _request_reply(method, *args):
+		"""
+		Start an asynchronous D-Bus call and return a dict which will
+		hold either its "reply" or its "error" once it completes.
+		"""
+		request = {}
+		method(*args,
+			reply_handler=lambda reply: request.update(reply=reply),
+			error_handler=lambda error: request.update(error=error))
+		return request
+
+	@staticmethod
+	def _wait_for_reply(request):
+		"""
+		Iterate the default GLib main context until `request`, as returned
+		by :meth:`_request_reply`, has completed, and return its reply.
+		"""
+		context = GLib.MainContext.default()
+		while not request:
+			context.iteration(True)
+		if "error" in request:
+			raise request["error"]
+		return request["reply"]
+
+	def gather(self, queries, reply_handler, timeout=None):
+		"""
+		Run several queries at the same time and pass all their results
+		to *reply_handler* at once.
+		
+		All queries are sent right away, so they are processed by the
+		engine while the earlier replies are still on their way; the whole
+		batch takes about as long as its slowest query.
+		
+		Each query is a tuple with the name of one of the asynchronous
+		methods of this class, a tuple with its arguments leaving out the
+		reply handler, and optionally a dict with keyword arguments::
+		
+		    client.gather([
+		        ("find_events_for_templates", ([documents],),
+		            {"num_events": 10}),
+		        ("find_events_for_templates", ([apps],),
+		            {"result_type": ResultType.MostPopularActor}),
+		        ("get_events", ([42, 43],)),
+		    ], update_view, timeout=2000)
+		
+		:param queries: A list of queries, as described above
+		:param reply_handler: Callback taking two lists, each with one
+		    item per query: the results, and the errors. A query which
+		    failed has None as result and the error (for example a
+		    :class:`dbus.DBusException`) in the errors list; for the other
+		    queries the error is None
+		:param timeout: Optional number of milliseconds after which
+		    *reply_handler* is called even if some replies are missing.
+		    Those queries get a :class:`TimeoutError` as error
+		"""
+		self._check_list_or_tuple(queries)
+		if not callable(reply_handler):
+			raise TypeError(
+				"Reply handler not callable, found %s" % reply_handler)
+		
+		results = [None] * len(queries)
+		errors = [None] * len(queries)
+		pending = set(range(len(queries)))
+		state = {"done": False, "timeout": None}
+		
+		def deliver():
+			reply_handler(results, errors)
+			return False
+		
+		def finish():
+			if state["done"]:
+				return
+			state["done"] = True
+			if state["timeout"] is not None:
+				GLib.source_remove(state["timeout"])
+			# Always reply from the main loop, even if every query failed
+			# before it was sent
+			GLib.idle_add(deliver)
+		
+		def complete(index, result=None, error=None):
+			if state["done"] or index not in pending:
+				return
+			pending.discard(index)
+			results[index] = result
+			errors[index] = error
+			if not pending:
+				finish()
+		
+		def on_timeout():
+			state["timeout"] = None
+			for index in pending:
+				errors[index] = TimeoutError(
+					"No reply to %s after %d ms" % (queries[index][0], timeout))
+			pending.clear()
+			finish()
+			return False
+		
+		for index, query in enumerate(queries):
+			method_name, args = query[0], query[1]
+			kwargs = dict(query[2]) if len(query) > 2 else {}
+			try:
+				if method_name.startswith("_"):
+					raise AttributeError("%s isn't a query method" % method_name)
+				method = getattr(self, method_name)
+				kwargs[self._get_reply_handler_name(method)] = \
+					lambda *reply, index=index: complete(index,
+						reply[0] if reply else None)
+				kwargs["error_handler"] = \
+					lambda error, index=index: complete(index, error=error)
+				method(*args, **kwargs)
+			except Exception as e:
+				complete(index, error=e)
+		
+		if not queries:
+			finish()
+		elif pending and timeout is not None:
+			state["timeout"] = GLib.timeout_add(timeout, on_timeout)
+	
+	@staticmethod
+	def _get_reply_handler_name(method):
+		for name in inspect.signature(method).parameters:
+			if name.endswith("reply_handler"):
+				return name
+		raise TypeError("%s doesn't take a reply handler" % method.__name__)
 	
 	def delete_events(self, event_ids, reply_handler=None, error_handler=None):
 		"""
@@ -888,7 +2125,8 @@ class ZeitgeistClient(object):
 		                                  error_handler=error_handler)
 	
 	def install_monitor (self, time_range, event_templates,
-		notify_insert_handler, notify_delete_handler, monitor_path=None):
+		notify_insert_handler, notify_delete_handler, monitor_path=None,
+		coalesce_latency=None):
 		"""
 		Install a monitor in the Zeitgeist engine that calls back
 		when events matching *event_templates* are logged. The matching
@@ -925,9 +2163,14 @@ class ZeitgeistClient(object):
 		    to install the client side monitor object on. If none is provided
 		    the client will provide one for you namespaced under
 		    /org/gnome/zeitgeist/monitor/*
+		:param coalesce_latency: Optional number of milliseconds during
+		    which notifications are merged before being delivered as one
+		    callback. See :class:`Monitor`. Monitors using this are never
+		    multiplexed
 		:returns: a :class:`Monitor`
 		"""
 		self._check_list_or_tuple(event_templates)
+		event_templates = self._as_events(event_templates)
 		self._check_members(event_templates, Event)
 		if not callable(notify_insert_handler):
 			raise TypeError("notify_insert_handler not callable, found %s" % \
@@ -937,10 +2180,14 @@ class ZeitgeistClient(object):
 			raise TypeError("notify_delete_handler not callable, found %s" % \
 				notify_reply_handler)
 		
+		if self._monitor_multiplexer is not None and monitor_path is None \
+			and not coalesce_latency:
+			return self._monitor_multiplexer.add(time_range, event_templates,
+				notify_insert_handler, notify_delete_handler)
 		
 		mon = Monitor(time_range, event_templates, notify_insert_handler,
 			notify_delete_handler, monitor_path=monitor_path,
-			event_type=self._event_type)
+			event_type=self._event_type, coalesce_latency=coalesce_latency)
 		self._iface.InstallMonitor(mon.path,
 		                           mon.time_range,
 		                           mon.templates,
@@ -960,10 +2207,17 @@ class ZeitgeistClient(object):
 		:param monitor_removed_handler: A callback function taking
 		    one integer argument. 1 on success, 0 on failure.
 		"""
+		if isinstance(monitor, _LocalMonitor):
+			monitor._multiplexer.remove(monitor)
+			if callable(monitor_removed_handler):
+				GLib.idle_add(lambda: monitor_removed_handler(1) and False)
+			return
+		
 		if isinstance(monitor, str):
 			path = dbus.ObjectPath(monitor)
 		elif isinstance(monitor, Monitor):
 			path = monitor.path
+			monitor._discard_pending()
 		else:
 			raise TypeError(
 				"Monitor, str, or unicode expected. Found %s" % type(monitor))
@@ -1064,11 +2318,32 @@ class ZeitgeistClient(object):
 	
 	def _check_list_or_tuple(self, collection):
 		"""
-		Raise a ValueError unless 'collection' is a list or tuple
+		Raise a ValueError unless 'collection' is a list or tuple (or
+		a :class:`LazyEventList`)
 		"""
-		if not (isinstance(collection, list) or isinstance(collection, tuple)):
+		if not isinstance(collection, (list, tuple, LazyEventList)):
 			raise TypeError("Expected list or tuple, found %s" % type(collection))
 	
+	def _event_for_struct(self, struct):
+		"""
+		Create an event from a raw event struct received over D-Bus,
+		interning its repetitive fields. Returns None for `NULL_EVENT`.
+		"""
+		return self._event_type.new_for_struct(
+			_string_interner.intern_event_struct(struct))
+	
+	def _as_events(self, events):
+		"""
+		Return 'events' with any :class:`EventRecord` in it converted to
+		an :class:`Event`, which can be sent over DBus
+		"""
+		if isinstance(events, LazyEventList):
+			events = list(events)
+		if any(isinstance(event, EventRecord) for event in events):
+			return [event.to_event() if isinstance(event, EventRecord)
+				else event for event in events]
+		return events
+	
 	def _check_members (self, collection, member_class):
 		"""
 		Raise a ValueError unless all of the members of 'collection'
@@ -1100,4 +2375,205 @@ class ZeitgeistClient(object):
 _FIND_EVENTS_FOR_TEMPLATES_ARGS = inspect.getargspec(
 	ZeitgeistClient.find_events_for_templates)[0]
 
+class AsyncZeitgeistClient(object):
+	"""
+	Variant of :class:`ZeitgeistClient` for code running on an :mod:`asyncio`
+	event loop. Instead of taking reply and error handlers, all query
+	methods are coroutines returning the result of the D-Bus call or
+	raising the :class:`dbus.exceptions.DBusException` sent by the engine.
+
+	Calls are sent asynchronously and don't wait for each other, so it is
+	fine to have hundreds of them in flight at the same time (eg. by using
+	:func:`asyncio.gather`). If the connection to Zeitgeist was lost they
+	are retried once after reconnecting, exactly like with
+	:class:`ZeitgeistClient`.
+
+	Replies are delivered by dbus-python from the GLib main context, so
+	either the asyncio loop must be backed by GLib (eg. PyGObject's
+	GLibEventLoopPolicy) or a GLib mainloop must be running on another
+	thread. In the latter case results are handed over to the asyncio
+	loop in a thread-safe manner.
+	"""
+
+	_event_type = Event
+
+	def __init__(self, loop=None):
+		self._iface = ZeitgeistDBusInterface()
+		self._loop = loop
+
+	register_event_subclass = ZeitgeistClient.register_event_subclass
+	register_subject_subclass = ZeitgeistClient.register_subject_subclass
+	_check_list_or_tuple = ZeitgeistClient._check_list_or_tuple
+	_check_members = ZeitgeistClient._check_members
+	_as_events = ZeitgeistClient._as_events
+	_event_for_struct = ZeitgeistClient._event_for_struct
+
+	def _call(self, method_name, *args):
+		"""
+		Start the asynchronous D-Bus call `method_name` and return an
+		:class:`asyncio.Future` which will receive its result.
+		"""
+		loop = self._loop or asyncio.get_event_loop()
+		future = loop.create_future()
+
+		def set_result(value):
+			if not future.done():
+				future.set_result(value)
+
+		def set_exception(error):
+			if not future.done():
+				future.set_exception(error)
+
+		def reply_handler(*reply):
+			# D-Bus methods may return no value, one value or several values
+			if len(reply) == 1:
+				reply = reply[0]
+			elif not reply:
+				reply = None
+			loop.call_soon_threadsafe(set_result, reply)
+
+		def error_handler(error):
+			loop.call_soon_threadsafe(set_exception, error)
+
+		getattr(self._iface, method_name)(*args,
+			reply_handler=reply_handler, error_handler=error_handler)
+		return future
+
+	def _events_from_reply(self, raw):
+		return LazyEventList(self._event_for_struct, raw)
+
+	# Properties
+
+	def get_version(self):
+		return [int(i) for i in self._iface.version()]
+
+	def get_extensions(self):
+		return [str(i) for i in self._iface.extensions()]
+
+	# Methods
+
+	async def insert_events(self, events):
+		"""
+		Send a collection of events to the Zeitgeist event log and return
+		the list of ids assigned to them. See
+		:meth:`ZeitgeistClient.insert_events`.
+		"""
+		self._check_list_or_tuple(events)
+		events = self._as_events(events)
+		self._check_members(events, Event)
+		return await self._call("InsertEvents", events)
+
+	async def find_event_ids_for_templates(self,
+					event_templates,
+					timerange = None,
+					storage_state = StorageState.Any,
+					num_events = 20,
+					result_type = ResultType.MostRecentEvents):
+		"""
+		Return the ids of the events matching any of `event_templates`.
+		The arguments have the same meaning as in
+		:meth:`ZeitgeistClient.find_event_ids_for_templates`.
+		"""
+		self._check_list_or_tuple(event_templates)
+		event_templates = self._as_events(event_templates)
+		self._check_members(event_templates, Event)
+		if timerange is None:
+			timerange = TimeRange.until_now()
+		return await self._call("FindEventIds", timerange, event_templates,
+			storage_state, num_events, result_type)
+
+	async def find_events_for_templates(self,
+					event_templates,
+					timerange = None,
+					storage_state = StorageState.Any,
+					num_events = 20,
+					result_type = ResultType.MostRecentEvents):
+		"""
+		Return a list of the :class:`Events <zeitgeist.datamodel.Event>`
+		matching any of `event_templates`. The arguments have the same
+		meaning as in :meth:`ZeitgeistClient.find_events_for_templates`.
+		"""
+		self._check_list_or_tuple(event_templates)
+		event_templates = self._as_events(event_templates)
+		self._check_members(event_templates, Event)
+		if timerange is None:
+			timerange = TimeRange.until_now()
+		raw = await self._call("FindEvents", timerange, event_templates,
+			storage_state, num_events, result_type)
+		return self._events_from_reply(raw)
+
+	async def get_events(self, event_ids):
+		"""
+		Return the :class:`Events <zeitgeist.datamodel.Event>` with the
+		given ids, in the same order. Events which aren't found in the
+		log are represented by `None`.
+		"""
+		raw = await self._call("GetEvents", event_ids)
+		return self._events_from_reply(raw)
+
+	async def iter_events(self,
+					event_templates,
+					timerange = None,
+					storage_state = StorageState.Any,
+					num_events = 0,
+					result_type = ResultType.MostRecentEvents,
+					page_size = 100):
+		"""
+		Asynchronous iterator over all the events matching
+		*event_templates*, fetched in pages of *page_size* events with
+		the next page always being prefetched. To be used with
+		``async for``. See :meth:`ZeitgeistClient.iter_events`.
+		"""
+		if page_size < 1:
+			raise ValueError("page_size must be a positive number")
+		event_ids = await self.find_event_ids_for_templates(event_templates,
+			timerange, storage_state, num_events, result_type)
+		pending = None
+		if event_ids:
+			pending = self._call("GetEvents", event_ids[:page_size])
+		try:
+			for offset in range(0, len(event_ids), page_size):
+				request = pending
+				next_offset = offset + page_size
+				if next_offset < len(event_ids):
+					# Prefetch the next page while this one is consumed
+					pending = self._call("GetEvents",
+						event_ids[next_offset:next_offset + page_size])
+				else:
+					pending = None
+				for struct in await request:
+					event = self._event_for_struct(struct)
+					if event is not None:
+						yield event
+		finally:
+			if pending is not None:
+				pending.cancel()
+
+	async def delete_events(self, event_ids):
+		"""
+		Warning: This API is EXPERIMENTAL and is not fully supported yet.
+
+		Delete the events with the given ids from the log. Returns the
+		time range covered by the deleted events, as given by the engine.
+		"""
+		self._check_list_or_tuple(event_ids)
+		self._check_members(event_ids, (int, dbus.UInt32))
+		return await self._call("DeleteEvents", event_ids)
+
+	async def find_related_uris_for_events(self, event_templates,
+		time_range=None, result_event_templates=[],
+		storage_state=StorageState.Any, num_events=10, result_type=0):
+		"""
+		Warning: This API is EXPERIMENTAL and is not fully supported yet.
+
+		Return a list of URIs of subjects which frequently occur together
+		with events matching `event_templates`. See
+		:meth:`ZeitgeistClient.find_related_uris_for_events`.
+		"""
+		if time_range is None:
+			time_range = TimeRange.until_now()
+		return await self._call("FindRelatedUris", time_range,
+			event_templates, result_event_templates, storage_state,
+			num_events, result_type)
+
 # vim:noexpandtab:ts=4:sw=4
@@ -23,9 +23,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os.path
+import array
+import bisect
+import collections
+import contextlib
+import functools
+import gc
 import gettext
+import heapq
+import itertools
+import marshal
+import mmap
+import operator
 import time
 import sys
+from struct import Struct
 gettext.install("zeitgeist")
 
 __all__ = [
@@ -35,9 +47,15 @@ __all__ = [
     'RelevantResultType',
 	'StorageState',
 	'TimeRange',
+	'TimeRangeSet',
 	'DataSource',
 	'Event',
 	'Subject',
+	'EventRecord',
+	'SubjectRecord',
+	'EventFactory',
+	'TemplateMatcher',
+	'EventBatch',
 	'NULL_EVENT',
 	'NEGATION_OPERATOR',
 ]
@@ -78,7 +96,72 @@ def get_name_or_str(obj):
 	except AttributeError:
 		return str(obj)
 
-_SYMBOLS_BY_URI = {}
+class _SymbolRegistry(dict):
+	"""
+	Dictionary with all Symbols by URI. When the ontology is loaded from
+	the precomputed cache, each Symbol is only created when it's first
+	looked up. Membership tests, get() and enumerating the registry
+	see those symbols too, creating them as needed.
+	"""
+	
+	def _resolve_pending(self):
+		for uri in list(_PENDING_SYMBOLS):
+			self[uri]
+	
+	def __contains__(self, uri):
+		return dict.__contains__(self, uri) or uri in _PENDING_SYMBOLS
+	
+	def __len__(self):
+		return dict.__len__(self) + len(_PENDING_SYMBOLS)
+	
+	def get(self, uri, default=None):
+		try:
+			return self[uri]
+		except KeyError:
+			return default
+	
+	def __iter__(self):
+		self._resolve_pending()
+		return dict.__iter__(self)
+	
+	def keys(self):
+		self._resolve_pending()
+		return dict.keys(self)
+	
+	def values(self):
+		self._resolve_pending()
+		return dict.values(self)
+	
+	def items(self):
+		self._resolve_pending()
+		return dict.items(self)
+	
+	def __missing__(self, uri):
+		try:
+			name, display_name, doc, parents, children = \
+				_PENDING_SYMBOLS.pop(uri)
+		except (KeyError, TypeError):
+			raise KeyError(uri)
+		symbol = Symbol(name, parent=set(parents), uri=uri,
+			display_name=display_name, doc=doc)
+		symbol._parents = dict.fromkeys(parents)
+		symbol._children = dict.fromkeys(children)
+		return symbol
+
+_SYMBOLS_BY_URI = _SymbolRegistry()
+
+# URI -> (name, display_name, doc, parent URIs, child URIs) of the symbols
+# from the ontology cache which haven't been created yet
+_PENDING_SYMBOLS = {}
+
+# URI of each symbol -> frozenset with the URIs of the symbol itself and
+# all its ancestors (or descendants). Filled in by _index_symbols, or
+# from the ontology cache.
+_ANCESTOR_URIS = {}
+_DESCENDANT_URIS = {}
+
+# Symbol name -> list of URIs of the symbols with that name
+_URIS_BY_NAME = {}
 
 class Symbol(str):
 
@@ -89,7 +172,6 @@ class Symbol(str):
 		
 	def __init__(self, name, parent=None, uri=None, display_name=None, doc=None, auto_resolve=True):
 		self._children = dict()
-		self._all_children = None
 		self._parents = parent or set() # will be bootstrapped to a dict at module load time
 		assert isinstance(self._parents, set), name
 		self._name = name
@@ -102,32 +184,19 @@ class Symbol(str):
 		return "<%s '%s'>" %(get_name_or_str(self), self.uri)
 		
 	def __getattr__(self, name):
-		self._ensure_all_children()
-		try:
-			return self._all_children[name]
-		except KeyError:
-			for child in self.iter_all_children():
-				if child == self:
-					continue
-				try:
-					return getattr(child, name)
-				except AttributeError:
-					pass
-			raise AttributeError("'%s' object has no attribute '%s'" %(self.__class__.__name__, name))
+		if not name.startswith("_"):
+			descendants = _DESCENDANT_URIS.get(self.uri, ())
+			for uri in _URIS_BY_NAME.get(name, ()):
+				if uri in descendants and uri != self.uri:
+					return _SYMBOLS_BY_URI[uri]
+		raise AttributeError("'%s' object has no attribute '%s'" %(self.__class__.__name__, name))
 	
 	def __getitem__ (self, uri):
 		return _SYMBOLS_BY_URI[uri]
 
-	def _ensure_all_children (self):
-		if self._all_children is not None : return
-		self._all_children = dict()
-		for child in list(self._children.values()):
-			child._visit(self._all_children)
-	
-	def _visit (self, dikt):
-		dikt[self.name] = self
-		for child in list(self._children.values()):
-			child._visit(dikt) 
+	def _iter_descendant_uris (self):
+		return (uri for uri in _DESCENDANT_URIS.get(self.uri, ())
+			if uri != self.uri)
 	
 	@staticmethod
 	def find_child_uris_extended (uri):
@@ -136,13 +205,7 @@ class Symbol(str):
 		`uri` itself in the list. Hence the "extended". If `uri`
 		is unknown a list containing only `uri` is returned.
 		"""
-		try:
-			symbol = _SYMBOLS_BY_URI[uri]
-			children = list(symbol.get_all_children())
-			children.append(uri)
-			return children
-		except KeyError as e:
-			return [uri]
+		return list(_DESCENDANT_URIS.get(uri, (uri,)))
 		
 
 	@property
@@ -159,8 +222,8 @@ class Symbol(str):
 	__name__ = name
 	
 	def __dir__(self):
-		self._ensure_all_children()
-		return list(self._all_children.keys())
+		return [_SYMBOLS_BY_URI[uri].name
+			for uri in self._iter_descendant_uris()]
 
 	@property
 	def doc(self):
@@ -174,15 +237,15 @@ class Symbol(str):
 		"""
 		Returns a list of immediate child symbols
 		"""
-		return frozenset(iter(list(self._children.values())))
+		return frozenset(_SYMBOLS_BY_URI[uri] for uri in self._children)
 		
 	def iter_all_children(self):
 		"""
 		Returns a generator that recursively iterates over all children
 		of this symbol
 		"""
-		self._ensure_all_children()
-		return iter(list(self._all_children.values()))
+		return iter([_SYMBOLS_BY_URI[uri]
+			for uri in self._iter_descendant_uris()])
 		
 	def get_all_children(self):
 		"""
@@ -194,27 +257,18 @@ class Symbol(str):
 		"""
 		Returns a list of immediate parent symbols
 		"""
-		return frozenset(iter(list(self._parents.values())))
+		return frozenset(_SYMBOLS_BY_URI[uri] for uri in self._parents)
 	
 	def is_child_of (self, parent):
 		"""
 		Returns True if this symbol is a child of `parent`.
 		"""
-		if not isinstance (parent, Symbol):
-			try:
-				parent = _SYMBOLS_BY_URI[parent]
-			except KeyError as e:
-				# Parent is not a known URI
-				return self.uri == parent
-		
-		# Invariant: parent is a Symbol
-		if self.uri == parent.uri : return True
-		
-		parent._ensure_all_children()
-		
-		# FIXME: We should really check that child.uri is in there,
-		#        but that is not fast with the current code layout
-		return self.name in parent._all_children
+		if isinstance(parent, Symbol):
+			parent = parent.uri
+		ancestors = _ANCESTOR_URIS.get(self.uri)
+		if ancestors is None:
+			return self.uri == parent
+		return parent in ancestors
 	
 	@staticmethod
 	def uri_is_child_of (child, parent):
@@ -223,22 +277,16 @@ class Symbol(str):
 		and `parent` arguments must be any combination of
 		:class:`Symbol` and/or string.
 		"""
-		if isinstance (child, str):
-			try:
-				child = _SYMBOLS_BY_URI[child]
-			except KeyError as e:
-				# Child is not a know URI
-				if isinstance (parent, str):
-					return child == parent
-				elif isinstance (parent, Symbol):
-					return child == parent.uri
-				else:
-					return False
-		
-		if not isinstance (child, Symbol):
+		if not isinstance (child, str):
 			raise ValueError("Child argument must be a Symbol or string. Got %s" % type(child))
 		
-		return child.is_child_of(parent)
+		# Symbols are strings holding their URI, so they can be looked up
+		# directly
+		ancestors = _ANCESTOR_URIS.get(child)
+		if ancestors is None:
+			# Child is not a known URI
+			return child == parent
+		return parent in ancestors
 		
 class TimeRange(list):
 	"""
@@ -359,6 +407,243 @@ class TimeRange(list):
 		return result
 
 
+class TimeRangeSet(object):
+	"""
+	A set of timestamps made up of any number of time ranges, supporting
+	unions, intersections and differences.
+	
+	The ranges are kept sorted, merged and in two arrays of 64 bit
+	integers, so that lookups and insertions only need a binary search.
+	Like with :class:`TimeRange`, both ends of every range are included
+	in the set. Iterating over the set yields :class:`TimeRange`
+	instances, which can be passed directly over D-Bus as (xx).
+	"""
+	
+	def __init__(self, time_ranges=()):
+		"""
+		Create a set covering `time_ranges`, which may contain
+		:class:`TimeRange` instances or any other (begin, end) pairs,
+		like the (xx) structs received over D-Bus.
+		"""
+		self._begins = array.array("q")
+		self._ends = array.array("q")
+		self._extend_sorted(sorted(
+			(int(time_range[0]), int(time_range[1]))
+			for time_range in time_ranges))
+	
+	@classmethod
+	def _new_for_sorted(cls, pairs):
+		self = cls()
+		self._extend_sorted(pairs)
+		return self
+	
+	def _extend_sorted(self, pairs):
+		"""
+		Append (begin, end) `pairs`, sorted by their beginning and not
+		starting before the last range in the set, merging them with
+		the ranges they overlap or are adjacent to.
+		"""
+		begins = self._begins
+		ends = self._ends
+		for begin, end in pairs:
+			if begin > end:
+				continue
+			if ends and begin <= ends[-1] + 1:
+				if end > ends[-1]:
+					ends[-1] = end
+			else:
+				begins.append(begin)
+				ends.append(end)
+	
+	def __iter__(self):
+		return map(TimeRange, self._begins, self._ends)
+	
+	def __len__(self):
+		return len(self._begins)
+	
+	def __bool__(self):
+		return len(self._begins) > 0
+	
+	def __eq__(self, other):
+		if not isinstance(other, TimeRangeSet):
+			return NotImplemented
+		return self._begins == other._begins and self._ends == other._ends
+	
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		return result if result is NotImplemented else not result
+	
+	def __repr__(self):
+		return "%s(%r)" % (self.__class__.__name__,
+			list(zip(self._begins, self._ends)))
+	
+	def __contains__(self, item):
+		"""
+		Check if a timestamp, or a whole time range, lies in the set
+		"""
+		if isinstance(item, (list, tuple)):
+			begin, end = int(item[0]), int(item[1])
+		else:
+			begin = end = int(item)
+		i = bisect.bisect_right(self._begins, begin) - 1
+		return i >= 0 and self._ends[i] >= end
+	
+	def overlaps(self, time_range):
+		"""
+		Check if any timestamp in `time_range` lies in the set
+		"""
+		begin, end = int(time_range[0]), int(time_range[1])
+		i = bisect.bisect_left(self._ends, begin)
+		return begin <= end and i < len(self._begins) \
+			and self._begins[i] <= end
+	
+	def span(self):
+		"""
+		Return the :class:`TimeRange` from the first to the last timestamp
+		in the set, or None if the set is empty
+		"""
+		if not self._begins:
+			return None
+		return TimeRange(self._begins[0], self._ends[-1])
+	
+	def copy(self):
+		result = self.__class__()
+		result._begins.extend(self._begins)
+		result._ends.extend(self._ends)
+		return result
+	
+	def add(self, time_range):
+		"""
+		Add all timestamps in `time_range` to the set
+		"""
+		begin, end = int(time_range[0]), int(time_range[1])
+		if begin > end:
+			return
+		# Ranges [i, j) overlap or are adjacent to the new one
+		i = bisect.bisect_left(self._ends, begin - 1)
+		j = bisect.bisect_right(self._begins, end + 1)
+		if i < j:
+			begin = min(begin, self._begins[i])
+			end = max(end, self._ends[j - 1])
+		self._begins[i:j] = array.array("q", (begin,))
+		self._ends[i:j] = array.array("q", (end,))
+	
+	def discard(self, time_range):
+		"""
+		Remove all timestamps in `time_range` from the set
+		"""
+		begin, end = int(time_range[0]), int(time_range[1])
+		if begin > end:
+			return
+		# Ranges [i, j) overlap the removed one
+		i = bisect.bisect_left(self._ends, begin)
+		j = bisect.bisect_right(self._begins, end)
+		if i >= j:
+			return
+		begins = array.array("q")
+		ends = array.array("q")
+		if self._begins[i] < begin:
+			begins.append(self._begins[i])
+			ends.append(begin - 1)
+		if self._ends[j - 1] > end:
+			begins.append(end + 1)
+			ends.append(self._ends[j - 1])
+		self._begins[i:j] = begins
+		self._ends[i:j] = ends
+	
+	def union(self, other):
+		"""
+		Return a new set with the timestamps in this set or in `other`,
+		which may be a :class:`TimeRangeSet` or a list of time ranges
+		"""
+		other = self._as_set(other)
+		return self._new_for_sorted(heapq.merge(
+			zip(self._begins, self._ends), zip(other._begins, other._ends)))
+	
+	def intersection(self, other):
+		"""
+		Return a new set with the timestamps both in this set and in
+		`other`, which may be a :class:`TimeRangeSet` or a list of time
+		ranges
+		"""
+		other = self._as_set(other)
+		result = self.__class__()
+		begins, ends = self._begins, self._ends
+		other_begins, other_ends = other._begins, other._ends
+		i = j = 0
+		while i < len(begins) and j < len(other_begins):
+			begin = max(begins[i], other_begins[j])
+			end = min(ends[i], other_ends[j])
+			if begin <= end:
+				result._begins.append(begin)
+				result._ends.append(end)
+			if ends[i] < other_ends[j]:
+				i += 1
+			else:
+				j += 1
+		return result
+	
+	def difference(self, other):
+		"""
+		Return a new set with the timestamps in this set which aren't in
+		`other`, which may be a :class:`TimeRangeSet` or a list of time
+		ranges
+		"""
+		other = self._as_set(other)
+		result = self.__class__()
+		other_begins, other_ends = other._begins, other._ends
+		j = 0
+		for begin, end in zip(self._begins, self._ends):
+			# Skip the ranges in other ending before this one
+			while j < len(other_begins) and other_ends[j] < begin:
+				j += 1
+			k = j
+			while k < len(other_begins) and other_begins[k] <= end:
+				if other_begins[k] > begin:
+					result._begins.append(begin)
+					result._ends.append(other_begins[k] - 1)
+				begin = other_ends[k] + 1
+				k += 1
+			if begin <= end:
+				result._begins.append(begin)
+				result._ends.append(end)
+		return result
+	
+	__or__ = union
+	__and__ = intersection
+	__sub__ = difference
+	
+	@classmethod
+	def _as_set(cls, time_ranges):
+		if isinstance(time_ranges, TimeRangeSet):
+			return time_ranges
+		return cls(time_ranges)
+	
+	def slices(self, timestamps):
+		"""
+		Return the list of slices of `timestamps`, a sequence of integer
+		timestamps sorted in ascending order, which lie in the set
+		"""
+		result = []
+		start = 0
+		for begin, end in zip(self._begins, self._ends):
+			start = bisect.bisect_left(timestamps, begin, start)
+			if start == len(timestamps):
+				break
+			stop = bisect.bisect_right(timestamps, end, start)
+			if stop > start:
+				result.append(slice(start, stop))
+			start = stop
+		return result
+	
+	def mask(self, timestamps):
+		"""
+		Return a bytearray with a 1 for each of the `timestamps`, in any
+		order, which lies in the set and a 0 for the rest
+		"""
+		return bytearray(map(self.__contains__, timestamps))
+
+
 class Subject(list):
 	"""
 	Represents a subject of an :class:`Event`. This class is both used to
@@ -885,6 +1170,1061 @@ class Event(list):
 		"""
 		t = int(self.timestamp) # The timestamp may be stored as a string
 		return (t >= time_range.begin) and (t <= time_range.end)
+	
+	@staticmethod
+	def dump_many(events, fileobj, block_size=65536):
+		"""
+		Write `events` to the binary file object `fileobj`, in the
+		compact format read by :meth:`load_many`.
+		
+		The events are written in blocks of `block_size` events, each
+		with the strings it introduces followed by fixed-width integer
+		records, so `events` may be any iterable (including None entries
+		for events which weren't found) and is never held in memory as a
+		whole.
+		"""
+		_write_event_dump(events, fileobj, block_size)
+	
+	@classmethod
+	def load_many(cls, fileobj, use_mmap=False):
+		"""
+		Return the list of events written to `fileobj` by
+		:meth:`dump_many`. All fields are restored exactly, except that
+		binary payloads are returned as `bytes`.
+		
+		If `use_mmap` is True `fileobj` must be a real file, which is
+		then memory-mapped instead of being read.
+		"""
+		events = []
+		with _gc_paused():
+			for block in _read_event_dump(fileobj, use_mmap, cls):
+				events.extend(block)
+		return events
+	
+	@classmethod
+	def iter_many(cls, fileobj, use_mmap=False):
+		"""
+		Like :meth:`load_many`, but yield the events one at a time
+		"""
+		return itertools.chain.from_iterable(
+			_read_event_dump(fileobj, use_mmap, cls))
+
+_DUMP_MAGIC = b"ZGEVDUMP"
+_DUMP_VERSION = 1
+_DUMP_HEADER = Struct("<8sI")
+# New strings, their size in bytes, events, subjects, payload size in bytes
+_DUMP_BLOCK_HEADER = Struct("<IIIII")
+(_DUMP_NULL_EVENT,
+	_DUMP_STRING_ID,
+	_DUMP_STRING_TIMESTAMP,
+	_DUMP_BINARY_PAYLOAD) = (1, 2, 4, 8)
+_DUMP_EVENT_FIELDS = (Event.Interpretation, Event.Manifestation, Event.Actor,
+	Event.Origin)
+
+_DUMP_NULL_STRUCT = (["0", "0", None, None, None, None], [], "")
+
+class _DumpStringTable(dict):
+	"""
+	Maps the strings written to an event dump to their index, collecting
+	the ones which haven't been written yet. Index 0 stands for None.
+	"""
+	
+	def __init__(self):
+		super(_DumpStringTable, self).__init__({None: 0})
+		self.new_strings = []
+	
+	def __missing__(self, value):
+		index = self[value] = len(self)
+		self.new_strings.append(str(value).encode("utf-8"))
+		return index
+
+def _dump_integers(values):
+	"""
+	Return an array with `values` converted to integers, and the
+	positions of the values which can't be restored exactly from one
+	"""
+	# Empty values (like the id of an event which hasn't been inserted)
+	# are common enough not to fall back to the slow path for them
+	filled = [value or "0" for value in values]
+	numbers = array.array("q")
+	try:
+		numbers.extend(map(int, filled))
+		if list(map(str, numbers)) == filled:
+			return numbers, list(itertools.compress(itertools.count(),
+				map(operator.not_, values)))
+	except (ValueError, TypeError, OverflowError):
+		pass
+	numbers = array.array("q")
+	irregular = []
+	for i, value in enumerate(values):
+		try:
+			number = int(value)
+			if str(number) == value:
+				numbers.append(number)
+				continue
+		except (ValueError, TypeError, OverflowError):
+			pass
+		numbers.append(0)
+		irregular.append(i)
+	return numbers, irregular
+
+def _write_dump_array(fileobj, values):
+	if sys.byteorder != "little":
+		values.byteswap()
+	fileobj.write(values.tobytes())
+
+def _write_event_dump(events, fileobj, block_size):
+	strings = _DumpStringTable()
+	fileobj.write(_DUMP_HEADER.pack(_DUMP_MAGIC, _DUMP_VERSION))
+	events = iter(events)
+	while True:
+		block = list(itertools.islice(events, block_size))
+		if not block:
+			break
+		_write_event_dump_block(block, strings, fileobj)
+
+def _write_event_dump_block(events, strings, fileobj):
+	strings.new_strings = []
+	index = strings.__getitem__
+	subject_width = len(Subject.Fields)
+	
+	flags = array.array("B", bytes(len(events)))
+	structs = []
+	payloads = []
+	for i, event in enumerate(events):
+		if event is None:
+			flags[i] = _DUMP_NULL_EVENT
+			event = _DUMP_NULL_STRUCT
+		structs.append(event)
+		payload = event[2] if len(event) > 2 else ""
+		if payload is None:
+			payload = ""
+		if isinstance(payload, str):
+			payloads.append(payload.encode("utf-8"))
+		else:
+			flags[i] |= _DUMP_BINARY_PAYLOAD
+			payloads.append(bytes(bytearray(payload)))
+	
+	data = [struct[0] for struct in structs]
+	columns = []
+	for field, string_flag in ((Event.Id, _DUMP_STRING_ID),
+			(Event.Timestamp, _DUMP_STRING_TIMESTAMP)):
+		values = list(map(operator.itemgetter(field), data))
+		numbers, irregular = _dump_integers(values)
+		for i in irregular:
+			numbers[i] = index(values[i])
+			flags[i] |= string_flag
+		columns.append(numbers)
+	metadata = array.array("I", map(index, itertools.chain.from_iterable(
+		map(operator.itemgetter(*_DUMP_EVENT_FIELDS), data))))
+	
+	subjects = [struct[1] for struct in structs]
+	subject_counts = array.array("I", map(len, subjects))
+	subjects = list(itertools.chain.from_iterable(subjects))
+	if set(map(len, subjects)) - set([subject_width]):
+		subjects = [subject if len(subject) == subject_width
+			else Subject(list(subject))[:subject_width]
+			for subject in subjects]
+	subject_fields = array.array("I",
+		map(index, itertools.chain.from_iterable(subjects)))
+	payload_lengths = array.array("I", map(len, payloads))
+	
+	new_strings = strings.new_strings
+	string_data = b"".join(new_strings)
+	payload_data = b"".join(payloads)
+	fileobj.write(_DUMP_BLOCK_HEADER.pack(len(new_strings), len(string_data),
+		len(events), len(subjects), len(payload_data)))
+	_write_dump_array(fileobj, array.array("I", map(len, new_strings)))
+	fileobj.write(string_data)
+	for values in [flags] + columns + [metadata, subject_counts,
+			payload_lengths, subject_fields]:
+		_write_dump_array(fileobj, values)
+	fileobj.write(payload_data)
+
+def _read_dump_bytes(read, size):
+	data = read(size)
+	if len(data) != size:
+		raise ValueError("Truncated event dump")
+	return data
+
+def _read_dump_array(read, typecode, count):
+	values = array.array(typecode)
+	values.frombytes(_read_dump_bytes(read, values.itemsize * count))
+	if sys.byteorder != "little":
+		values.byteswap()
+	return values
+
+def _read_event_dump(fileobj, use_mmap, event_type):
+	"""
+	Yield a list with the events (of `event_type`) in each block of the
+	dump in `fileobj`
+	"""
+	if use_mmap:
+		source = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+		read = source.read
+	else:
+		source = None
+		read = fileobj.read
+	try:
+		header = read(_DUMP_HEADER.size)
+		if len(header) != _DUMP_HEADER.size \
+				or header[:len(_DUMP_MAGIC)] != _DUMP_MAGIC:
+			raise ValueError("Not an event dump")
+		version = _DUMP_HEADER.unpack(header)[1]
+		if version != _DUMP_VERSION:
+			raise ValueError("Unsupported event dump version %s" % version)
+		strings = [None]
+		while True:
+			header = read(_DUMP_BLOCK_HEADER.size)
+			if not header:
+				break
+			yield _read_event_dump_block(read, header, strings, event_type)
+	finally:
+		if source is not None:
+			source.close()
+
+def _slices(lengths):
+	"""Return the consecutive slices with the given `lengths`"""
+	ends = list(itertools.accumulate(lengths))
+	return list(map(slice, [0] + ends[:-1], ends))
+
+@contextlib.contextmanager
+def _gc_paused():
+	"""
+	Disable the cyclic garbage collector while creating large numbers of
+	acyclic containers, which would otherwise trigger it over and over
+	"""
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		yield
+	finally:
+		if enabled:
+			gc.enable()
+
+def _read_event_dump_block(read, header, strings, event_type):
+	if len(header) != _DUMP_BLOCK_HEADER.size:
+		raise ValueError("Truncated event dump")
+	(string_count, string_size, event_count, subject_count,
+		payload_size) = _DUMP_BLOCK_HEADER.unpack(header)
+	string_lengths = _read_dump_array(read, "I", string_count)
+	string_data = _read_dump_bytes(read, string_size)
+	strings.extend(string_data[part].decode("utf-8")
+		for part in _slices(string_lengths))
+	
+	subject_width = len(Subject.Fields)
+	flags = _read_dump_array(read, "B", event_count)
+	ids = _read_dump_array(read, "q", event_count)
+	timestamps = _read_dump_array(read, "q", event_count)
+	metadata = _read_dump_array(read, "I", 4 * event_count)
+	subject_counts = _read_dump_array(read, "I", event_count)
+	payload_lengths = _read_dump_array(read, "I", event_count)
+	subject_fields = _read_dump_array(read, "I", subject_width * subject_count)
+	payload_data = _read_dump_bytes(read, payload_size)
+	
+	ids = list(map(str, ids))
+	timestamps = list(map(str, timestamps))
+	marked = list(itertools.compress(itertools.count(), map(
+		(_DUMP_NULL_EVENT | _DUMP_STRING_ID | _DUMP_STRING_TIMESTAMP).__and__,
+		flags)))
+	for i in marked:
+		if flags[i] & _DUMP_STRING_ID:
+			ids[i] = strings[int(ids[i])]
+		if flags[i] & _DUMP_STRING_TIMESTAMP:
+			timestamps[i] = strings[int(timestamps[i])]
+	
+	# The dump only holds complete events, so like in EventFactory the
+	# instances are filled in directly instead of going through their
+	# constructors, all without running any Python code per event
+	new = list.__new__
+	fill = list.extend
+	with _gc_paused():
+		values = map(strings.__getitem__, metadata)
+		data = list(map(list,
+			zip(ids, timestamps, values, values, values, values)))
+		subjects = list(map(new,
+			itertools.repeat(event_type._subject_type, subject_count)))
+		values = map(strings.__getitem__, subject_fields)
+		collections.deque(map(fill, subjects,
+			zip(*[values] * subject_width)), 0)
+		subjects = list(map(subjects.__getitem__, _slices(subject_counts)))
+		payloads = list(map(payload_data.__getitem__,
+			_slices(payload_lengths)))
+		if any(flag & _DUMP_BINARY_PAYLOAD for flag in flags):
+			payloads = [payload if flag & _DUMP_BINARY_PAYLOAD
+				else payload.decode("utf-8")
+				for payload, flag in zip(payloads, flags)]
+		else:
+			payloads = list(map(bytes.decode, payloads))
+		events = list(map(new, itertools.repeat(event_type, event_count)))
+		collections.deque(map(fill, events,
+			zip(data, subjects, payloads)), 0)
+	for i in marked:
+		if flags[i] & _DUMP_NULL_EVENT:
+			events[i] = None
+	return events
+
+class EventFactory(object):
+	"""
+	Builds :class:`Event` instances from rows of values with a fixed
+	layout, several times faster than :meth:`Event.new_for_values`.
+	
+	The layout is given once, as the names of the columns of the rows,
+	which are the keywords of :meth:`Event.new_for_values` plus
+	"payload". If any of the *subject_** keywords is used, each event
+	gets a subject built from those columns. For example::
+	
+	  factory = EventFactory(("timestamp", "interpretation", "actor",
+	      "subject_uri", "subject_mimetype"))
+	  events = factory.new_events(rows)
+	
+	Additional subjects can be given to :meth:`new_event` as rows laid
+	out as `subject_fields`, whose names are the keywords of
+	:meth:`Subject.new_for_values`.
+	"""
+	
+	EVENT_KEYS = {
+		"timestamp": Event.Timestamp,
+		"interpretation": Event.Interpretation,
+		"manifestation": Event.Manifestation,
+		"actor": Event.Actor,
+		"origin": Event.Origin,
+	}
+	
+	SUBJECT_KEYS = {
+		"uri": Subject.Uri,
+		"current_uri": Subject.CurrentUri,
+		"interpretation": Subject.Interpretation,
+		"manifestation": Subject.Manifestation,
+		"origin": Subject.Origin,
+		"current_origin": Subject.CurrentOrigin,
+		"mimetype": Subject.Mimetype,
+		"text": Subject.Text,
+		"storage": Subject.Storage,
+	}
+	
+	def __init__(self, fields, subject_fields=(), event_type=Event):
+		self._event_type = event_type
+		self._subject_type = event_type._subject_type
+		fields = tuple(fields)
+		subject_fields = tuple(subject_fields)
+		
+		# Missing fields are read from an empty string appended to rows
+		empty = len(fields)
+		event_columns = [empty] * len(Event.Fields)
+		subject_columns = [empty] * len(Subject.Fields)
+		payload_column = empty
+		has_subject = False
+		for column, name in enumerate(fields):
+			if name == "payload":
+				payload_column = column
+			elif name in self.EVENT_KEYS:
+				event_columns[self.EVENT_KEYS[name]] = column
+			elif name.startswith("subject_") \
+					and name[len("subject_"):] in self.SUBJECT_KEYS:
+				subject_columns[self.SUBJECT_KEYS[name[len("subject_"):]]] = \
+					column
+				has_subject = True
+			else:
+				raise ValueError("Event parameter '%s' is not supported" % name)
+		
+		extra_columns = [len(subject_fields)] * len(Subject.Fields)
+		for column, name in enumerate(subject_fields):
+			if name not in self.SUBJECT_KEYS:
+				raise ValueError("Subject parameter '%s' is not supported" % name)
+			extra_columns[self.SUBJECT_KEYS[name]] = column
+		
+		self._width = len(fields)
+		self._subject_width = len(subject_fields)
+		self._has_timestamp = "timestamp" in fields
+		self._get_event_data = operator.itemgetter(*event_columns)
+		self._get_subject = operator.itemgetter(*subject_columns) \
+			if has_subject else None
+		self._get_payload = operator.itemgetter(payload_column)
+		self._get_extra_subject = operator.itemgetter(*extra_columns)
+	
+	def _check_row(self, row, width):
+		if len(row) != width:
+			raise ValueError("Expected a row with %s values, found %s" \
+				% (width, len(row)))
+	
+	def new_event(self, row, subjects=()):
+		"""
+		Return a new event with the values in `row`, and with a subject
+		for each of the rows in `subjects`
+		"""
+		event = self._new_events((row,))[0]
+		if subjects:
+			subject_type = self._subject_type
+			get_subject = self._get_extra_subject
+			for values in subjects:
+				self._check_row(values, self._subject_width)
+				subject = list.__new__(subject_type)
+				subject.extend(get_subject(tuple(values) + ("",)))
+				event[1].append(subject)
+		return event
+	
+	def new_events(self, rows):
+		"""
+		Return a list with a new event for each row in the iterable
+		`rows`
+		"""
+		with _gc_paused():
+			return self._new_events(rows)
+	
+	def _new_events(self, rows):
+		# The layout guarantees complete events, so the instances are
+		# filled in directly instead of going through their constructors
+		new = list.__new__
+		extend = list.extend
+		event_type = self._event_type
+		subject_type = self._subject_type
+		get_event_data = self._get_event_data
+		get_subject = self._get_subject
+		get_payload = self._get_payload
+		has_timestamp = self._has_timestamp
+		width = self._width
+		events = []
+		for row in rows:
+			values = tuple(row) + ("",)
+			if len(values) != width + 1:
+				self._check_row(row, width)
+			data = list(get_event_data(values))
+			data[Event.Timestamp] = str(data[Event.Timestamp]) if has_timestamp \
+				else str(get_timestamp_for_now())
+			if get_subject:
+				subject = new(subject_type)
+				extend(subject, get_subject(values))
+				subjects = [subject]
+			else:
+				subjects = []
+			event = new(event_type)
+			extend(event, (data, subjects, get_payload(values)))
+			events.append(event)
+		return events
+
+
+class TemplateMatcher(object):
+	"""
+	Matcher for a list of event templates, which matches events exactly
+	like :meth:`Event.matches_template` does but much faster.
+	
+	:meth:`compile` does the work which :meth:`Event.matches_template`
+	repeats for every event: it looks for negations and wildcards in the
+	template fields, picks the comparison to use and finds all children
+	of the interpretations and manifestations. What is left for
+	:meth:`match` is looking up the event fields in sets and comparing
+	strings.
+	
+	An event matches if it matches any of the templates, or if there are
+	no templates at all, like in the queries done by the Zeitgeist engine.
+	"""
+	
+	def __init__(self, predicates):
+		"""
+		Use :meth:`compile` instead of creating instances directly.
+		"""
+		self._predicates = predicates
+	
+	@classmethod
+	def compile(cls, event_templates):
+		"""
+		Return a new :class:`TemplateMatcher` for `event_templates`, a
+		list of :class:`Event` (or :class:`EventRecord`) templates
+		"""
+		return cls([cls._compile_event_template(template)
+			for template in event_templates])
+	
+	def match(self, event):
+		"""
+		Return True if `event` matches any of the templates
+		"""
+		if not self._predicates:
+			return True
+		for predicate in self._predicates:
+			if predicate(event):
+				return True
+		return False
+	
+	def filter(self, events):
+		"""
+		Return a list with the events from `events` matching any of the
+		templates
+		"""
+		if not self._predicates:
+			return list(events)
+		predicates = self._predicates
+		return [event for event in events
+			if any(predicate(event) for predicate in predicates)]
+	
+	@classmethod
+	def _compile_event_template(cls, template):
+		data = template[0]
+		checks = []
+		for field in Event.Fields:
+			if field == Event.Timestamp or not data[field]:
+				# matching by timestamp is not supported and empty
+				# template fields are treated as wildcards
+				continue
+			checks.append((field, cls._compile_expression(data[field],
+				field in (Event.Interpretation, Event.Manifestation),
+				field in Event.SUPPORTS_NEGATION,
+				field in Event.SUPPORTS_WILDCARDS)))
+		subject_checks = [cls._compile_subject_template(subject)
+			for subject in template[1]]
+		checks = tuple(checks)
+		
+		if not subject_checks:
+			def predicate(event):
+				data = event[0]
+				for field, check in checks:
+					if not check(data[field]):
+						return False
+				return True
+			return predicate
+		
+		def predicate(event):
+			data = event[0]
+			for field, check in checks:
+				if not check(data[field]):
+					return False
+			for subject_template in subject_checks:
+				for subject in event[1]:
+					for field, check in subject_template:
+						if not check(subject[field]):
+							break
+					else:
+						return True
+			return False
+		return predicate
+	
+	@classmethod
+	def _compile_subject_template(cls, template):
+		checks = []
+		for field in Subject.Fields:
+			if not template[field]:
+				# empty fields are handled as wildcards
+				continue
+			if field == Subject.Storage:
+				# see Subject.matches_template
+				raise ValueError("zeitgeist does not support searching by 'storage' field")
+			checks.append((field, cls._compile_expression(template[field],
+				field in (Subject.Interpretation, Subject.Manifestation),
+				field in Subject.SUPPORTS_NEGATION,
+				field in Subject.SUPPORTS_WILDCARDS)))
+		return tuple(checks)
+	
+	@classmethod
+	def _compile_expression(cls, expression, is_symbol, supports_negation,
+		supports_wildcards):
+		"""
+		Return a function checking a field value against `expression`,
+		resolving operators the same way as Event._check_field_match
+		"""
+		if supports_negation and expression.startswith(NEGATION_OPERATOR):
+			check = cls._compile_expression(
+				expression[len(NEGATION_OPERATOR):], is_symbol,
+				supports_negation, supports_wildcards)
+			return lambda value: not check(value)
+		if is_symbol:
+			return cls._get_symbol_uris(expression).__contains__
+		if supports_wildcards and expression.endswith(WILDCARD):
+			prefix = str(expression[:-len(WILDCARD)])
+			return lambda value: value.startswith(prefix)
+		return functools.partial(operator.eq, str(expression))
+	
+	@staticmethod
+	def _get_symbol_uris(uri):
+		"""
+		Return a set with `uri` and the URIs of all its children, ie.
+		the values for which Symbol.uri_is_child_of(value, uri) is True
+		"""
+		return _DESCENDANT_URIS.get(uri, frozenset([str(uri)]))
+
+def _intern(value):
+	# D-Bus strings are str subclasses, which can't be interned
+	return sys.intern(str(value))
+
+class SubjectRecord(object):
+	"""
+	Compact, read-mostly alternative to :class:`Subject`, for programs
+	keeping lots of events in memory. The fields are attributes with the
+	same names as the properties of :class:`Subject`; interpretations,
+	manifestations, mime-types and storage ids are interned, so all the
+	records share a single copy of each.
+	
+	Records can be indexed with the :attr:`Subject.Fields` positions,
+	so they can be used as templates, and converted losslessly from and
+	to subject structs with :meth:`new_for_struct` and :meth:`to_struct`.
+	"""
+	
+	__slots__ = ("uri", "interpretation", "manifestation", "origin",
+		"mimetype", "text", "storage", "current_uri", "current_origin")
+	
+	Fields = Subject.Fields
+	
+	def __init__(self, uri="", interpretation="", manifestation="",
+		origin="", mimetype="", text="", storage="", current_uri="",
+		current_origin=""):
+		self.uri = str(uri)
+		self.interpretation = _intern(interpretation)
+		self.manifestation = _intern(manifestation)
+		self.origin = str(origin)
+		self.mimetype = _intern(mimetype)
+		self.text = str(text)
+		self.storage = _intern(storage)
+		# The current URI and origin are nearly always the same as the
+		# original ones, so share them in that case
+		self.current_uri = self.uri if current_uri == uri \
+			else str(current_uri)
+		self.current_origin = self.origin if current_origin == origin \
+			else str(current_origin)
+	
+	@classmethod
+	def new_for_struct(cls, data):
+		"""
+		Create a record from a :class:`Subject` or any other sequence
+		with the subject fields, as received over D-Bus
+		"""
+		if len(data) < len(Subject.Fields) - 2:
+			raise ValueError("Invalid subject data length %s, expected %s" \
+				% (len(data), len(Subject.Fields)))
+		return cls(*data[:len(Subject.Fields)])
+	
+	def to_struct(self):
+		"""
+		Return the fields as a list, in the order of :attr:`Subject.Fields`
+		"""
+		return [getattr(self, name) for name in self.__slots__]
+	
+	def to_subject(self, subject_type=Subject):
+		"""
+		Return a new :class:`Subject` (or `subject_type`) with this
+		record's data
+		"""
+		return subject_type(self.to_struct())
+	
+	def __getitem__(self, index):
+		return getattr(self, self.__slots__[index])
+	
+	def __len__(self):
+		return len(self.__slots__)
+	
+	def __eq__(self, other):
+		if not isinstance(other, (SubjectRecord, list, tuple)):
+			return NotImplemented
+		return list(self) == list(other)
+	
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		return result if result is NotImplemented else not result
+	
+	__hash__ = None
+	
+	def __repr__(self):
+		return "%s(%r)" % (self.__class__.__name__, self.to_struct())
+	
+	def matches_template(self, subject_template):
+		"""
+		See :meth:`Subject.matches_template`
+		"""
+		return self.to_subject().matches_template(subject_template)
+
+class EventRecord(object):
+	"""
+	Compact alternative to :class:`Event`, for programs keeping lots of
+	events in memory. It uses several times less memory than an
+	:class:`Event` with the same data.
+	
+	The fields are attributes with the same names as the properties of
+	:class:`Event`, but the id and the timestamp are integers, the
+	subjects are a tuple of :class:`SubjectRecord` and the payload is
+	a bytes object. Interpretations, manifestations and actors are
+	interned.
+	
+	Records are converted losslessly from and to the a(asaasay) D-Bus
+	struct with :meth:`new_for_struct` and :meth:`to_struct`, and from
+	and to :class:`Event` with :meth:`new_for_struct` and :meth:`to_event`.
+	They can be indexed like events, so they can be used as templates
+	for :meth:`Event.matches_template`, and
+	:class:`ZeitgeistClient <zeitgeist.client.ZeitgeistClient>` accepts
+	them wherever it accepts events.
+	"""
+	
+	__slots__ = ("id", "timestamp", "interpretation", "manifestation",
+		"actor", "origin", "subjects", "payload")
+	
+	Fields = Event.Fields
+	
+	def __init__(self, id=0, timestamp=None, interpretation="",
+		manifestation="", actor="", origin="", subjects=(), payload=b""):
+		self.id = int(id) if id else 0
+		self.timestamp = int(timestamp) if timestamp \
+			else get_timestamp_for_now()
+		self.interpretation = _intern(interpretation)
+		self.manifestation = _intern(manifestation)
+		self.actor = _intern(actor)
+		self.origin = str(origin) if origin else ""
+		self.subjects = tuple(subj if isinstance(subj, SubjectRecord)
+			else SubjectRecord.new_for_struct(subj) for subj in subjects)
+		if isinstance(payload, str):
+			payload = payload.encode("utf-8")
+		self.payload = bytes(payload) if payload else b""
+	
+	@classmethod
+	def new_for_struct(cls, struct):
+		"""
+		Create a record from an :class:`Event` or an event struct as
+		received over D-Bus. Returns None if `struct` is a `NULL_EVENT`
+		"""
+		if struct == NULL_EVENT:
+			return None
+		data = struct[0]
+		if len(data) < len(Event.Fields) - 1:
+			raise ValueError("event_data must have %s members, found %s" % \
+				(len(Event.Fields), len(data)))
+		subjects = struct[1] if len(struct) > 1 else ()
+		payload = struct[2] if len(struct) > 2 else b""
+		return cls(data[Event.Id], data[Event.Timestamp],
+			data[Event.Interpretation], data[Event.Manifestation],
+			data[Event.Actor],
+			data[Event.Origin] if len(data) > Event.Origin else "",
+			subjects, payload)
+	
+	def to_struct(self):
+		"""
+		Return a (metadata, subjects, payload) tuple which can be sent
+		over D-Bus with the a(asaasay) signature
+		"""
+		data = [str(self.id) if self.id else "", str(self.timestamp),
+			self.interpretation, self.manifestation, self.actor, self.origin]
+		# Like Event, use an empty string for an empty payload
+		return (data, [subj.to_struct() for subj in self.subjects],
+			self.payload or "")
+	
+	def to_event(self, event_type=Event):
+		"""
+		Return a new :class:`Event` (or `event_type`) with this
+		record's data
+		"""
+		return event_type(self.to_struct())
+	
+	def __getitem__(self, index):
+		if index == 0 or index == -3:
+			return self.to_struct()[0]
+		elif index == 1 or index == -2:
+			return list(self.subjects)
+		elif index == 2 or index == -1:
+			return self.payload
+		raise IndexError("EventRecord index out of range")
+	
+	def __len__(self):
+		return 3
+	
+	def __eq__(self, other):
+		if not isinstance(other, EventRecord):
+			if not isinstance(other, (list, tuple)):
+				return NotImplemented
+			if len(other) != 3:
+				return False
+			other = EventRecord.new_for_struct(other)
+		return self.to_struct() == other.to_struct()
+	
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		return result if result is NotImplemented else not result
+	
+	__hash__ = None
+	
+	def __repr__(self):
+		return "%s(%r)" % (self.__class__.__name__, self.to_struct())
+	
+	def matches_template(self, event_template):
+		"""
+		See :meth:`Event.matches_template`
+		"""
+		return self.to_event().matches_template(event_template)
+	
+	def in_time_range(self, time_range):
+		"""
+		Check if the event timestamp lies within a :class:`TimeRange`
+		"""
+		return time_range.begin <= self.timestamp <= time_range.end
+
+class EventBatch(object):
+	"""
+	Column-oriented container for large numbers of events, meant for
+	analysing query results. Filtering and grouping work on whole columns
+	at once instead of going through an :class:`Event` per row.
+	
+	Ids and timestamps are stored as 64 bit integer arrays. The
+	interpretation, manifestation, actor and origin of events, and the
+	interpretation, manifestation, origin, mimetype and storage of
+	subjects, are dictionary encoded: each column is an array of integer
+	codes, indexing a list with the distinct values. The subjects of the
+	i-th event are the rows subject_offsets[i] to subject_offsets[i+1]
+	of the subject columns.
+	
+	Filters return masks, which are :class:`bytearray` objects with a 0
+	or 1 per event. They can be combined with :meth:`mask_and`,
+	:meth:`mask_or` and :meth:`mask_not`, and applied with :meth:`select`.
+	A mask on a subject field is set for an event if any of its subjects
+	matches.
+	
+	Fields are named like the keyword arguments of
+	:meth:`Event.new_for_values`, eg. "actor" or "subject_mimetype".
+	"""
+	
+	EVENT_FIELDS = ("interpretation", "manifestation", "actor", "origin")
+	SUBJECT_FIELDS = ("uri", "interpretation", "manifestation", "origin",
+		"mimetype", "text", "storage", "current_uri", "current_origin")
+	_ENCODED_SUBJECT_FIELDS = ("interpretation", "manifestation", "origin",
+		"mimetype", "storage")
+	
+	def __init__(self):
+		"""
+		Create an empty batch. Use :meth:`from_events` to fill one.
+		"""
+		self.ids = array.array("q")
+		self.timestamps = array.array("q")
+		self.subject_offsets = array.array("q", [0])
+		# Event row of each subject row
+		self._subject_events = array.array("q")
+		self.payloads = []
+		self._columns = {}
+		self._values = {}
+		self._codes = {}
+		for field in self.EVENT_FIELDS:
+			self._add_column(field, True)
+		for field in self.SUBJECT_FIELDS:
+			self._add_column("subject_" + field,
+				field in self._ENCODED_SUBJECT_FIELDS)
+	
+	def _add_column(self, name, encoded):
+		if encoded:
+			self._columns[name] = array.array("q")
+			self._values[name] = []
+			self._codes[name] = {}
+		else:
+			self._columns[name] = []
+	
+	def _append_value(self, name, value):
+		value = str(value) if value else ""
+		codes = self._codes.get(name)
+		if codes is None:
+			self._columns[name].append(value)
+			return
+		code = codes.get(value)
+		if code is None:
+			code = codes[value] = len(self._values[name])
+			self._values[name].append(value)
+		self._columns[name].append(code)
+	
+	@classmethod
+	def from_events(cls, events):
+		"""
+		Create a batch from a list of :class:`Event`,
+		:class:`EventRecord` or raw event structs. None entries (for
+		events which weren't found) are skipped.
+		"""
+		batch = cls()
+		append = batch._append_value
+		for event in events:
+			if event is None:
+				continue
+			data = event[0]
+			batch.ids.append(int(data[Event.Id]) if data[Event.Id] else 0)
+			batch.timestamps.append(int(data[Event.Timestamp]))
+			append("interpretation", data[Event.Interpretation])
+			append("manifestation", data[Event.Manifestation])
+			append("actor", data[Event.Actor])
+			append("origin", data[Event.Origin]
+				if len(data) > Event.Origin else "")
+			subjects = event[1]
+			batch._subject_events.extend(
+				itertools.repeat(len(batch.ids) - 1, len(subjects)))
+			for subject in subjects:
+				for field, name in enumerate(cls.SUBJECT_FIELDS):
+					append("subject_" + name,
+						subject[field] if field < len(subject) else "")
+			batch.subject_offsets.append(
+				batch.subject_offsets[-1] + len(subjects))
+			# Like Event, use an empty string for an empty payload
+			batch.payloads.append((event[2] if len(event) > 2 else "") or "")
+		return batch
+	
+	def _get_value(self, name, row):
+		values = self._values.get(name)
+		if values is None:
+			return self._columns[name][row]
+		return values[self._columns[name][row]]
+	
+	def to_events(self, event_type=Event):
+		"""
+		Return a list with an :class:`Event` (or `event_type`) per row
+		"""
+		events = []
+		subject_type = event_type._subject_type
+		for i in range(len(self)):
+			data = [str(self.ids[i]) if self.ids[i] else "",
+				str(self.timestamps[i])]
+			data.extend(self._get_value(field, i)
+				for field in self.EVENT_FIELDS)
+			subjects = [subject_type([
+				self._get_value("subject_" + field, row)
+				for field in self.SUBJECT_FIELDS])
+				for row in range(self.subject_offsets[i],
+				self.subject_offsets[i + 1])]
+			events.append(event_type([data, subjects, self.payloads[i]]))
+		return events
+	
+	def __len__(self):
+		return len(self.ids)
+	
+	def get_values(self, field):
+		"""
+		Return the list of distinct values of the dictionary encoded
+		column `field`
+		"""
+		return list(self._values[field])
+	
+	def _check_field(self, field):
+		if field not in self._columns:
+			raise ValueError("Unknown field '%s'" % field)
+	
+	def _mask_for_values(self, field, predicate, column_predicate):
+		"""
+		Return a mask with the events for which `predicate` is True for
+		the value of `field` (or for the value of any of their subjects).
+		`column_predicate` must return the same for each value of a whole
+		column which isn't dictionary encoded.
+		"""
+		self._check_field(field)
+		column = self._columns[field]
+		values = self._values.get(field)
+		if values is not None:
+			# Test each distinct value only once
+			codes = frozenset(code for code, value in enumerate(values)
+				if predicate(value))
+			row_mask = bytearray(map(codes.__contains__, column))
+		else:
+			row_mask = bytearray(column_predicate(column))
+		if not field.startswith("subject_"):
+			return row_mask
+		matching = frozenset(itertools.compress(self._subject_events,
+			row_mask))
+		return bytearray(map(matching.__contains__, range(len(self))))
+	
+	def equals_mask(self, field, value):
+		"""
+		Return a mask with the events whose `field` is `value`
+		"""
+		value = str(value)
+		return self._mask_for_values(field, value.__eq__,
+			lambda column: map(operator.eq, column, itertools.repeat(value)))
+	
+	def prefix_mask(self, field, prefix):
+		"""
+		Return a mask with the events whose `field` starts with `prefix`
+		"""
+		prefix = str(prefix)
+		return self._mask_for_values(field,
+			lambda value: value.startswith(prefix),
+			lambda column: map(str.startswith, column,
+				itertools.repeat(prefix)))
+	
+	def symbol_mask(self, field, symbol):
+		"""
+		Return a mask with the events whose `field` is `symbol` or any
+		of its children, as in template matching
+		"""
+		uris = _DESCENDANT_URIS.get(symbol, frozenset([str(symbol)]))
+		return self._mask_for_values(field, uris.__contains__,
+			lambda column: map(uris.__contains__, column))
+	
+	def time_range_mask(self, time_range):
+		"""
+		Return a mask with the events lying in `time_range`, which may
+		also be a :class:`TimeRangeSet`
+		"""
+		if isinstance(time_range, TimeRangeSet):
+			return time_range.mask(self.timestamps)
+		begin, end = int(time_range[0]), int(time_range[1])
+		return bytearray(map(operator.and_,
+			map(begin.__le__, self.timestamps),
+			map(end.__ge__, self.timestamps)))
+	
+	@staticmethod
+	def mask_and(*masks):
+		"""
+		Return a mask with the events set in all of `masks`
+		"""
+		result = masks[0]
+		for mask in masks[1:]:
+			result = bytearray(map(operator.and_, result, mask))
+		return result
+	
+	@staticmethod
+	def mask_or(*masks):
+		"""
+		Return a mask with the events set in any of `masks`
+		"""
+		result = masks[0]
+		for mask in masks[1:]:
+			result = bytearray(map(operator.or_, result, mask))
+		return result
+	
+	@staticmethod
+	def mask_not(mask):
+		"""
+		Return a mask with the events not set in `mask`
+		"""
+		return mask.translate(bytes([1, 0]) + bytes(254))
+	
+	def select(self, mask):
+		"""
+		Return a new batch with the events set in `mask`
+		"""
+		batch = EventBatch()
+		batch._values = dict((name, list(values))
+			for name, values in self._values.items())
+		batch._codes = dict((name, dict(codes))
+			for name, codes in self._codes.items())
+		rows = [i for i, selected in enumerate(mask) if selected]
+		batch.ids = array.array("q", (self.ids[i] for i in rows))
+		batch.timestamps = array.array("q", (self.timestamps[i] for i in rows))
+		batch.payloads = [self.payloads[i] for i in rows]
+		subject_rows = []
+		for row, i in enumerate(rows):
+			start, end = self.subject_offsets[i], self.subject_offsets[i + 1]
+			subject_rows.extend(range(start, end))
+			batch.subject_offsets.append(
+				batch.subject_offsets[-1] + end - start)
+			batch._subject_events.extend(itertools.repeat(row, end - start))
+		for name, column in self._columns.items():
+			selected = subject_rows if name.startswith("subject_") else rows
+			values = [column[i] for i in selected]
+			batch._columns[name] = array.array("q", values) \
+				if name in self._values else values
+		return batch
+	
+	def count_by(self, field, mask=None):
+		"""
+		Return a dict with the number of events for each value of the
+		dictionary encoded column `field`, only counting the events set in
+		`mask` if it's given. For subject fields, each subject is counted.
+		"""
+		self._check_field(field)
+		if field not in self._values:
+			raise ValueError("Field '%s' isn't dictionary encoded" % field)
+		column = self._columns[field]
+		if mask is not None:
+			if field.startswith("subject_"):
+				mask = bytes(map(mask.__getitem__, self._subject_events))
+			column = itertools.compress(column, mask)
+		values = self._values[field]
+		return dict((values[code], count)
+			for code, count in collections.Counter(column).items())
 
 class DataSource(list):
 	""" Optimized and convenient data structure representing a datasource.
@@ -1166,42 +2506,103 @@ Manifestation = Symbol("Manifestation", doc=MANIFESTATION_DOC)
 _SYMBOLS_BY_URI["Interpretation"] = Interpretation
 _SYMBOLS_BY_URI["Manifestation"] = Manifestation
 
-# Load the ontology definitions
-ontology_file = os.path.join(os.path.dirname(__file__), "_ontology.py")
-try:
-	with open(ontology_file, "rb") as f:
-		exec(compile(f.read(), ontology_file, 'exec'))
-except IOError:
-	raise ImportError("Unable to load Zeitgeist ontology. Did you run `make`?")
+# Must match PythonSerializer.CACHE_VERSION in data/ontology2code
+_ONTOLOGY_CACHE_VERSION = 1
 
-#
-# Bootstrap the symbol relations. We use a 2-pass strategy:
-#
-# 1) Make sure that all parents and children are registered on each symbol
-for symbol in list(_SYMBOLS_BY_URI.values()):
-	for parent in symbol._parents:
-		try:
-			_SYMBOLS_BY_URI[parent]._children[symbol.uri] = None
-		except KeyError as e:
-			print("ERROR", e, parent, symbol.uri)
-			pass
-	for child in symbol._children:
-		try:
-			_SYMBOLS_BY_URI[child]._parents.add(symbol.uri)
-		except KeyError:
-			print("ERROR", e, child, symbol.uri)
-			pass
+def _load_ontology_cache(path):
+	"""
+	Load the ontology table written by `ontology2code --dump-python-cache`.
+	Returns None if it is missing or was written for a different format.
+	"""
+	try:
+		with open(path, "rb") as f:
+			version, table = marshal.load(f)
+	except (IOError, EOFError, ValueError, TypeError):
+		return None
+	if version != _ONTOLOGY_CACHE_VERSION:
+		return None
+	for (uri, name, display_name, doc, parents, children, ancestors,
+		descendants) in table:
+		_ANCESTOR_URIS[uri] = ancestors
+		_DESCENDANT_URIS[uri] = descendants
+		if name is None:
+			# Interpretation or Manifestation
+			_SYMBOLS_BY_URI[uri]._children = dict.fromkeys(children)
+		else:
+			_PENDING_SYMBOLS[uri] = (name, display_name, doc, parents,
+				children)
+			_URIS_BY_NAME.setdefault(name, []).append(uri)
+	return table
 
-# 2) Resolve all child and parent URIs to their actual Symbol instances
-for symbol in list(_SYMBOLS_BY_URI.values()):
-	for child_uri in list(symbol._children.keys()):
-		symbol._children[child_uri] = _SYMBOLS_BY_URI[child_uri]
-	
-	parents = {}
-	for parent_uri in symbol._parents:
-		parents[parent_uri] = _SYMBOLS_BY_URI[parent_uri]
-	symbol._parents = parents
+def _load_ontology_module(ontology_file):
+	"""
+	Create all symbols by running the generated _ontology.py, and resolve
+	their relations.
+	"""
+	try:
+		with open(ontology_file, "rb") as f:
+			exec(compile(f.read(), ontology_file, 'exec'), globals())
+	except IOError:
+		raise ImportError("Unable to load Zeitgeist ontology. Did you run `make`?")
+
+	#
+	# Bootstrap the symbol relations. We use a 2-pass strategy:
+	#
+	# 1) Make sure that all parents and children are registered on each symbol
+	for symbol in list(_SYMBOLS_BY_URI.values()):
+		for parent in symbol._parents:
+			try:
+				_SYMBOLS_BY_URI[parent]._children[symbol.uri] = None
+			except KeyError as e:
+				print("ERROR", e, parent, symbol.uri)
+				pass
+		for child in symbol._children:
+			try:
+				_SYMBOLS_BY_URI[child]._parents.add(symbol.uri)
+			except KeyError:
+				print("ERROR", e, child, symbol.uri)
+				pass
+
+	# 2) Resolve all child and parent URIs to their actual Symbol instances
+	for symbol in list(_SYMBOLS_BY_URI.values()):
+		for child_uri in list(symbol._children.keys()):
+			symbol._children[child_uri] = _SYMBOLS_BY_URI[child_uri]
+		
+		parents = {}
+		for parent_uri in symbol._parents:
+			parents[parent_uri] = _SYMBOLS_BY_URI[parent_uri]
+		symbol._parents = parents
+
+	_index_symbols()
+
+def _index_symbols():
+	"""
+	Fill in _ANCESTOR_URIS, _DESCENDANT_URIS and _URIS_BY_NAME for all
+	registered symbols, so ancestry checks are a single set lookup.
+	"""
+	def closure(uri, relatives, result):
+		if uri not in result:
+			uris = set([uri])
+			for relative in relatives(_SYMBOLS_BY_URI[uri]):
+				uris.update(closure(relative, relatives, result))
+			result[uri] = frozenset(uris)
+		return result[uri]
+	
+	_ANCESTOR_URIS.clear()
+	_DESCENDANT_URIS.clear()
+	_URIS_BY_NAME.clear()
+	for symbol in set(_SYMBOLS_BY_URI.values()):
+		closure(symbol.uri, lambda s: s._parents, _ANCESTOR_URIS)
+		closure(symbol.uri, lambda s: s._children, _DESCENDANT_URIS)
+		_URIS_BY_NAME.setdefault(symbol.name, []).append(symbol.uri)
 
+# Load the ontology definitions. The precomputed cache only needs to be
+# unmarshalled, and its symbols are created when they are first used;
+# _ontology.py is used if the cache hasn't been built.
+if _load_ontology_cache(os.path.join(os.path.dirname(__file__),
+	"_ontology.marshal")) is None:
+	_load_ontology_module(os.path.join(os.path.dirname(__file__),
+		"_ontology.py"))
 
 if __name__ == "__main__":
 	print("Success")
@@ -19,13 +19,15 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import re
 
-from datamodel import Interpretation, Manifestation
+from zeitgeist.datamodel import Interpretation, Manifestation, Subject
 
 __all__ = [
     "get_interpretation_for_mimetype",
     "get_manifestation_for_uri",
+    "classify_subjects",
 ]
 
 class RegExpr(object):
@@ -46,6 +48,7 @@ class RegExpr(object):
 def make_regex_tuple(*items):
     return tuple((RegExpr(k), v) for k, v in items)
 
+@functools.lru_cache(maxsize=1024)
 def get_interpretation_for_mimetype(mimetype):
     """ get interpretation for a given mimetype, returns :const:`None`
     if none of the predefined interpretations matches
@@ -53,20 +56,66 @@ def get_interpretation_for_mimetype(mimetype):
     interpretation = MIMES.get(mimetype, None)
     if interpretation is not None:
         return interpretation
-    for pattern, interpretation in MIMES_REGEX:
-        if pattern.match(mimetype):
-            return interpretation
+    # All of MIMES_REGEX is matched at once, the alternatives are tried
+    # in order just like the individual patterns would be
+    match = _MIMES_REGEX_ALTERNATION.match(mimetype)
+    if match is not None:
+        return _MIMES_REGEX_GROUPS[match.lastindex]
     return None
     
 def get_manifestation_for_uri(uri):
     """ Lookup Manifestation for a given uri based on the scheme part,
     returns :const:`None` if no suitable manifestation is found
     """
-    for scheme, manifestation in SCHEMES:
+    for scheme, manifestation in _SCHEMES_BY_NAME.get(
+            uri.partition(":")[0], ()):
         if uri.startswith(scheme):
             return manifestation
     return None
     
+def classify_subjects(subjects):
+    """ Fill in the interpretation of the given subjects from their
+    mimetype, and their manifestation from their uri, where those
+    aren't set yet and a suitable one is known. Returns `subjects`.
+    
+    `subjects` may contain :class:`Subject <zeitgeist.datamodel.Subject>`
+    instances or any lists with the subject fields.
+    """
+    for subject in subjects:
+        if not subject[Subject.Interpretation] and subject[Subject.Mimetype]:
+            interpretation = get_interpretation_for_mimetype(
+                subject[Subject.Mimetype])
+            if interpretation is not None:
+                subject[Subject.Interpretation] = interpretation
+        if not subject[Subject.Manifestation]:
+            manifestation = get_manifestation_for_uri(subject[Subject.Uri])
+            if manifestation is not None:
+                subject[Subject.Manifestation] = manifestation
+    return subjects
+    
+def _compile_alternation(regex_tuple):
+    """ Merge the patterns of `regex_tuple` into a single regular
+    expression, returning it together with a mapping from the index of
+    the group of each alternative to its value
+    """
+    alternatives = []
+    groups = {}
+    group = 1
+    for pattern, value in regex_tuple:
+        alternatives.append("(%s)" % pattern)
+        groups[group] = value
+        group += pattern.groups + 1
+    return re.compile("|".join(alternatives)), groups
+    
+def _index_schemes(schemes):
+    """ Group the prefixes in `schemes` by their scheme name, keeping
+    them in order """
+    index = {}
+    for scheme, manifestation in schemes:
+        index.setdefault(scheme.partition(":")[0], []).append(
+            (scheme, manifestation))
+    return index
+    
     
 MIMES = {
     # x-applix-*
@@ -250,4 +299,7 @@ SCHEMES = tuple((
     ("smb://", Manifestation.REMOTE_DATA_OBJECT),
 ))
 
+_MIMES_REGEX_ALTERNATION, _MIMES_REGEX_GROUPS = _compile_alternation(MIMES_REGEX)
+_SCHEMES_BY_NAME = _index_schemes(SCHEMES)
+
 # vim:noexpandtab:ts=4:sw=4
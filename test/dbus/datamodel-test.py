@@ -0,0 +1,323 @@
+#! /usr/bin/env python3
+# -.- coding: utf-8 -.-
+
+# datamodel-test.py
+#
+# Tests for the parts of the Python datamodel which don't need a
+# running daemon. Their agreement with the engine is checked in
+# remote-test.py.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import tempfile
+import unittest
+
+from zeitgeist import datamodel, mimetypes
+from zeitgeist.datamodel import (Event, Subject, Interpretation, Manifestation,
+	TimeRange, EventRecord, TemplateMatcher, EventBatch, TimeRangeSet,
+	EventFactory)
+
+import testutils
+from testutils import parse_events
+
+def get_five_events():
+	"""
+	Return the events in five_events.js, with the ids 1 to 5
+	"""
+	events = parse_events("test/data/five_events.js")
+	for i, event in enumerate(events):
+		event[0][Event.Id] = str(i + 1)
+	return events
+
+class SymbolRegistryTest(unittest.TestCase):
+
+	def testEnumerateSymbols(self):
+		registry = datamodel._SYMBOLS_BY_URI
+		uri = Interpretation.EMAIL.uri
+		self.assertTrue(uri in registry)
+		self.assertEqual(uri, registry.get(uri))
+		self.assertEqual(None, registry.get("http://example.org/#Nothing"))
+		# Symbols from the ontology cache which weren't used yet are
+		# listed too
+		uris = set(registry)
+		self.assertEqual(len(registry), len(uris))
+		self.assertTrue(Interpretation.AUDIO.uri in uris)
+		self.assertTrue(Manifestation.FILE_DATA_OBJECT in registry.values())
+
+class DumpManyTest(unittest.TestCase):
+
+	def testDumpManyLoadMany(self):
+		events = get_five_events() + [None]
+		local = Event.new_for_values(timestamp=123, actor="application://x",
+			subject_uri="file:///tmp/dump")
+		local.payload = b"\x00binary\xff"
+		events.append(local)
+
+		buf = io.BytesIO()
+		Event.dump_many(events, buf, block_size=2)
+		buf.seek(0)
+		loaded = Event.load_many(buf)
+		self.assertEqual(events, loaded)
+		self.assertEqual(None, loaded[5])
+		self.assertEqual(3, loaded[2].id)
+		self.assertEqual(b"\x00binary\xff", loaded[-1].payload)
+
+		with tempfile.TemporaryFile() as f:
+			f.write(buf.getvalue())
+			f.seek(0)
+			self.assertEqual(loaded, Event.load_many(f, use_mmap=True))
+		self.assertRaises(ValueError, Event.load_many,
+			io.BytesIO(buf.getvalue()[:-1]))
+
+	def testParseEventsFromDump(self):
+		events = get_five_events()
+		with tempfile.NamedTemporaryFile() as f:
+			Event.dump_many(events, f)
+			f.flush()
+			self.assertEqual(events, parse_events(f.name))
+
+class EventFactoryTest(unittest.TestCase):
+
+	def testEventFactory(self):
+		factory = EventFactory(("timestamp", "interpretation", "actor",
+			"subject_uri", "subject_mimetype", "payload"), ("uri", "text"))
+		rows = [(100 + i, Interpretation.ACCESS_EVENT, "application://gedit",
+			"file:///tmp/%d.txt" % i, "text/plain", "") for i in range(3)]
+		events = factory.new_events(rows)
+		events.append(factory.new_event(
+			(200, Interpretation.MODIFY_EVENT, "application://gedit",
+				"file:///tmp/a.txt", "text/plain", ""),
+			[("file:///tmp/b.txt", "b")]))
+		self.assertEqual(Event.new_for_values(timestamp=101,
+			interpretation=Interpretation.ACCESS_EVENT,
+			actor="application://gedit", subject_uri="file:///tmp/1.txt",
+			subject_mimetype="text/plain"), events[1])
+		self.assertEqual(["file:///tmp/a.txt", "file:///tmp/b.txt"],
+			[subject.uri for subject in events[3].subjects])
+		self.assertRaises(ValueError, EventFactory, ("subject_foo",))
+		self.assertRaises(ValueError, factory.new_event, (1, 2))
+
+class ClassifySubjectsTest(unittest.TestCase):
+
+	def testClassifySubjects(self):
+		subjects = [
+			Subject.new_for_values(uri="file:///tmp/a.odt",
+				mimetype="application/vnd.oasis.opendocument.text"),
+			Subject.new_for_values(uri="https://example.org/",
+				mimetype="image/x-foo"),
+			Subject.new_for_values(uri="mailto:a@example.org",
+				mimetype="text/x-dvi", interpretation=Interpretation.EMAIL),
+		]
+		mimetypes.classify_subjects(subjects)
+		self.assertEqual(
+			[Interpretation.PAGINATED_TEXT_DOCUMENT, Interpretation.IMAGE,
+				Interpretation.EMAIL],
+			[subject.interpretation for subject in subjects])
+		self.assertEqual(
+			[Manifestation.FILE_DATA_OBJECT, Manifestation.WEB_DATA_OBJECT, ""],
+			[subject.manifestation for subject in subjects])
+
+class EventRecordTest(unittest.TestCase):
+
+	def testEventRecords(self):
+		events = get_five_events()
+		records = [EventRecord.new_for_struct(event) for event in events]
+		for record, event in zip(records, events):
+			self.assertEqual(event, record.to_event())
+			self.assertEqual(event,
+				EventRecord.new_for_struct(record.to_event()).to_event())
+
+		tmpl = EventRecord.new_for_struct(
+			Event.new_for_values(interpretation="stfu:OpenEvent"))
+		self.assertEqual([1, 5],
+			[r.id for r in records if r.matches_template(tmpl)])
+
+	def testCompare(self):
+		events = get_five_events()
+		record = EventRecord.new_for_struct(events[0])
+		self.assertTrue(record == events[0])
+		self.assertTrue(events[0] == record)
+		self.assertTrue(record != events[1])
+		# Comparing with unrelated objects doesn't raise
+		self.assertFalse(record == 5)
+		self.assertTrue(record != None)
+		self.assertTrue(record in [None, 3, record])
+		self.assertFalse(record == (1, 2))
+		self.assertFalse(record.subjects[0] == object())
+		self.assertTrue(record.subjects[0] == events[0].subjects[0])
+
+class TemplateMatcherTest(unittest.TestCase):
+
+	def testTemplateMatcher(self):
+		events = get_five_events()
+
+		def match(*templates):
+			matcher = TemplateMatcher.compile(templates)
+			return [event.id for event in matcher.filter(events)]
+
+		self.assertEqual([1, 5],
+			match(Event.new_for_values(interpretation="stfu:OpenEvent")))
+		self.assertEqual([1],
+			match(Event.new_for_values(subject_uri="http://*")))
+		self.assertEqual([1, 4, 5],
+			match(Event.new_for_values(subject_uri="!file:///tmp/foo.txt")))
+		self.assertEqual([2, 3], match(Event.new_for_values(actor="!firefox")))
+		self.assertEqual([1, 5],
+			match(Event.new_for_values(interpretation="stfu:OpenEvent"),
+				Event.new_for_values(subject_uri="http://*")))
+
+		matcher = TemplateMatcher.compile(
+			[Event.new_for_values(actor="geany")])
+		self.assertEqual([False, True, False, False, False],
+			[matcher.match(event) for event in events])
+
+class TimeRangeSetTest(unittest.TestCase):
+
+	def testDiscard(self):
+		ranges = TimeRangeSet([TimeRange(100, 125), (140, 160)])
+		ranges.discard((150, 155))
+		self.assertEqual(
+			[TimeRange(100, 125), TimeRange(140, 149), TimeRange(156, 160)],
+			list(ranges))
+		self.assertEqual(ranges,
+			TimeRangeSet([(100, 160)]) - [(126, 139), (150, 155)])
+
+	def testMergeAdjacentAndOverlapping(self):
+		ranges = TimeRangeSet([(10, 20), (21, 30), (25, 40), (50, 60), (42, 42)])
+		self.assertEqual([TimeRange(10, 40), TimeRange(42, 42),
+			TimeRange(50, 60)], list(ranges))
+		# Empty ranges are ignored
+		self.assertEqual(TimeRangeSet(), TimeRangeSet([(5, 4)]))
+		self.assertFalse(TimeRangeSet([(5, 4)]))
+
+	def testAdd(self):
+		ranges = TimeRangeSet([(10, 20), (30, 40), (50, 60)])
+		ranges.add((41, 49))
+		self.assertEqual(TimeRangeSet([(10, 20), (30, 60)]), ranges)
+		ranges.add((0, 5))
+		ranges.add((22, 28))
+		self.assertEqual(TimeRangeSet([(0, 5), (10, 20), (22, 28), (30, 60)]),
+			ranges)
+		ranges.add((6, 29))
+		self.assertEqual(TimeRangeSet([(0, 60)]), ranges)
+		ranges.add((70, 65))
+		self.assertEqual(TimeRangeSet([(0, 60)]), ranges)
+
+	def testUnion(self):
+		a = TimeRangeSet([(10, 20), (40, 50)])
+		b = TimeRangeSet([(15, 25), (26, 30), (60, 70)])
+		self.assertEqual(TimeRangeSet([(10, 30), (40, 50), (60, 70)]), a | b)
+		self.assertEqual(a | b, b | a)
+		self.assertEqual(a | b, a | [(15, 25), (26, 30), (60, 70)])
+		self.assertEqual(a, a | TimeRangeSet())
+		# The operands aren't changed
+		self.assertEqual(TimeRangeSet([(10, 20), (40, 50)]), a)
+
+	def testIntersection(self):
+		a = TimeRangeSet([(10, 20), (40, 50)])
+		b = TimeRangeSet([(15, 45), (50, 60)])
+		self.assertEqual(TimeRangeSet([(15, 20), (40, 45), (50, 50)]), a & b)
+		self.assertEqual(a & b, b & a)
+		self.assertEqual(TimeRangeSet(), a & [(21, 39)])
+		self.assertEqual(TimeRangeSet(), a & TimeRangeSet())
+
+	def testContains(self):
+		ranges = TimeRangeSet([(10, 20), (30, 40)])
+		self.assertTrue(10 in ranges)
+		self.assertTrue(20 in ranges)
+		self.assertFalse(9 in ranges)
+		self.assertFalse(25 in ranges)
+		self.assertTrue((12, 18) in ranges)
+		self.assertTrue(TimeRange(30, 40) in ranges)
+		self.assertFalse((15, 35) in ranges)
+		self.assertFalse(0 in TimeRangeSet())
+
+	def testOverlaps(self):
+		ranges = TimeRangeSet([(10, 20), (30, 40)])
+		self.assertTrue(ranges.overlaps((0, 10)))
+		self.assertTrue(ranges.overlaps((20, 30)))
+		self.assertTrue(ranges.overlaps((15, 35)))
+		self.assertFalse(ranges.overlaps((21, 29)))
+		self.assertFalse(ranges.overlaps((41, 50)))
+		self.assertFalse(ranges.overlaps((35, 32)))
+		self.assertFalse(TimeRangeSet().overlaps((0, 10)))
+
+	def testInt64Bounds(self):
+		low, high = -2 ** 63, 2 ** 63 - 1
+		ranges = TimeRangeSet([(low, high)])
+		self.assertEqual([TimeRange(low, high)], list(ranges))
+		self.assertTrue(low in ranges)
+		self.assertTrue(high in ranges)
+		self.assertTrue(ranges.overlaps((high, high)))
+
+		ranges.discard((0, 0))
+		self.assertEqual([TimeRange(low, -1), TimeRange(1, high)],
+			list(ranges))
+		ranges.add((0, 0))
+		self.assertEqual(TimeRangeSet([(low, high)]), ranges)
+		ranges.discard((low, low))
+		ranges.discard((high, high))
+		self.assertEqual([TimeRange(low + 1, high - 1)], list(ranges))
+		ranges.add((low, high))
+		self.assertEqual(TimeRangeSet(), ranges - [(low, high)])
+		self.assertEqual(TimeRangeSet([(high, high)]), ranges & [(high, high)])
+		self.assertEqual(ranges, TimeRangeSet([(low, 0)]) | [(1, high)])
+		self.assertEqual(TimeRangeSet([TimeRange.always()]),
+			ranges & [TimeRange.always()])
+
+	def testSlices(self):
+		ranges = TimeRangeSet([(100, 125), (140, 149), (156, 160)])
+		timestamps = [90, 100, 110, 130, 140, 149, 150, 160, 170]
+		self.assertEqual([slice(1, 3), slice(4, 6), slice(7, 8)],
+			ranges.slices(timestamps))
+		self.assertEqual(bytearray([0, 1, 1, 0, 1, 1, 0, 1, 0]),
+			ranges.mask(timestamps))
+
+class EventBatchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.events = get_five_events()
+		self.batch = EventBatch.from_events(self.events)
+
+	def ids_for_mask(self, mask):
+		return sorted(self.batch.select(mask).ids)
+
+	def testToEvents(self):
+		self.assertEqual(len(self.events), len(self.batch))
+		self.assertEqual(self.events, self.batch.to_events())
+
+	def testMasks(self):
+		batch = self.batch
+		self.assertEqual([1, 4, 5],
+			self.ids_for_mask(batch.equals_mask("actor", "firefox")))
+		self.assertEqual([2, 3, 4],
+			self.ids_for_mask(batch.prefix_mask("subject_uri", "file:///tmp/")))
+		self.assertEqual([1, 5], self.ids_for_mask(batch.mask_not(
+			batch.equals_mask("subject_mimetype", "text/plain"))))
+		self.assertEqual([2, 3], self.ids_for_mask(batch.mask_and(
+			batch.time_range_mask(TimeRange(130, 150)),
+			batch.prefix_mask("subject_uri", "file://"))))
+
+	def testCountBy(self):
+		self.assertEqual({"firefox": 3, "geany": 1, "gedit": 1},
+			self.batch.count_by("actor"))
+		self.assertEqual({"firefox": 2},
+			self.batch.count_by("actor",
+				self.batch.equals_mask("interpretation", "stfu:OpenEvent")))
+
+if __name__ == "__main__":
+	testutils.run()
+
+# vim:noexpandtab:ts=4:sw=4
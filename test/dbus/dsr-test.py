@@ -51,6 +51,9 @@ from testutils import parse_events, import_events, asyncTestMethod
 
 class ZeitgeistRemoteDataSourceRegistryTest(testutils.RemoteTestCase):
 	
+	# Data sources can't be unregistered, so each test needs a new daemon
+	reuse_daemon = False
+	
 	_ds1 = [
 		"www.example.com/foo",
 		"Foo Source",
@@ -32,6 +32,9 @@ from testutils import parse_events, import_events, new_event
 
 class ZeitgeistEngineTest(testutils.RemoteTestCase):
 
+	# Many tests expect the events they insert to get specific ids
+	reuse_daemon = False
+
 	def testSingleInsertGet(self):
 		test_event_1 = parse_events("test/data/one_event.js")[0]
 		# Insert item and event
@@ -44,9 +44,10 @@ from dbus.exceptions import DBusException
 from gi.repository import GLib
 from zeitgeist.datamodel import (Event, Subject, Interpretation, Manifestation,
 	TimeRange, StorageState, DataSource, NULL_EVENT, ResultType)
+from zeitgeist.client import get_bus
 
 import testutils
-from testutils import parse_events, import_events, asyncTestMethod
+from testutils import parse_events, import_events, asyncTestMethod, new_event
 
 
 class ZeitgeistMonitorTest(testutils.RemoteTestCase):
@@ -316,6 +317,242 @@ class ZeitgeistMonitorTest(testutils.RemoteTestCase):
 		
 		self.assertEqual(3, len(result))
 
+	def testMultiplexedMonitors(self):
+		result1 = []
+		result2 = []
+		mainloop = self.create_mainloop()
+		events = parse_events("test/data/five_events.js")
+		self.client.enable_monitor_multiplexing()
+
+		def check_ok():
+			if len(result1) == 2 and len(result2) == 1:
+				mainloop.quit()
+
+		@asyncTestMethod(mainloop)
+		def notify_insert_handler1(time_range, events):
+			result1.extend(events)
+			check_ok()
+
+		@asyncTestMethod(mainloop)
+		def notify_insert_handler2(time_range, events):
+			result2.extend(events)
+			check_ok()
+
+		@asyncTestMethod(mainloop)
+		def notify_delete_handler(time_range, event_ids):
+			mainloop.quit()
+			self.fail("Unexpected delete notification")
+
+		tmpl1 = Event.new_for_values(interpretation="stfu:OpenEvent")
+		tmpl2 = Event.new_for_values(
+			subjects=[Subject.new_for_values(uri="file:///tmp/bar.txt")])
+		self.client.install_monitor(TimeRange.always(), [tmpl1],
+			notify_insert_handler1, notify_delete_handler)
+		mon2 = self.client.install_monitor([153, 166], [tmpl2],
+			notify_insert_handler2, notify_delete_handler)
+		self.assertEqual(mon2.time_range, TimeRange(153, 166))
+
+		# Insert the events once the shared monitor has been installed
+		GLib.timeout_add(100, lambda: self.client.insert_events(events))
+		mainloop.run()
+
+		self.assertEqual(2, len(result1))
+		self.assertEqual(1, len(result2))
+		self.assertTrue(all(ev.interpretation == "stfu:OpenEvent"
+			for ev in result1))
+
+	def testMultiplexedMonitorsDelete(self):
+		ids = import_events("test/data/five_events.js", self)
+		result = {}
+		mainloop = self.create_mainloop()
+		self.client.enable_monitor_multiplexing()
+
+		def notify_insert_handler(time_range, events):
+			pass
+
+		def delete_handler(name):
+			@asyncTestMethod(mainloop)
+			def notify_delete_handler(time_range, event_ids):
+				result[name] = time_range
+				if len(result) == 2:
+					mainloop.quit()
+			return notify_delete_handler
+
+		self.client.install_monitor(TimeRange.always(), [],
+			notify_insert_handler, delete_handler("always"))
+		self.client.install_monitor([140, 160], [],
+			notify_insert_handler, delete_handler("restricted"))
+
+		# Delete the events once the shared monitor has been installed
+		GLib.timeout_add(100, lambda: self.client.delete_events(ids) and False)
+		mainloop.run()
+
+		# Each monitor only hears about its own part of the time range
+		self.assertEqual(result["always"], TimeRange(123, 163))
+		self.assertEqual(result["restricted"], TimeRange(140, 160))
+
+	def testCoalescedMonitor(self):
+		result = []
+		counts = []
+		mainloop = self.create_mainloop()
+		events = parse_events("test/data/five_events.js")
+
+		@asyncTestMethod(mainloop)
+		def notify_insert_handler(time_range, events):
+			result.extend(events)
+			counts.append(mon.coalesced_notifications)
+			self.assertTrue(time_range.begin <= min(int(ev.timestamp) for ev in events))
+			self.assertTrue(time_range.end >= max(int(ev.timestamp) for ev in events))
+			if len(result) == 5:
+				mainloop.quit()
+
+		@asyncTestMethod(mainloop)
+		def notify_delete_handler(time_range, event_ids):
+			mainloop.quit()
+			self.fail("Unexpected delete notification")
+
+		mon = self.client.install_monitor(TimeRange.always(), [],
+			notify_insert_handler, notify_delete_handler,
+			coalesce_latency=200)
+		for event in events:
+			self.client.insert_events([event])
+		mainloop.run()
+
+		self.assertEqual(5, len(result))
+		# Every raw notification is accounted for exactly once
+		self.assertEqual(5, sum(counts))
+		self.assertTrue(len(counts) < 5)
+
+	def testCoalescedMonitorDeleteUnion(self):
+		result = []
+		mon = self.client.install_monitor(TimeRange.always(), [],
+			lambda time_range, events: None,
+			lambda time_range, event_ids: result.append(
+				(time_range, event_ids)),
+			coalesce_latency=60000)
+		first = [1, 2]
+		mon.NotifyDelete((10, 20), first)
+		mon.NotifyDelete((15, 30), [2, 3, 1])
+		mon.flush()
+
+		# Repeated ids are only reported once, in order of appearance
+		self.assertEqual(result, [(TimeRange(10, 30), [1, 2, 3])])
+		self.assertEqual(first, [1, 2])
+
+	def waitForCacheInvalidation(self, cache):
+		mainloop = self.create_mainloop()
+		def check_cache():
+			if len(cache) == 0:
+				mainloop.quit()
+				return False
+			return True
+		GLib.timeout_add(10, check_cache)
+		mainloop.run()
+
+	def testQueryCache(self):
+		import_events("test/data/five_events.js", self)
+		cache = self.client.enable_query_cache()
+		tmpl = Event.new_for_values(interpretation="stfu:OpenEvent")
+
+		result1 = self.findEventsForTemplatesAndWait([tmpl], num_events=10)
+		result2 = self.findEventsForTemplatesAndWait([tmpl], num_events=10)
+		self.assertEqual(2, len(result1))
+		self.assertEqual([ev.id for ev in result1], [ev.id for ev in result2])
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+		# A different query isn't answered from the cache
+		self.findEventsForTemplatesAndWait([tmpl], num_events=1)
+		self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+		# Inserting a matching event drops the cached results
+		event = new_event(interpretation="stfu:OpenEvent",
+			subject_uri="file:///tmp/query-cache")
+		self.insertEventsAndWait([event])
+		self.waitForCacheInvalidation(cache)
+		self.assertEqual(2, cache.invalidations)
+
+		result3 = self.findEventsForTemplatesAndWait([tmpl], num_events=10)
+		self.assertEqual(3, len(result3))
+		self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+	def testQueryCacheDeleteEvents(self):
+		ids = import_events("test/data/five_events.js", self)
+		cache = self.client.enable_query_cache()
+
+		result1 = self.findEventIdsAndWait([], num_events=10)
+		self.assertEqual(sorted(result1), sorted(ids))
+
+		self.deleteEventsAndWait([ids[0]])
+		self.waitForCacheInvalidation(cache)
+
+		result2 = self.findEventIdsAndWait([], num_events=10)
+		self.assertEqual(sorted(result2), sorted(ids[1:]))
+		self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+	def testQueryCacheRemovesMonitors(self):
+		import_events("test/data/five_events.js", self)
+		cache = self.client.enable_query_cache()
+		tmpl = Event.new_for_values(interpretation="stfu:OpenEvent")
+		bus = get_bus()
+		monitors = lambda: bus.list_exported_child_objects(
+			"/org/gnome/zeitgeist/monitor")
+		initial = len(monitors())
+
+		for i in range(10):
+			self.findEventsForTemplatesAndWait([tmpl], num_events=10)
+			event = new_event(interpretation="stfu:OpenEvent",
+				subject_uri="file:///tmp/query-cache-%d" % i)
+			self.insertEventsAndWait([event])
+			self.waitForCacheInvalidation(cache)
+		self.assertEqual(10, cache.invalidations)
+
+		# The monitors of the dropped entries are unexported once the
+		# engine confirms their removal
+		mainloop = self.create_mainloop()
+		def check_monitors():
+			if len(monitors()) <= initial:
+				mainloop.quit()
+				return False
+			return True
+		GLib.timeout_add(10, check_monitors)
+		mainloop.run()
+		self.assertEqual(initial, len(monitors()))
+
+	def testQueryCacheIgnoresStorageState(self):
+		import_events("test/data/five_events.js", self)
+		cache = self.client.enable_query_cache()
+		for i in range(2):
+			self.findEventIdsAndWait([], num_events=10,
+				storage_state=StorageState.Available)
+		self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 0, 0))
+
+	def testEventCache(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		cache = self.client.enable_event_cache()
+
+		result1 = self.getEventsAndWait(ids[:3])
+		self.assertEqual((cache.hits, cache.misses), (0, 3))
+		result2 = self.getEventsAndWait(list(reversed(ids)))
+		self.assertEqual((cache.hits, cache.misses), (3, 5))
+		self.assertEqual([ev.id for ev in result2], list(reversed(ids)))
+		for retrieved, event in zip(result2, reversed(events)):
+			self.assertEventsEqual(retrieved, event)
+
+		# Deleted events are dropped from the cache
+		self.deleteEventsAndWait([ids[0]])
+		mainloop = self.create_mainloop()
+		def check_cache():
+			if ids[0] not in cache:
+				mainloop.quit()
+				return False
+			return True
+		GLib.timeout_add(10, check_cache)
+		mainloop.run()
+		result3 = self.getEventsAndWait(ids[:2])
+		self.assertEqual(result3[0], None)
+		self.assertEqual(result3[1].id, ids[1])
+
 if __name__ == "__main__":
 	unittest.main()
 
@@ -24,10 +24,18 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import io
+import os
 import signal
+from unittest import mock
 
+from zeitgeist import client, mimetypes
+from zeitgeist.client import (AsyncZeitgeistClient, LazyEventList,
+	ZeitgeistDBusInterface)
 from zeitgeist.datamodel import (Event, Subject, Interpretation, Manifestation,
-	TimeRange, StorageState, DataSource, NULL_EVENT, ResultType)
+	TimeRange, StorageState, DataSource, NULL_EVENT, ResultType, EventRecord,
+	TemplateMatcher, EventBatch, TimeRangeSet, EventFactory)
 
 import testutils
 from dbus.exceptions import DBusException
@@ -55,11 +63,105 @@ class ZeitgeistRemoteAPITest(testutils.RemoteTestCase):
 
 	def testGetEvents(self):
 		events = parse_events("test/data/five_events.js")
-		ids = self.insertEventsAndWait(events) + [1000, 2000]
+		ids = self.insertEventsAndWait(events)
+		ids += [max(ids) + 1000, max(ids) + 2000]
 		result = self.getEventsAndWait(ids)
 		self.assertEqual(len([_f for _f in result if _f]), len(events))
 		self.assertEqual(len([event for event in result if event is None]), 2)
 
+	def testGetEventsLazy(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		ids += [max(ids) + 1000]
+		mainloop = self.create_mainloop()
+		result = []
+
+		def collect_and_quit(events):
+			result.append(events)
+			mainloop.quit()
+
+		self.client.get_events(ids, collect_and_quit)
+		mainloop.run()
+
+		lazy = result[0]
+		self.assertTrue(isinstance(lazy, LazyEventList))
+		self.assertEqual(6, len(lazy))
+		self.assertEqual(ids[2], lazy[2].id)
+		self.assertEqual(None, lazy[-1])
+		self.assertEqual([ids[3], ids[4]], [ev.id for ev in lazy[3:5]])
+		self.assertEqual(ids[:5], [ev.id for ev in lazy if ev])
+		self.assertEqual(list(lazy), lazy)
+		# Raw structs never leak out, not even through C-level list code
+		self.assertFalse(isinstance(lazy, list))
+		self.assertTrue(all(isinstance(ev, Event) for ev in [] + lazy[:5]))
+
+	def testGetEventsInternsSymbols(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		retrieved = self.getEventsAndWait(ids)
+		# Equal strings decoded from different events are the same object
+		seen = {}
+		values = []
+		for event in retrieved:
+			subject = event.subjects[0]
+			values.extend((event.interpretation, subject.storage,
+				subject.mimetype))
+		for value in values:
+			self.assertIs(seen.setdefault(value, value), value)
+		# Make sure that some of the values did repeat
+		self.assertTrue(len(values) > len(seen))
+
+	def testDumpManyLoadMany(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		retrieved = self.getEventsAndWait(ids + [max(ids) + 1000])
+
+		buf = io.BytesIO()
+		Event.dump_many(retrieved, buf)
+		buf.seek(0)
+		loaded = Event.load_many(buf)
+		self.assertEqual(None, loaded[5])
+		for original, event in zip(retrieved[:5], loaded[:5]):
+			self.assertEventsEqual(original, event)
+
+	def testEventFactory(self):
+		factory = EventFactory(("timestamp", "interpretation", "actor",
+			"subject_uri", "subject_mimetype", "payload"), ("uri", "text"))
+		events = factory.new_events([(100 + i, Interpretation.ACCESS_EVENT,
+			"application://gedit", "file:///tmp/%d.txt" % i, "text/plain", "")
+			for i in range(3)])
+		ids = self.insertEventsAndWait(events)
+		for event, retrieved in zip(events, self.getEventsAndWait(ids)):
+			self.assertEventsEqual(event, retrieved)
+
+	def testClassifySubjects(self):
+		subjects = [
+			Subject.new_for_values(uri="file:///tmp/a.odt",
+				mimetype="application/vnd.oasis.opendocument.text"),
+			Subject.new_for_values(uri="https://example.org/",
+				mimetype="image/x-foo"),
+		]
+		mimetypes.classify_subjects(subjects)
+		event = Event.new_for_values(subjects=subjects)
+		ids = self.insertEventsAndWait([event])
+		self.assertEventsEqual(event, self.getEventsAndWait(ids)[0])
+
+	def testEventRecords(self):
+		events = parse_events("test/data/five_events.js")
+		records = [EventRecord.new_for_struct(event) for event in events]
+		ids = self.insertEventsAndWait(records)
+		self.assertEqual(5, len(ids))
+
+		retrieved = self.getEventsAndWait(ids)
+		for record, event in zip(records, retrieved):
+			self.assertEventsEqual(record.to_event(), event)
+
+		tmpl = EventRecord.new_for_struct(
+			Event.new_for_values(interpretation="stfu:OpenEvent"))
+		result = self.findEventIdsAndWait([tmpl], num_events=0)
+		self.assertEqual(2, len(result))
+		self.assertEqual(2, len([r for r in records if r.matches_template(tmpl)]))
+
 	def testInsertAndDeleteEvent(self):
 		# Insert an event
 		events = parse_events("test/data/single_event.js")
@@ -105,6 +207,111 @@ class ZeitgeistRemoteAPITest(testutils.RemoteTestCase):
 		self.assertEqual(retrieved_events[0], None)
 		self.assertEventsEqual(retrieved_events[1], event2)
 
+	def testBatchedInsert(self):
+		events = parse_events("test/data/five_events.js")
+		mainloop = self.create_mainloop()
+		result = []
+
+		def collect_ids(ids):
+			result.append(ids)
+			if len(result) == len(events):
+				mainloop.quit()
+
+		self.client.enable_insert_batching(max_events=100, max_delay=50)
+		for event in events:
+			self.client.insert_event(event, ids_reply_handler=collect_ids)
+		mainloop.run()
+		self.client.close()
+
+		# Every caller got exactly its own id
+		self.assertEqual([len(ids) for ids in result], [1] * len(events))
+		ids = [ids[0] for ids in result]
+		self.assertEqual(len(set(ids)), len(events))
+		retrieved_events = self.getEventsAndWait(ids)
+		for retrieved, event in zip(retrieved_events, events):
+			self.assertEventsEqual(retrieved, event)
+
+	def testBatchedInsertFlush(self):
+		events = parse_events("test/data/three_events.js")
+		mainloop = self.create_mainloop()
+		result = []
+
+		def collect_ids(ids):
+			result.extend(ids)
+			mainloop.quit()
+
+		# With a huge delay, only flush() gets the events out in time
+		self.client.enable_insert_batching(max_events=100, max_delay=60000)
+		self.client.insert_events(events, ids_reply_handler=collect_ids)
+		self.client.flush()
+		mainloop.run()
+		self.assertEqual(len(result), len(events))
+
+	def testBatchedInsertInvalidEvent(self):
+		events = parse_events("test/data/three_events.js")
+		invalid = Event.new_for_values(timestamp=123,
+			subjects=[Subject.new_for_values(uri="file:///invalid")])
+		mainloop = self.create_mainloop()
+		result = {}
+
+		def store(key, value):
+			result[key] = value
+			if len(result) == 2:
+				mainloop.quit()
+
+		# Both batches go out in a single call, which the engine rejects
+		# because of the incomplete event; only its sender gets an error
+		self.client.enable_insert_batching(max_events=100, max_delay=60000)
+		self.client.insert_events(events,
+			ids_reply_handler=lambda ids: store("valid", ids),
+			error_handler=lambda error: store("valid", error))
+		self.client.insert_events([invalid],
+			ids_reply_handler=lambda ids: store("invalid", ids),
+			error_handler=lambda error: store("invalid", error))
+		self.client.flush()
+		mainloop.run()
+
+		self.assertIsInstance(result["invalid"], DBusException)
+		self.assertEqual(len(result["valid"]), len(events))
+		retrieved_events = self.getEventsAndWait(result["valid"])
+		for retrieved, event in zip(retrieved_events, events):
+			self.assertEventsEqual(retrieved, event)
+
+	def testIterEvents(self):
+		events = parse_events("test/data/twenty_events.js")
+		self.insertEventsAndWait(events)
+		expected = self.findEventIdsAndWait([], num_events=0)
+		result = list(self.client.iter_events([], page_size=3))
+		self.assertEqual([event.id for event in result], expected)
+
+	def testGather(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.insertEventsAndWait(events)
+		mainloop = self.create_mainloop()
+		result = []
+
+		def collect_and_quit(results, errors):
+			result.extend([results, errors])
+			mainloop.quit()
+
+		tmpl = Event.new_for_values(interpretation="stfu:OpenEvent")
+		self.client.gather([
+			("find_event_ids_for_templates", ([],), {"num_events": 0}),
+			("find_events_for_templates", ([tmpl],)),
+			("get_events", (ids[:2],)),
+			("find_events_for_templates", ("not a template list",)),
+		], collect_and_quit, timeout=5000)
+		mainloop.run()
+
+		results, errors = result
+		self.assertEqual(4, len(results))
+		self.assertEqual(sorted(ids), sorted(results[0]))
+		self.assertEqual(2, len(results[1]))
+		self.assertEqual(ids[:2], [ev.id for ev in results[2]])
+		self.assertEqual(None, results[3])
+		self.assertEqual([None, None, None], errors[:3])
+		self.assertTrue(isinstance(errors[3], TypeError))
+
 class ZeitgeistRemoteAPITestAdvanced(testutils.RemoteTestCase):
 
 	def testFindTwoOfThreeEvents(self):
@@ -277,6 +484,9 @@ class ZeitgeistRemoteFindEventIdsTest(testutils.RemoteTestCase):
 	tearDownClass to speed up test execution.
 	"""
 
+	# The tests expect the events to get the ids 1 to 5
+	reuse_daemon = False
+
 	def setUp(self):
 		super(ZeitgeistRemoteFindEventIdsTest, self).setUp()
 		
@@ -491,6 +701,80 @@ class ZeitgeistRemoteFindEventIdsTest(testutils.RemoteTestCase):
 		ids = self.findEventIdsAndWait([tmpl], storage_state=StorageState.Available)
 		self.assertEqual(ids, [6])
 
+	def testTemplateMatcherAgreesWithEngine(self):
+		events = self.getEventsAndWait(self.ids)
+		templates = [
+			Event.new_for_values(interpretation="stfu:OpenEvent"),
+			Event.new_for_values(subject_uri="http://*"),
+			Event.new_for_values(subject_uri="!file:///tmp/foo.txt"),
+			Event.new_for_values(actor="!firefox"),
+			Event.new_for_values(subjects=[
+				Subject.new_for_values(uri="file:///tmp/foo.txt"),
+				Subject.new_for_values(mimetype="text/*")]),
+		]
+		for template in templates:
+			matcher = TemplateMatcher.compile([template])
+			expected = self.findEventIdsAndWait([template], num_events=0)
+			self.assertEqual(sorted(expected),
+				sorted(event.id for event in matcher.filter(events)))
+
+		matcher = TemplateMatcher.compile(templates[:2])
+		expected = self.findEventIdsAndWait(templates[:2], num_events=0)
+		self.assertEqual(sorted(expected),
+			sorted(event.id for event in events if matcher.match(event)))
+
+	def testTimeRangeSetAgreesWithEngine(self):
+		ranges = TimeRangeSet([(100, 125), (140, 149), (156, 160)])
+
+		expected = []
+		for time_range in ranges:
+			expected.extend(self.findEventIdsAndWait([],
+				timerange=time_range, num_events=0))
+		events = self.findEventsForTemplatesAndWait([], num_events=0,
+			result_type=ResultType.LeastRecentEvents)
+		timestamps = [int(event.timestamp) for event in events]
+		self.assertEqual(sorted(expected), sorted(event.id
+			for part in ranges.slices(timestamps) for event in events[part]))
+		batch = EventBatch.from_events(events)
+		self.assertEqual(sorted(expected),
+			sorted(batch.select(batch.time_range_mask(ranges)).ids))
+
+	def testEventBatchAgreesWithEngine(self):
+		events = self.findEventsForTemplatesAndWait([], num_events=0)
+		batch = EventBatch.from_events(events)
+		self.assertEqual(len(events), len(batch))
+		for event, converted in zip(events, batch.to_events()):
+			self.assertEventsEqual(event, converted)
+
+		def ids_for_mask(mask):
+			return sorted(batch.select(mask).ids)
+
+		def ids_for_template(**values):
+			template = Event.new_for_values(**values)
+			return sorted(self.findEventIdsAndWait([template], num_events=0))
+
+		self.assertEqual(ids_for_mask(batch.equals_mask("actor", "firefox")),
+			ids_for_template(actor="firefox"))
+		self.assertEqual(
+			ids_for_mask(batch.prefix_mask("subject_uri", "file:///tmp/")),
+			ids_for_template(subject_uri="file:///tmp/*"))
+		self.assertEqual(
+			ids_for_mask(batch.mask_not(
+				batch.equals_mask("subject_mimetype", "text/plain"))),
+			ids_for_template(subject_mimetype="!text/plain"))
+		self.assertEqual(
+			ids_for_mask(batch.mask_and(
+				batch.time_range_mask(TimeRange(130, 150)),
+				batch.prefix_mask("subject_uri", "file://"))),
+			sorted(self.findEventIdsAndWait(
+				[Event.new_for_values(subject_uri="file://*")],
+				timerange=TimeRange(130, 150), num_events=0)))
+
+		counts = batch.count_by("actor")
+		self.assertEqual(len(events), sum(counts.values()))
+		self.assertEqual(len(ids_for_template(actor="firefox")),
+			counts["firefox"])
+
 class ZeitgeistRemoteInterfaceTest(testutils.RemoteTestCase):
 
 	def testQuit(self):
@@ -526,6 +810,78 @@ class ZeitgeistRemotePropertiesTest(testutils.RemoteTestCase):
 	def testVersion(self):
 		self.assertTrue(len(self.client.get_version()) >= 2)
 
+	def testStaleIntrospectionCache(self):
+		# RemoteTestCase points XDG_CACHE_HOME at the temporary data path
+		cache = client._IntrospectionCache()
+		self.assertEqual(cache.get(ZeitgeistDBusInterface.BUS_NAME,
+			ZeitgeistDBusInterface.OBJECT_PATH,
+			ZeitgeistDBusInterface.INTERFACE_NAME), None)
+		# Pretend an older engine without GetEvents was introspected
+		cache.set(ZeitgeistDBusInterface.BUS_NAME,
+			ZeitgeistDBusInterface.OBJECT_PATH,
+			ZeitgeistDBusInterface.INTERFACE_NAME, ["InsertEvents"], [])
+		for patcher in (
+				mock.patch.object(client, "_introspection_cache",
+					client._IntrospectionCache()),
+				mock.patch.object(ZeitgeistDBusInterface,
+					"_ZeitgeistDBusInterface__shared_state", {})):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+		self.client = client.ZeitgeistClient()
+
+		ids = import_events("test/data/single_event.js", self)
+		self.assertEqual(len(self.getEventsAndWait(ids)), 1)
+		self.assertRaises(TypeError, getattr, self.client._iface,
+			"NoSuchMethod")
+		methods, signals = client._IntrospectionCache().get(
+			ZeitgeistDBusInterface.BUS_NAME,
+			ZeitgeistDBusInterface.OBJECT_PATH,
+			ZeitgeistDBusInterface.INTERFACE_NAME)
+		self.assertTrue("GetEvents" in methods)
+
+class ZeitgeistAsyncClientTest(testutils.RemoteTestCase):
+
+	def setUp(self):
+		super(ZeitgeistAsyncClientTest, self).setUp()
+		self.async_client = AsyncZeitgeistClient()
+
+	def testInsertAndGetEvents(self):
+		events = parse_events("test/data/five_events.js")
+		ids = self.runAsyncAndWait(self.async_client.insert_events(events))
+		self.assertEqual(len(ids), len(events))
+		result = self.runAsyncAndWait(
+			self.async_client.get_events(list(ids) + [max(ids) + 1000]))
+		self.assertEqual(len(result), len(events) + 1)
+		for retrieved, event in zip(result, events):
+			self.assertEventsEqual(retrieved, event)
+		self.assertEqual(result[-1], None)
+
+	def testConcurrentQueries(self):
+		import_events("test/data/five_events.js", self)
+		async def run_queries():
+			return await asyncio.gather(*[
+				self.async_client.find_event_ids_for_templates([],
+					num_events=i % 5 + 1)
+				for i in range(200)])
+		results = self.runAsyncAndWait(run_queries())
+		self.assertEqual(len(results), 200)
+		for i, ids in enumerate(results):
+			self.assertEqual(len(ids), i % 5 + 1)
+
+	def testIterEvents(self):
+		import_events("test/data/twenty_events.js", self)
+		expected = self.findEventIdsAndWait([], num_events=0)
+		async def collect_ids():
+			return [event.id async for event in
+				self.async_client.iter_events([], page_size=7)]
+		self.assertEqual(self.runAsyncAndWait(collect_ids()), expected)
+
+	def testDeleteEvents(self):
+		ids = import_events("test/data/single_event.js", self)
+		self.runAsyncAndWait(self.async_client.delete_events(ids))
+		result = self.runAsyncAndWait(self.async_client.get_events(ids))
+		self.assertEqual(result, [None])
+
 
 if __name__ == "__main__":
 	testutils.run()
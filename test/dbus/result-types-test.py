@@ -267,21 +267,21 @@ class ResultTypeTest(testutils.RemoteTestCase):
 			new_event(timestamp=3, actor="bar", subject_uri="tmp/boo"),
 			new_event(timestamp=4, actor="baz", subject_uri="tmp/boo"),
 		]
-		self.insertEventsAndWait(events)
+		inserted = self.insertEventsAndWait(events)
 
 		# Get the least recent actors
 		ids = self.findEventIdsAndWait([],
 			num_events = 0,
 			result_type = ResultType.OldestActor)
 		events = self.getEventsAndWait(ids)
-		self.assertEqual(list(ids), [1, 3, 4])
+		self.assertEqual(list(ids), [inserted[0], inserted[2], inserted[3]])
 
 		# Get the least recent actors for "home/boo"
 		template = Event.new_for_values(subject_uri="home/boo")
 		ids = self.findEventIdsAndWait([template],
 			num_events = 0,
 			result_type = ResultType.OldestActor)
-		self.assertEqual(list(ids), [2])
+		self.assertEqual(list(ids), [inserted[1]])
 
 		# Let's also try the same with MostRecentActor... Although there
 		# should be no problem here.
@@ -289,7 +289,7 @@ class ResultTypeTest(testutils.RemoteTestCase):
 		ids = self.findEventIdsAndWait([template],
 			num_events = 0,
 			result_type = ResultType.OldestActor)
-		self.assertEqual(list(ids), [2])
+		self.assertEqual(list(ids), [inserted[1]])
 
 	def testResultTypesOldestActor(self):
 		import_events("test/data/twenty_events.js", self)
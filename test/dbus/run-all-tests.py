@@ -24,9 +24,15 @@
 import os
 import unittest
 import logging
+import json
+import random
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 
-from optparse import OptionParser
+from optparse import OptionParser, SUPPRESS_HELP
 
 if not os.path.isfile("NEWS"):
     print("*** Please run from root directory.", file=sys.stderr)
@@ -68,22 +74,176 @@ def load_tests(module, pattern):
 		else:
 			yield test
 
-def compile_suite(pattern=None):
+def get_test_modules():
+	# All of the files that end with "-test.py", without the ".py"
+	return sorted(fname[:-3] for fname in os.listdir(TESTDIR)
+		if fname.endswith("-test.py"))
+
+def compile_suite(pattern=None, modules=None):
 	# Create a test suite to run all tests
 	suite = unittest.TestSuite()
 
-	# Add all of the tests from each file that ends with "-test.py"
-	for fname in os.listdir(TESTDIR):
-		if fname.endswith("-test.py"):
-			fname = os.path.basename(fname)[:-3] # filename without the ".py"
-			module = __import__(fname)
-			tests = list(load_tests(module, pattern))
-			suite.addTests(tests)
+	# Add all of the tests from each test module
+	for fname in modules or get_test_modules():
+		module = __import__(fname)
+		tests = list(load_tests(module, pattern))
+		suite.addTests(tests)
 	return suite
 
+class TimedTestResult(unittest.TextTestResult):
+	"""
+	Test result which also keeps the outcome and duration of every test,
+	in a form which can be passed on from a worker process
+	"""
+
+	def __init__(self, *args, **kwargs):
+		super(TimedTestResult, self).__init__(*args, **kwargs)
+		self.records = []
+		self._started = None
+
+	def startTest(self, test):
+		self._started = time.time()
+		super(TimedTestResult, self).startTest(test)
+
+	def _record(self, test, outcome, details=""):
+		# Errors in class or module fixtures aren't reported on a test
+		if hasattr(test, "_testMethodName"):
+			name = get_test_name(test)
+		else:
+			name = test.id()
+		duration = time.time() - self._started if self._started else 0.0
+		self.records.append((name, outcome, duration, details))
+
+	def addSuccess(self, test):
+		super(TimedTestResult, self).addSuccess(test)
+		self._record(test, "ok")
+
+	def addFailure(self, test, err):
+		super(TimedTestResult, self).addFailure(test, err)
+		self._record(test, "FAIL", self._exc_info_to_string(err, test))
+
+	def addError(self, test, err):
+		super(TimedTestResult, self).addError(test, err)
+		self._record(test, "ERROR", self._exc_info_to_string(err, test))
+
+	def addSkip(self, test, reason):
+		super(TimedTestResult, self).addSkip(test, reason)
+		self._record(test, "skipped", reason)
+
+	def addExpectedFailure(self, test, err):
+		super(TimedTestResult, self).addExpectedFailure(test, err)
+		self._record(test, "expected failure")
+
+	def addUnexpectedSuccess(self, test):
+		super(TimedTestResult, self).addUnexpectedSuccess(test)
+		self._record(test, "unexpected success")
+
+def shard_modules(modules, jobs, pattern=None):
+	"""
+	Split the test modules in up to `jobs` shards with roughly the same
+	number of tests, assigning the biggest modules first
+	"""
+	sizes = dict((module, len(list(load_tests(__import__(module), pattern))))
+		for module in modules)
+	shards = [[] for i in range(min(jobs, len(modules)))]
+	loads = [0] * len(shards)
+	for module in sorted(modules, key=sizes.get, reverse=True):
+		if not sizes[module]:
+			continue
+		i = loads.index(min(loads))
+		shards[i].append(module)
+		loads[i] += sizes[module]
+	return [shard for shard in shards if shard]
+
+def run_parallel(jobs, pattern, verbosity):
+	"""
+	Run the test modules in `jobs` worker processes, each one with its
+	own private bus and data path, and print a merged report
+	"""
+	shards = shard_modules(get_test_modules(), jobs, pattern)
+	# Every worker needs its own X display for its private bus
+	first_display = random.randint(100, 900)
+	workers = []
+	started = time.time()
+	for i, shard in enumerate(shards):
+		workdir = tempfile.mkdtemp(prefix="zeitgeist.worker.")
+		env = os.environ.copy()
+		env.update({
+			"TMPDIR": workdir,
+			"ZEITGEIST_DATA_PATH": workdir,
+		})
+		cmd = [sys.executable, os.path.abspath(__file__),
+			"--worker-results", os.path.join(workdir, "results.json"),
+			"--display", str(first_display + i)]
+		cmd.extend("--module=%s" % module for module in shard)
+		cmd.extend(["-v"] * (verbosity or 0))
+		cmd.extend(pattern or [])
+		log = open(os.path.join(workdir, "worker.log"), "w")
+		process = subprocess.Popen(cmd, env=env, stdout=log,
+			stderr=subprocess.STDOUT)
+		workers.append((process, shard, workdir, log))
+		print("*** Worker %d is running %s" % (i + 1, ", ".join(shard)),
+			file=sys.stderr)
+
+	records = []
+	for process, shard, workdir, log in workers:
+		process.wait()
+		log.close()
+		try:
+			with open(os.path.join(workdir, "results.json")) as f:
+				records.extend(tuple(record) for record in json.load(f))
+		except (IOError, ValueError):
+			with open(os.path.join(workdir, "worker.log")) as f:
+				output = f.read()
+			records.append((", ".join(shard), "ERROR", 0.0,
+				"Worker exited with code %s without results:\n%s" \
+				% (process.returncode, output)))
+		if 'ZEITGEIST_TESTS_KEEP_TMP' in os.environ:
+			print("*** Worker files have been preserved in %s" % workdir,
+				file=sys.stderr)
+		else:
+			shutil.rmtree(workdir)
+	return print_report(records, time.time() - started, len(workers))
+
+def print_report(records, elapsed, workers):
+	records.sort()
+	for name, outcome, duration, details in records:
+		print("%s ... %s (%.3fs)" % (name, outcome, duration))
+	failed = [record for record in records
+		if record[1] in ("FAIL", "ERROR")]
+	for name, outcome, duration, details in failed:
+		print("=" * 70)
+		print("%s: %s" % (outcome, name))
+		print("-" * 70)
+		print(details)
+	print("-" * 70)
+	print("Slowest tests:")
+	for name, outcome, duration, details in sorted(records,
+			key=lambda record: record[2], reverse=True)[:10]:
+		print("  %8.3fs %s" % (duration, name))
+	print("-" * 70)
+	print("Ran %d tests in %.3fs using %d workers" \
+		% (len(records), elapsed, workers))
+	if failed:
+		print("\nFAILED (failures=%d, errors=%d)" % (
+			len([record for record in failed if record[1] == "FAIL"]),
+			len([record for record in failed if record[1] == "ERROR"])))
+	else:
+		print("\nOK")
+	return not failed
+
 if __name__ == "__main__":
 	parser = OptionParser()
 	parser.add_option("-v", action="count", dest="verbosity")
+	parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+		help="run the test modules in JOBS parallel processes, "
+			"0 for one per CPU")
+	parser.add_option("--worker-results", dest="worker_results",
+		help=SUPPRESS_HELP)
+	parser.add_option("--display", type="int", dest="display",
+		help=SUPPRESS_HELP)
+	parser.add_option("--module", action="append", dest="modules",
+		help=SUPPRESS_HELP)
 	(options, args) = parser.parse_args()
 
 	if options.verbosity:
@@ -94,8 +254,18 @@ if __name__ == "__main__":
 	else:
 		logging.basicConfig(filename="/dev/null")
 	
+	os.environ["ZEITGEIST_DEFAULT_EXTENSIONS"] = \
+		"_zeitgeist.engine.extensions.blacklist.Blacklist," \
+		"_zeitgeist.engine.extensions.datasource_registry.DataSourceRegistry"
+	jobs = options.jobs or os.cpu_count() or 1
+	if jobs > 1 and not options.worker_results:
+		success = run_parallel(jobs, args or None, options.verbosity)
+		raise SystemExit(0 if success else 1)
+
 	from testutils import DBusPrivateMessageBus
 	bus = DBusPrivateMessageBus()
+	if options.display is not None:
+		bus.DISPLAY = ":%d" % options.display
 	err = bus.run(ignore_errors=True)
 	if err:
 		print("*** Failed to setup private bus, error was: %s" %err, file=sys.stderr)
@@ -106,12 +276,13 @@ if __name__ == "__main__":
 		config.update({"DISPLAY": bus.DISPLAY, "pid.Xvfb": bus.display.pid})
 		print("*** Configuration: %s" %config, file=sys.stderr)
 	try:
-		os.environ["ZEITGEIST_DEFAULT_EXTENSIONS"] = \
-			"_zeitgeist.engine.extensions.blacklist.Blacklist," \
-			"_zeitgeist.engine.extensions.datasource_registry.DataSourceRegistry"
-		suite = compile_suite(args or None)
+		suite = compile_suite(args or None, options.modules)
 		# Run all of the tests
-		unittest.TextTestRunner(stream=sys.stdout, verbosity=2).run(suite)
+		result = unittest.TextTestRunner(stream=sys.stdout, verbosity=2,
+			resultclass=TimedTestResult).run(suite)
+		if options.worker_results:
+			with open(options.worker_results, "w") as f:
+				json.dump(result.records, f)
 	finally:
 		bus.quit(ignore_errors=True)
 
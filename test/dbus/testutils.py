@@ -20,6 +20,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import unittest
 import dbus
 import os
@@ -29,8 +30,10 @@ import signal
 import tempfile
 import shutil
 import random
+import atexit
 import gi
 from subprocess import Popen, PIPE
+from unittest import mock
 
 # DBus setup
 from gi.repository import GLib
@@ -39,10 +42,11 @@ DBusGMainLoop(set_as_default=True)
 
 # Import local Zeitgeist modules
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import zeitgeist.client
 from zeitgeist.client import ZeitgeistDBusInterface, ZeitgeistClient, \
 	get_bus, _set_bus
 from zeitgeist.datamodel import Event, Subject, Interpretation, Manifestation, \
-	TimeRange, NULL_EVENT
+	TimeRange, NULL_EVENT, StorageState, ResultType
 
 # Json handling is special in Python 2.5...
 try:
@@ -77,7 +81,15 @@ def dict2event(d):
 	return ev
 	
 def parse_events(path):
-	with open(path) as f:
+	"""
+	Return the events in `path`, which is either a JSON file like the
+	ones in test/data or an event dump written by Event.dump_many
+	"""
+	with open(path, "rb") as f:
+		is_json = f.read(64).lstrip()[:1] == b"["
+		f.seek(0)
+		if not is_json:
+			return Event.load_many(f)
 		data = json.load(f)
 	events = list(map(dict2event, data))
 	return events
@@ -134,12 +146,65 @@ def asyncTestMethod(mainloop):
 		return new_f
 	return wrap
 
+class _DaemonPool(object):
+	"""
+	Keeps the daemon of the last test running once it is done, so that
+	the next test from the same module can reuse it instead of waiting for
+	a new one to start. There can only be a single daemon on the bus, so
+	it is stopped as soon as any other test needs a daemon.
+	"""
+	
+	def __init__(self):
+		self._owner = None
+		self._daemon = None
+		self._env = None
+		self._datapath = None
+	
+	def take(self, owner):
+		"""
+		Return the (daemon, env, datapath) kept for `owner`, if it is
+		still running, or None after stopping any other daemon
+		"""
+		if self._daemon is not None and self._owner == owner \
+				and self._daemon.poll() is None:
+			daemon = (self._daemon, self._env, self._datapath)
+			self._daemon = None
+			return daemon
+		self.stop()
+		return None
+	
+	def put(self, owner, daemon, env, datapath):
+		self.stop()
+		self._owner = owner
+		self._daemon = daemon
+		self._env = env
+		self._datapath = datapath
+	
+	def stop(self):
+		if self._daemon is None:
+			return
+		if self._daemon.poll() is None:
+			os.kill(self._daemon.pid, signal.SIGKILL)
+			self._daemon.wait()
+		RemoteTestCase._remove_datapath(self._datapath)
+		self._daemon = None
+
+_daemon_pool = _DaemonPool()
+atexit.register(_daemon_pool.stop)
+
 class RemoteTestCase (unittest.TestCase):
 	"""
 	Helper class to implement unit tests against a
 	remote Zeitgeist process
+	
+	Consecutive tests from the same module share a daemon, which is reset
+	to an empty log in between. Test cases which need a daemon of their
+	own, for example because they expect specific event ids (which keep
+	growing on a shared daemon), must set `reuse_daemon` to False.
 	"""
 	
+	reuse_daemon = True
+	
 	@staticmethod
 	def _get_pid(matching_string):
 		p1 = Popen(["pgrep", "-x", "zeitgeist-daemo"], stdout=PIPE, stderr=PIPE)
@@ -152,16 +217,20 @@ class RemoteTestCase (unittest.TestCase):
 		return pid_line
 		
 	@staticmethod
-	def _safe_start_subprocess(cmd, env, timeout=1, error_callback=None):
-		""" starts `cmd` in a subprocess and check after `timeout`
-		if everything goes well"""
+	def _safe_start_subprocess(cmd, env, timeout=1, error_callback=None,
+		ready_callback=None):
+		""" starts `cmd` in a subprocess and check after `timeout`, or
+		as soon as `ready_callback` returns, if everything goes well"""
 		args = { 'env': env }
 		if not '--verbose-subprocess' in sys.argv:
 			args['stderr'] = PIPE
 			args['stdout'] = PIPE
 		process = Popen(cmd, **args)
 		# give the process some time to wake up
-		time.sleep(timeout)
+		if ready_callback:
+			ready_callback(process, timeout)
+		else:
+			time.sleep(timeout)
 		error = process.poll()
 		if error:
 			cmd = " ".join(cmd)
@@ -172,7 +241,25 @@ class RemoteTestCase (unittest.TestCase):
 		return process
 		
 	@staticmethod
-	def _safe_start_daemon(env=None, timeout=1):
+	def _wait_for_daemon(process, timeout):
+		""" waits until `process` owns the Zeitgeist bus name, or exits,
+		for at most `timeout` seconds """
+		bus_object = dbus.SessionBus().get_object("org.freedesktop.DBus",
+			"/org/freedesktop/DBus")
+		deadline = time.time() + timeout
+		while time.time() < deadline and process.poll() is None:
+			try:
+				pid = bus_object.GetConnectionUnixProcessID(
+					ZeitgeistDBusInterface.BUS_NAME,
+					dbus_interface="org.freedesktop.DBus")
+				if pid == process.pid:
+					return
+			except dbus.exceptions.DBusException:
+				pass
+			time.sleep(0.01)
+	
+	@staticmethod
+	def _safe_start_daemon(env=None, timeout=10):
 		if env is None:
 			env = os.environ.copy()
 			
@@ -186,7 +273,15 @@ class RemoteTestCase (unittest.TestCase):
 			
 		return RemoteTestCase._safe_start_subprocess(
 			("./src/zeitgeist-daemon", "--no-datahub", "--log-level=DEBUG"),
-			env, timeout, error_callback)
+			env, timeout, error_callback, RemoteTestCase._wait_for_daemon)
+	
+	@staticmethod
+	def _remove_datapath(datapath):
+		if 'ZEITGEIST_TESTS_KEEP_TMP' in os.environ:
+			print('\n\nAll temporary files have been preserved in %s\n' \
+				% datapath)
+		else:
+			shutil.rmtree(datapath)
 	
 	def __init__(self, methodName):
 		super(RemoteTestCase, self).__init__(methodName)
@@ -203,35 +298,81 @@ class RemoteTestCase (unittest.TestCase):
 	def setUp(self, database_path=None):
 		assert self.daemon is None
 		assert self.client is None
-		self.env = os.environ.copy()
-		self.datapath = tempfile.mkdtemp(prefix="zeitgeist.datapath.")
-		self.env.update({
-			"ZEITGEIST_DATABASE_PATH": database_path or ":memory:",
-			"ZEITGEIST_DATA_PATH": self.datapath,
-			"XDG_CACHE_HOME": os.path.join(self.datapath, "cache"),
-		})
-		self.spawn_daemon()
-		
-		# hack to clear the state of the interface
-		ZeitgeistDBusInterface._ZeitgeistDBusInterface__shared_state = {}
-		
-		# Replace the bus connection with a private one for each test case,
-		# so that they don't share signals or other state
-		_set_bus(dbus.SessionBus(private=True))
-		get_bus().set_exit_on_disconnect(False)
+		# Daemons with a custom database are never shared
+		self._shared = self.reuse_daemon and database_path is None
+		if self._shared:
+			pooled = _daemon_pool.take(self.__module__)
+		else:
+			_daemon_pool.stop()
+			pooled = None
+		if pooled:
+			self.daemon, self.env, self.datapath = pooled
+		else:
+			self.env = os.environ.copy()
+			self.datapath = tempfile.mkdtemp(prefix="zeitgeist.datapath.")
+			self.env.update({
+				"ZEITGEIST_DATABASE_PATH": database_path or ":memory:",
+				"ZEITGEIST_DATA_PATH": self.datapath,
+				"XDG_CACHE_HOME": os.path.join(self.datapath, "cache"),
+			})
+			self.spawn_daemon()
 		
-		self.client = ZeitgeistClient()
+		try:
+			# The client caches introspection data as well; keep it in the
+			# temporary data path instead of the user's cache directory
+			for patcher in (
+					mock.patch.dict(os.environ,
+						{"XDG_CACHE_HOME": self.env["XDG_CACHE_HOME"]}),
+					mock.patch.object(zeitgeist.client, "_introspection_cache",
+						zeitgeist.client._IntrospectionCache())):
+				patcher.start()
+				self.addCleanup(patcher.stop)
+			
+			# hack to clear the state of the interface
+			ZeitgeistDBusInterface._ZeitgeistDBusInterface__shared_state = {}
+			
+			# Replace the bus connection with a private one for each test case,
+			# so that they don't share signals or other state
+			_set_bus(dbus.SessionBus(private=True))
+			get_bus().set_exit_on_disconnect(False)
+			
+			self.client = ZeitgeistClient()
+			if pooled:
+				self.reset_daemon()
+		except:
+			# tearDown isn't run if setUp fails, so don't leave the daemon
+			# around holding the bus name
+			if self.daemon.poll() is None:
+				self.kill_daemon()
+			self._remove_datapath(self.datapath)
+			raise
+	
+	def reset_daemon(self):
+		"""
+		Bring a reused daemon back to an empty log, by deleting all its
+		events and blacklist templates
+		"""
+		iface = self.client._iface
+		ids = iface.FindEventIds(TimeRange.always(), [], StorageState.Any,
+			0, ResultType.MostRecentEvents)
+		if ids:
+			iface.DeleteEvents(ids)
+		blacklist = dbus.Interface(get_bus().get_object(
+			ZeitgeistDBusInterface.BUS_NAME, "/org/gnome/zeitgeist/blacklist"),
+			"org.gnome.zeitgeist.Blacklist")
+		for template_id in list(blacklist.GetTemplates().keys()):
+			blacklist.RemoveTemplate(template_id)
 	
 	def tearDown(self):
 		assert self.daemon is not None
 		assert self.client is not None
 		get_bus().close()
+		if self._shared and self.daemon.poll() is None:
+			_daemon_pool.put(self.__module__, self.daemon, self.env,
+				self.datapath)
+			return
 		self.kill_daemon()
-		if 'ZEITGEIST_TESTS_KEEP_TMP' in os.environ:
-			print('\n\nAll temporary files have been preserved in %s\n' \
-				% self.datapath)
-		else:
-			shutil.rmtree(self.datapath)
+		self._remove_datapath(self.datapath)
 	
 	def insertEventsAndWait(self, events):
 		"""
@@ -369,6 +510,30 @@ class RemoteTestCase (unittest.TestCase):
 		mainloop.run()
 		return result
 	
+	@staticmethod
+	def runAsyncAndWait(coroutine, timeout=5):
+		"""
+		Run `coroutine` on a new asyncio event loop, iterating the GLib
+		main context meanwhile so that D-Bus replies get dispatched, and
+		return its result.
+		"""
+		context = GLib.MainContext.default()
+
+		async def wrapper():
+			task = asyncio.ensure_future(coroutine)
+			while not task.done():
+				while context.pending():
+					context.iteration(False)
+				await asyncio.sleep(0.001)
+			return task.result()
+
+		loop = asyncio.new_event_loop()
+		try:
+			return loop.run_until_complete(
+				asyncio.wait_for(wrapper(), timeout))
+		finally:
+			loop.close()
+
 	@staticmethod
 	def create_mainloop(timeout=5):
 		
@@ -0,0 +1,402 @@
+#! /usr/bin/env python3
+# -.- coding: utf-8 -.-
+
+# Zeitgeist - Build a synthetic activity database
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# #############################################################################
+# Writes an activity.sqlite with millions of events directly, without going
+# through D-Bus. The tables are created from the statements in
+# libzeitgeist/sql-schema.vala, so the result can be opened by the daemon
+# as it is:
+#
+#   tools/development/build_synthetic_database.py -n 10000000 activity.sqlite
+#   ZEITGEIST_DATABASE_PATH=activity.sqlite zeitgeist-daemon --replace
+#
+# The same options and seed always produce the same database.
+# #############################################################################
+
+import itertools
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+from optparse import OptionParser
+
+from zeitgeist.datamodel import Interpretation, Manifestation
+from zeitgeist.mimetypes import MIMES, get_interpretation_for_mimetype
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '../../libzeitgeist/sql-schema.vala')
+
+# Fixed default for the newest timestamp, so that fixtures are reproducible
+# (2013-01-01 00:00:00 UTC)
+DEFAULT_END = 1356998400000
+
+HOUR = 3600 * 1000
+DAY = 24 * HOUR
+
+# Relative activity for each hour of the day, and for each day of the week
+# (starting on Thursday, as the epoch did)
+HOURLY_WEIGHTS = (
+    0.3, 0.15, 0.1, 0.05, 0.05, 0.1, 0.3, 0.8, 2.0, 3.5, 4.0, 4.0,
+    2.5, 3.0, 4.0, 4.0, 3.5, 3.0, 2.0, 2.0, 2.5, 2.5, 1.5, 0.8)
+DAILY_WEIGHTS = (1.0, 0.9, 0.4, 0.35, 1.0, 1.0, 1.0)
+
+EVENT_INTERPRETATIONS = (
+    (Interpretation.ACCESS_EVENT, 45),
+    (Interpretation.LEAVE_EVENT, 30),
+    (Interpretation.MODIFY_EVENT, 12),
+    (Interpretation.CREATE_EVENT, 5),
+    (Interpretation.SEND_EVENT, 2),
+    (Interpretation.RECEIVE_EVENT, 2),
+    (Interpretation.MOVE_EVENT, 1),
+    (Interpretation.DELETE_EVENT, 1),
+    (Interpretation.ACCEPT_EVENT, 0.5),
+    (Interpretation.DENY_EVENT, 0.5),
+    (Interpretation.EXPIRE_EVENT, 0.5))
+WEB_EVENT_INTERPRETATIONS = (
+    (Interpretation.ACCESS_EVENT, 60),
+    (Interpretation.LEAVE_EVENT, 40))
+EVENT_MANIFESTATIONS = (
+    (Manifestation.USER_ACTIVITY, 85),
+    (Manifestation.HEURISTIC_ACTIVITY, 5),
+    (Manifestation.SCHEDULED_ACTIVITY, 4),
+    (Manifestation.SYSTEM_NOTIFICATION, 4),
+    (Manifestation.WORLD_ACTIVITY, 2))
+SUBJECT_COUNTS = ((1, 90), (2, 8), (3, 2))
+
+SYLLABLES = ('ba', 'ko', 'ri', 'te', 'lu', 'mo', 'sa', 'ne', 'di', 'va',
+    'pe', 'zu', 'ka', 'lo', 'mi', 'tor', 'ran', 'gel', 'bus', 'fin')
+
+def read_schema(path):
+    """
+    Return the schema version and the CREATE statements for the tables
+    and for the event indices, as found in sql-schema.vala
+    """
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    version = int(re.search(r'CORE_SCHEMA_VERSION = (\d+);', source).group(1))
+    methods = {}
+    for chunk in source.split('public static void ')[1:]:
+        name = chunk.split(None, 1)[0]
+        methods[name] = [' '.join(re.sub(r'--.*', '', sql).split())
+            for sql in re.findall(r'"""(.*?)"""', chunk, re.S)
+            if sql.split(None, 1)[0].upper() == 'CREATE']
+    return version, methods['create_schema'], methods['create_event_indices']
+
+def cumulative(weights):
+    return list(itertools.accumulate(weights))
+
+def zipf_weights(n, exponent):
+    return cumulative(1.0 / rank ** exponent for rank in range(1, n + 1))
+
+class ValueTable(dict):
+    """
+    Assigns consecutive ids to the values of one of the lookup tables
+    """
+
+    def __missing__(self, value):
+        self[value] = len(self) + 1
+        return self[value]
+
+class SyntheticDatabase():
+
+    def __init__(self, options):
+        self._options = options
+        self._random = random.Random(options.seed)
+        self._words = sorted(set(self._make_word() for i in range(2000)))
+        self._random.shuffle(self._words)
+
+        self.uris = ValueTable()
+        self.texts = ValueTable()
+        self.actors = ValueTable()
+        self.mimetypes = ValueTable()
+        self.interpretations = ValueTable()
+        self.manifestations = ValueTable()
+        self.storages = ValueTable()
+
+        self._subjects = []
+        self._make_subjects()
+        self._make_actors()
+
+        self._subject_weights = zipf_weights(len(self._subjects),
+            options.zipf)
+        self._actor_weights = zipf_weights(len(self._actor_ids), options.zipf)
+        self._interpretations = self._weighted(EVENT_INTERPRETATIONS,
+            self.interpretations)
+        self._web_interpretations = self._weighted(WEB_EVENT_INTERPRETATIONS,
+            self.interpretations)
+        self._manifestations = self._weighted(EVENT_MANIFESTATIONS,
+            self.manifestations)
+        self._subject_counts = [count for count, w in SUBJECT_COUNTS]
+        self._subject_count_weights = cumulative(
+            w for count, w in SUBJECT_COUNTS)
+        self._move_event = self.interpretations[Interpretation.MOVE_EVENT]
+
+    def _make_word(self):
+        return ''.join(self._random.choice(SYLLABLES)
+            for i in range(self._random.randint(1, 4)))
+
+    def _zipf_choices(self, population, k):
+        return self._random.choices(population,
+            cum_weights=zipf_weights(len(population), self._options.zipf), k=k)
+
+    def _weighted(self, pairs, table):
+        return ([table[value] for value, w in pairs],
+            cumulative(w for value, w in pairs))
+
+    def _make_subjects(self):
+        """
+        Create the pool of subjects. Each of them has a fixed URI, origin,
+        mimetype, text and storage, and an interpretation following the
+        ontology for its mimetype. The pool is ordered by popularity.
+        """
+        rand = self._random
+        mimes = sorted(MIMES)
+        rand.shuffle(mimes)
+        hosts = ['www.%s.%s' % (word, rand.choice(('com', 'org', 'net')))
+            for word in self._words[:500]]
+        folders = ['/home/user/%s' % '/'.join(rand.sample(self._words,
+            rand.randint(1, 4))) for i in range(2000)]
+        file_mimes = self._zipf_choices(mimes, self._options.uris)
+        file_folders = self._zipf_choices(folders, self._options.uris)
+        web_hosts = self._zipf_choices(hosts, self._options.uris)
+
+        for i in range(self._options.uris):
+            name = '%s-%d' % (rand.choice(self._words), i)
+            if rand.random() < 0.2:
+                origin = 'http://%s' % web_hosts[i]
+                uri = '%s/%s.html' % (origin, name)
+                mimetype = 'text/html'
+                interpretation = Interpretation.WEBSITE
+                manifestation = Manifestation.WEB_DATA_OBJECT
+                storage = 'net'
+            else:
+                mimetype = file_mimes[i]
+                origin = 'file://%s' % file_folders[i]
+                uri = '%s/%s.%s' % (origin, name,
+                    re.split(r'[/.+-]', mimetype)[-1])
+                interpretation = get_interpretation_for_mimetype(mimetype) \
+                    or Interpretation.DOCUMENT
+                manifestation = Manifestation.FILE_DATA_OBJECT
+                storage = 'unknown'
+            # Keep the subject columns of the event table ready to use
+            uri_id = self.uris[uri]
+            origin_id = self.uris[origin]
+            self._subjects.append(((None, None, uri_id, uri_id,
+                self.interpretations[interpretation],
+                self.manifestations[manifestation], origin_id, origin_id,
+                self.mimetypes[mimetype], self.texts[name],
+                self.storages[storage]), storage == 'net', uri))
+
+    def _make_actors(self):
+        self._actor_ids = [self.actors['application://%s.desktop' % word]
+            for word in self._words[:self._options.actors]]
+
+    def _hourly_event_counts(self, start, num_hours):
+        """
+        Distribute the events over the hours between `start` and the end
+        timestamp following the diurnal and weekly activity patterns, with
+        some day-to-day variation
+        """
+        weights = []
+        for day in range(0, num_hours, 24):
+            day_weight = DAILY_WEIGHTS[(start // DAY + day // 24) % 7] * \
+                self._random.lognormvariate(0, 0.5)
+            weights.extend(day_weight * HOURLY_WEIGHTS[(start // HOUR + hour) % 24]
+                for hour in range(day, min(day + 24, num_hours)))
+        total = sum(weights)
+        assigned = 0
+        for i, acc in enumerate(itertools.accumulate(weights)):
+            count = int(round(self._options.events * acc / total)) - assigned
+            assigned += count
+            yield i, min(count, HOUR)
+
+    def iter_events(self):
+        """
+        Yield the rows for the event table, ordered by timestamp
+        """
+        rand = self._random
+        options = self._options
+        end = options.end
+        num_hours = options.days * 24
+        start = end - num_hours * HOUR
+        subject_ranks = range(len(self._subjects))
+        self.num_events = 0
+
+        for hour, count in self._hourly_event_counts(start, num_hours):
+            if not count:
+                continue
+            offset = start + hour * HOUR
+            timestamps = sorted(rand.sample(range(HOUR), count))
+            subjects = rand.choices(subject_ranks,
+                cum_weights=self._subject_weights, k=count)
+            actors = rand.choices(self._actor_ids,
+                cum_weights=self._actor_weights, k=count)
+            manifestations = rand.choices(self._manifestations[0],
+                cum_weights=self._manifestations[1], k=count)
+            num_subjects = rand.choices(self._subject_counts,
+                cum_weights=self._subject_count_weights, k=count)
+            interpretations = rand.choices(self._interpretations[0],
+                cum_weights=self._interpretations[1], k=count)
+            web_interpretations = rand.choices(self._web_interpretations[0],
+                cum_weights=self._web_interpretations[1], k=count)
+            for i in range(count):
+                self.num_events += 1
+                subject = self._subjects[subjects[i]]
+                event = (self.num_events, offset + timestamps[i],
+                    web_interpretations[i] if subject[1]
+                        else interpretations[i],
+                    manifestations[i], actors[i])
+                if num_subjects[i] > 1:
+                    ranks = {subjects[i]}
+                    while len(ranks) < num_subjects[i]:
+                        ranks.add(rand.choices(subject_ranks,
+                            cum_weights=self._subject_weights)[0])
+                    event_subjects = [self._subjects[rank]
+                        for rank in sorted(ranks)]
+                else:
+                    event_subjects = (subject,)
+                for subject in event_subjects:
+                    if event[2] == self._move_event:
+                        yield event + self._moved_subject(event, subject)
+                    else:
+                        yield event + subject[0]
+
+    def _moved_subject(self, event, subject):
+        columns, is_web, uri = subject
+        current_uri = self.uris['%s.moved-%d' % (uri, event[0])]
+        return columns[:3] + (current_uri,) + columns[4:]
+
+    def write_lookup_tables(self, db):
+        for table in ('uri', 'text', 'actor', 'mimetype', 'interpretation',
+                'manifestation'):
+            values = getattr(self, '%ss' % table)
+            db.executemany('INSERT INTO %s (id, value) VALUES (?, ?)' % table,
+                ((id, str(value)) for value, id in values.items()))
+        db.executemany('INSERT INTO storage (id, value, state) '
+            'VALUES (?, ?, 1)', ((id, value)
+                for value, id in self.storages.items()))
+
+EVENT_INSERTION = '''
+    INSERT INTO event (
+        id, timestamp, interpretation, manifestation, actor,
+        origin, payload, subj_id, subj_id_current,
+        subj_interpretation, subj_manifestation, subj_origin,
+        subj_origin_current, subj_mimetype, subj_text, subj_storage
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+def build_database(path, options):
+    version, tables, indices = read_schema(options.schema)
+    generator = SyntheticDatabase(options)
+
+    db = sqlite3.connect(path, isolation_level=None)
+    # The file is thrown away if anything goes wrong, so don't bother
+    # keeping a journal while loading it
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('PRAGMA cache_size = -262144')
+    db.execute('PRAGMA temp_store = MEMORY')
+    # Let SQLite sort with several threads when building the indices
+    db.execute('PRAGMA threads = %d' % min(os.cpu_count() or 1, 8))
+
+    started = time.time()
+    db.execute('BEGIN')
+    for sql in tables:
+        db.execute(sql)
+    db.execute("INSERT INTO schema_version VALUES ('core', ?)", (version,))
+    db.execute("INSERT INTO schema_version VALUES ('database_creation', ?)",
+        (options.end - options.days * DAY,))
+
+    num_rows = 0
+    rows = generator.iter_events()
+    while True:
+        chunk = list(itertools.islice(rows, 100000))
+        if not chunk:
+            break
+        db.executemany(EVENT_INSERTION, chunk)
+        num_rows += len(chunk)
+        elapsed = time.time() - started
+        print('Inserted %d rows (%d rows/s)' % (num_rows, num_rows / elapsed))
+
+    # The lookup tables are written last, as MOVE_EVENTs add new URIs
+    generator.write_lookup_tables(db)
+    db.execute('COMMIT')
+
+    # Building the indices once is much faster than keeping them up to
+    # date while loading the events
+    print('Creating indices...')
+    for sql in indices:
+        db.execute(sql)
+    db.execute('ANALYZE')
+    db.execute('PRAGMA journal_mode = WAL')
+    db.close()
+
+    elapsed = time.time() - started
+    print('Wrote %d events (%d rows, %d URIs) in %.1fs.' % (
+        generator.num_events, num_rows, len(generator.uris), elapsed))
+
+def main():
+    parser = OptionParser(usage='%prog [options] <database file>')
+    parser.add_option('-n', '--events', type='int', default=1000000,
+        help='number of events [default: %default]')
+    parser.add_option('-u', '--uris', type='int', default=None,
+        help='number of distinct subjects [default: events / 20]')
+    parser.add_option('-a', '--actors', type='int', default=200,
+        help='number of distinct actors [default: %default]')
+    parser.add_option('-d', '--days', type='int', default=365,
+        help='number of days covered by the events [default: %default]')
+    parser.add_option('-e', '--end', type='int', default=DEFAULT_END,
+        help='timestamp of the end of the covered time range, in '
+            'milliseconds [default: %default]')
+    parser.add_option('-z', '--zipf', type='float', default=1.1,
+        help='exponent of the Zipf distribution used for subjects and '
+            'actors [default: %default]')
+    parser.add_option('-s', '--seed', type='int', default=0,
+        help='seed for the random number generator [default: %default]')
+    parser.add_option('--schema', default=SCHEMA_FILE,
+        help='sql-schema.vala to read the tables from [default: %default]')
+    parser.add_option('-f', '--force', action='store_true', default=False,
+        help='overwrite the database file if it already exists')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected a single database file')
+    if options.uris is None:
+        options.uris = max(1000, options.events // 20)
+    path = args[0]
+
+    if os.path.exists(path) and not options.force:
+        parser.error('%s already exists (use --force to replace it)' % path)
+    partial_path = path + '.partial'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(partial_path + suffix):
+            os.remove(partial_path + suffix)
+    try:
+        build_database(partial_path, options)
+    except:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.rename(partial_path, path)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('Interrupted.', file=sys.stderr)
+        sys.exit(1)
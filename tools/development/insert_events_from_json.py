@@ -1,7 +1,7 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 # -.- coding: utf-8 -.-
 
-# Zeitgeist - Send all events from a JSON file to Zeitgeist
+# Zeitgeist - Send all events from a JSON file or event dump to Zeitgeist
 #
 # Copyright © 2012 Collabora Ltd.
 #             By Siegfried-A. Gevatter <siegfried.gevatter@collabora.co.uk>
@@ -27,35 +27,214 @@
 #          Zeitgeist.
 # #############################################################################
 
+import io
+import json
 import os
+import re
 import sys
+import time
+from optparse import OptionParser
+
+from gi.repository import GLib
+from dbus.mainloop.glib import DBusGMainLoop
+DBusGMainLoop(set_as_default=True)
 
 from zeitgeist.datamodel import *
 from zeitgeist.client import ZeitgeistDBusInterface
 
-# Import parse_events from testutils.py
+# Import dict2event from testutils.py
 path = os.path.join(os.path.dirname(__file__), '../../test/dbus')
 sys.path.append(path)
-from testutils import parse_events
+from testutils import dict2event
 
 # Max. number of events to send in a D-Bus call
 LIMIT = 100
 
-def insert_events(events):
-    iface = ZeitgeistDBusInterface()
-    print "Inserting %d events..." % len(events)
-    while len(events):
-        iface.InsertEvents(events[:LIMIT])
-        events = events[LIMIT:]
-        print "."
-    print 'OK.'
+# Max. size of the JSON for the events sent in a D-Bus call
+SIZE_LIMIT = 1024 * 1024
+
+# Number of D-Bus calls to have in flight at the same time
+IN_FLIGHT = 4
+
+_WHITESPACE = re.compile(r'\s*')
+
+# Characters which may continue a JSON number
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+def iter_json_array(f, chunk_size=64 * 1024):
+    """
+    Parse the JSON array in the file object `f` incrementally, yielding
+    each of its items together with the size of its JSON text. Only the
+    current item and a chunk of the file are kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    expected = '['
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf) and not eof:
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        char = buf[pos:pos + 1]
+        if expected == '[':
+            if char != '[':
+                raise ValueError('Expected a JSON array')
+            pos += 1
+            expected = 'item or ]'
+        elif expected == ', or ]' or (expected == 'item or ]' and char == ']'):
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError('Expected , or ] in the JSON array')
+            pos += 1
+            expected = 'item'
+        else:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = len(buf)
+            # The item may continue in the next chunk. A number may
+            # also have been cut before its fraction or exponent, in
+            # which case it's followed by nothing but number characters.
+            if not eof and (end == len(buf) or (
+                    isinstance(item, (int, float))
+                    and not isinstance(item, bool)
+                    and _NUMBER_TAIL.match(buf, end).end() == len(buf))):
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield item, end - pos
+            pos = end
+            expected = ', or ]'
+
+def is_json_file(f):
+    """
+    Check if the binary file object `f` holds a JSON array rather than
+    an event dump written by Event.dump_many
+    """
+    is_json = f.read(64).lstrip()[:1] == b'['
+    f.seek(0)
+    return is_json
+
+def event_size(event):
+    """
+    Roughly estimate the size of `event`, for events which weren't read
+    from JSON
+    """
+    size = sum(len(value or '') for value in event[0]) + len(event[2] or '')
+    for subject in event[1]:
+        size += sum(map(len, subject))
+    return size
+
+def iter_batches(items, limit=LIMIT, size_limit=SIZE_LIMIT):
+    """
+    Group the (event, size) pairs from `items` in lists of at most
+    `limit` events and, unless a single event is bigger, `size_limit`
+    bytes of JSON (or of event data, see event_size)
+    """
+    batch = []
+    size = 0
+    for event, event_size in items:
+        if batch and (len(batch) >= limit or size + event_size > size_limit):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(event)
+        size += event_size
+    if batch:
+        yield batch
+
+class EventInserter(object):
+    """
+    Sends batches of events to Zeitgeist, keeping up to `in_flight`
+    InsertEvents calls pending at the same time
+    """
+
+    def __init__(self, batches, in_flight=IN_FLIGHT):
+        self._iface = ZeitgeistDBusInterface()
+        self._batches = batches
+        self._in_flight = in_flight
+        self._pending = 0
+        self._inserted = 0
+        self._error = None
+        self._started = None
+        self._last_report = 0
+        self._mainloop = GLib.MainLoop()
+
+    def run(self):
+        self._started = time.time()
+        GLib.idle_add(self._send)
+        self._mainloop.run()
+        self._report(force=True)
+        if self._error is not None:
+            raise self._error
+        print('OK.')
+
+    def _send(self):
+        while self._error is None and self._pending < self._in_flight:
+            batch = next(self._batches, None)
+            if batch is None:
+                break
+            self._pending += 1
+            self._iface.InsertEvents(batch,
+                reply_handler=self._on_reply, error_handler=self._on_error)
+        if not self._pending:
+            self._mainloop.quit()
+        return False
+
+    def _on_reply(self, ids):
+        self._pending -= 1
+        self._inserted += len(ids)
+        self._report()
+        self._send()
+
+    def _on_error(self, error):
+        self._pending -= 1
+        self._error = error
+        if not self._pending:
+            self._mainloop.quit()
+
+    def _report(self, force=False):
+        now = time.time()
+        if not force and now - self._last_report < 1:
+            return
+        self._last_report = now
+        elapsed = max(now - self._started, 1e-6)
+        print('Inserted %d events (%d events/s)' % (self._inserted,
+            self._inserted / elapsed))
 
 def main():
-    if len(sys.argv) != 2:
-        raise SystemExit, 'Usage: %s <json file>' % sys.argv[0]
+    parser = OptionParser(usage='%prog [options] <json or event dump file>')
+    parser.add_option('-b', '--batch-events', type='int', default=LIMIT,
+        help='max. number of events per D-Bus call [default: %default]')
+    parser.add_option('-s', '--batch-size', type='int', default=SIZE_LIMIT,
+        help='max. bytes of JSON per D-Bus call [default: %default]')
+    parser.add_option('-j', '--in-flight', type='int', default=IN_FLIGHT,
+        help='number of D-Bus calls in flight [default: %default]')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected a single JSON or event dump file')
 
-    events = parse_events(sys.argv[1])
-    insert_events(events)
+    with open(args[0], 'rb') as f:
+        if is_json_file(f):
+            events = ((dict2event(item), size) for item, size
+                in iter_json_array(io.TextIOWrapper(f, encoding='utf-8')))
+        else:
+            # Dumps load several times faster than JSON
+            events = ((event, event_size(event))
+                for event in Event.iter_many(f))
+        batches = iter_batches(events, options.batch_events,
+            options.batch_size)
+        EventInserter(batches, options.in_flight).run()
 
 if __name__ == '__main__':
     try:
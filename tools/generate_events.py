@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 # -.- coding: utf-8 -.-
 
 # Zeitgeist - Insert random events into the database
@@ -31,8 +31,12 @@ import os
 import sys
 import time
 import random
+import multiprocessing
 from collections import deque
-from gi.repository import GLib, GObject
+from optparse import OptionParser
+from queue import Empty
+from gi.repository import GLib
+from dbus.mainloop.glib import DBusGMainLoop
 
 from zeitgeist import mimetypes
 from zeitgeist.datamodel import *
@@ -47,25 +51,46 @@ class EventGenerator:
     _mimetypes = None
     _desktop_files = None
     _schemas = None
+    _event_interpretations = None
+    _event_manifestations = None
+    _subject_interpretations = None
+    _subject_manifestations = None
     _uri_table = None
     _timestamp_generator = None
 
+    _event_factory = EventFactory(
+        ('timestamp', 'interpretation', 'manifestation', 'actor', 'origin'),
+        ('uri', 'current_uri', 'interpretation', 'manifestation', 'origin',
+            'mimetype', 'text'))
+
     def __init__(self):
         # Initialize a pool of random words for use in URIs, etc.
-        dictionary_words = map(str.strip,
-            open('/usr/share/dict/words').readlines())
-        dictionary_words = filter(lambda x: '\'s' not in x, dictionary_words)
+        with open('/usr/share/dict/words') as f:
+            dictionary_words = [word.strip() for word in f
+                if '\'s' not in word]
         self._words = random.sample(dictionary_words, self.NUM_WORDS)
 
         # Initialize timestamp generator
         self._timestamp_generator = TimestampGenerator()
 
         # Initialize a pool of MIME-Types
-        self._mimetypes = mimetypes.MIMES.keys()
+        self._mimetypes = list(mimetypes.MIMES.keys())
 
         # Initialize a pool of application names
-        self._desktop_files =  filter(lambda actor: actor.endswith('.desktop'),
-            os.listdir('/usr/share/applications'))
+        self._desktop_files = [actor for actor in
+            os.listdir('/usr/share/applications') if actor.endswith('.desktop')]
+
+        # Initialize pools of interpretations and manifestations. They are
+        # kept as plain strings so that events can be pickled and handed
+        # over to the inserting process.
+        ev_interp = Interpretation.EVENT_INTERPRETATION.get_children()
+        ev_manif = Manifestation.EVENT_MANIFESTATION.get_children()
+        self._event_interpretations = [str(x) for x in ev_interp]
+        self._event_manifestations = [str(x) for x in ev_manif]
+        self._subject_interpretations = [str(x) for x in
+            set(Interpretation.get_children()).difference(ev_interp)]
+        self._subject_manifestations = [str(x) for x in
+            set(Interpretation.get_children()).difference(ev_manif)]
 
         # Initialize a list of URI schemas
         self._schemas = ('application', 'davs', 'http', 'https', 'ftp')
@@ -88,7 +113,7 @@ class EventGenerator:
             ]
         else:
             extensions = self._words
-        return filter(str.isalpha, random.choice(extensions))
+        return ''.join(filter(str.isalpha, random.choice(extensions)))
 
     def get_path(self, force_directory=False):
         path = ''
@@ -155,64 +180,49 @@ class EventGenerator:
         return self._timestamp_generator.next()
 
     def get_event_interpretation(self):
-        interpretations = Interpretation.EVENT_INTERPRETATION.get_children()
-        return random.choice(list(interpretations))
+        return random.choice(self._event_interpretations)
 
     def get_subject_interpretation(self):
-        ev_interp = Interpretation.EVENT_INTERPRETATION.get_children()
-        subj_interp = set(Interpretation.get_children())
-        subj_interp.difference_update(ev_interp)
-        return random.choice(list(subj_interp))
+        return random.choice(self._subject_interpretations)
 
     def get_event_manifestation(self):
         if random.random() < 0.3:
-            manifestations = Manifestation.EVENT_MANIFESTATION.get_children()
-            return random.choice(list(manifestations))
+            return random.choice(self._event_manifestations)
         else:
-            return Manifestation.USER_ACTIVITY
+            return str(Manifestation.USER_ACTIVITY)
 
     def get_subject_manifestation(self):
-        ev_manif = Manifestation.EVENT_MANIFESTATION.get_children()
-        subj_manif = set(Interpretation.get_children())
-        subj_manif.difference_update(ev_manif)
-        return random.choice(list(subj_manif))
+        return random.choice(self._subject_manifestations)
 
     def get_subject(self, event_interpretation):
         uri = self.get_uri()
 
-        subject = Subject.new_for_values(
-            uri            = uri,
-            current_uri    = uri,
-            interpretation = self.get_subject_interpretation(),
-            manifestation  = self.get_subject_manifestation(),
-            origin         = self.get_subject_origin(uri),
-            mimetype       = random.choice(self._mimetypes),
-            text           = self.get_text(),
-            storage        = "")
-
+        current_uri = uri
         if event_interpretation == Interpretation.MOVE_EVENT:
-            while subject.uri == subject.current_uri:
-                subject.current_uri = self.get_uri()
+            while current_uri == uri:
+                current_uri = self.get_uri()
 
-        return subject
+        return (uri, current_uri, self.get_subject_interpretation(),
+            self.get_subject_manifestation(), self.get_subject_origin(uri),
+            random.choice(self._mimetypes), self.get_text())
 
     def get_event(self):
         event_interpretation = self.get_event_interpretation()
-        event = Event.new_for_values(
-            timestamp      = self.get_timestamp(),
-            interpretation = event_interpretation,
-            manifestation  = self.get_event_manifestation(),
-            actor          = self.get_actor(),
-            origin         = self.get_event_origin())
 
         num_subjects = max(1, abs(int(random.gauss(1, 1))))
-        while len(event.subjects) < num_subjects:
+        subjects = []
+        while len(subjects) < num_subjects:
             subject = self.get_subject(event_interpretation)
-            if subject.uri not in (x.uri for x in event.get_subjects()):
+            if subject[0] not in (x[0] for x in subjects):
                 # events with two subjects having the same URI aren't supported
-                event.append_subject(subject)
+                subjects.append(subject)
 
-        return event
+        return self._event_factory.new_event((
+            self.get_timestamp(),
+            event_interpretation,
+            self.get_event_manifestation(),
+            self.get_actor(),
+            self.get_event_origin()), subjects)
 
 class TimestampGenerator():
 
@@ -239,6 +249,29 @@ class TimestampGenerator():
     def current_time():
         return int(time.time() * 1000)
 
+def generate_events(queue, limit, batch_size, seed):
+    """
+    Worker process: generate `limit` events and put them on `queue` in
+    batches of `batch_size`, followed by None once done
+    """
+    random.seed(seed)
+    try:
+        generator = EventGenerator()
+        batch = []
+        for i in range(limit):
+            event = generator.get_event()
+            event.payload = 'generate_events.py'
+            batch.append(event)
+            if len(batch) >= batch_size:
+                queue.put(batch)
+                batch = []
+        if batch:
+            queue.put(batch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.put(None)
+
 class EventInserter():
 
     BUFFER_SIZE = 1000
@@ -268,25 +301,128 @@ class EventInserter():
     def get_insertion_count(self):
         return self._events_inserted
 
+class AsyncEventInserter():
+    """
+    Takes batches of events from the generator processes and sends them
+    to Zeitgeist, keeping up to `in_flight` InsertEvents calls pending at
+    the same time
+    """
+
+    POLL_INTERVAL = 10
+
+    def __init__(self, queue, num_workers, in_flight):
+        self._log = ZeitgeistDBusInterface()
+        self._queue = queue
+        self._workers_left = num_workers
+        self._in_flight = in_flight
+        self._pending = 0
+        self._inserted = 0
+        self._error = None
+        self._started = None
+        self._polling = False
+        self._last_report = (0, 0)
+        self._mainloop = GLib.MainLoop()
+
+    def run(self):
+        self._started = time.time()
+        self._last_report = (self._started, 0)
+        GLib.idle_add(self._send)
+        self._mainloop.run()
+        if self._error is not None:
+            raise self._error
+
+    def _send(self):
+        self._polling = False
+        while self._error is None and self._workers_left and \
+                self._pending < self._in_flight:
+            try:
+                batch = self._queue.get_nowait()
+            except Empty:
+                # The generators are lagging behind, check again later
+                self._polling = True
+                GLib.timeout_add(self.POLL_INTERVAL, self._send)
+                break
+            if batch is None:
+                self._workers_left -= 1
+                continue
+            self._pending += 1
+            self._log.InsertEvents(batch,
+                reply_handler=self._on_reply, error_handler=self._on_error)
+        if not self._pending and (self._error is not None or
+                not self._workers_left):
+            self._mainloop.quit()
+        return False
+
+    def _on_reply(self, ids):
+        self._pending -= 1
+        self._inserted += len(ids)
+        self._report()
+        if not self._polling:
+            self._send()
+
+    def _on_error(self, error):
+        self._pending -= 1
+        self._error = error
+        if not self._pending:
+            self._mainloop.quit()
+
+    def _report(self):
+        now = time.time()
+        last_time, last_inserted = self._last_report
+        if now - last_time < 1:
+            return
+        self._last_report = (now, self._inserted)
+        print("Inserted %d events (%d events/s, %d events/s overall)." % (
+            self._inserted, (self._inserted - last_inserted) / (now - last_time),
+            self._inserted / (now - self._started)))
+
+    def get_insertion_count(self):
+        return self._inserted
+
+    def get_elapsed_time(self):
+        return time.time() - self._started
+
 def main():
-    limit = '10000000' if len(sys.argv) < 2 else sys.argv[1]
-    if len(sys.argv) > 2 or not limit.isdigit():
-        print "Usage: %s [<num_events>]" % sys.argv[0]
-        sys.exit(1)
+    parser = OptionParser(usage='%prog [options] [<num_events>]')
+    parser.add_option('-w', '--workers', type='int',
+        default=multiprocessing.cpu_count(),
+        help='number of processes generating events [default: %default]')
+    parser.add_option('-j', '--in-flight', type='int', default=4,
+        help='number of D-Bus calls in flight [default: %default]')
+    parser.add_option('-b', '--batch-size', type='int', default=1000,
+        help='number of events per D-Bus call [default: %default]')
+    (options, args) = parser.parse_args()
+    limit = '10000000' if not args else args[0]
+    if len(args) > 1 or not limit.isdigit():
+        parser.error('expected a single number of events')
     limit = int(limit)
-
-    event_inserter = EventInserter()
+    num_workers = max(1, min(options.workers, limit))
+
+    DBusGMainLoop(set_as_default=True)
+
+    # Bound the queue so that generators can't run too far ahead of the
+    # inserter and fill up the memory
+    queue = multiprocessing.Queue(maxsize=2 * num_workers + options.in_flight)
+    workers = []
+    for i in range(num_workers):
+        share = limit // num_workers + (1 if i < limit % num_workers else 0)
+        worker = multiprocessing.Process(target=generate_events,
+            args=(queue, share, options.batch_size, random.random()))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    event_inserter = AsyncEventInserter(queue, num_workers, options.in_flight)
     try:
-        generator = EventGenerator()
-        for i in xrange(limit):
-            event = generator.get_event()
-            event.payload = 'generate_events.py'
-            if event_inserter.insert(event):
-                print "Inserted %d events." % i
+        event_inserter.run()
     except KeyboardInterrupt:
         pass
-    event_inserter.flush()
-    print "Inserted %d events. Done." % event_inserter.get_insertion_count()
+    for worker in workers:
+        worker.terminate()
+    elapsed = event_inserter.get_elapsed_time()
+    print("Inserted %d events in %.1fs (%d events/s). Done." % (
+        event_inserter.get_insertion_count(), elapsed,
+        event_inserter.get_insertion_count() / elapsed))
 
 if __name__ == '__main__':
     main()